@@ -30,6 +30,21 @@ class BasePlugin(metaclass=BaseMeta):
 
     `name` *must* be defined in child classes or else the plugin manager will
     complain quite thoroughly.
+
+    Packet hooks (on_*) may be plain functions or coroutines. Hooks that only
+    check or update in-memory state should be plain functions; the plugin
+    manager calls those directly instead of allocating a coroutine for
+    every packet.
+
+    Plugins that talk to outside services can set `isolate` to the name of
+    a plugin loop. The plugin manager then runs their activation and hooks
+    on that loop's own thread (plugins naming the same loop share it), and
+    `self.isolation` is set to the `plugin_manager.IsolatedLoop`. Use
+    `utilities.on_plugin_loop` and `utilities.on_main_loop` on methods
+    that other plugins call, or that reach back into the server.
+
+    `self.events` is the plugin manager's `events.EventBus`. Methods
+    decorated with `events.subscribe` receive the events they name.
     """
 
     name = "Base Plugin"
@@ -39,7 +54,17 @@ class BasePlugin(metaclass=BaseMeta):
     default_config = None
     plugins = DotDict({})
     auto_activate = True
-    background_tasks = set()
+    isolate = None
+    isolation = None
+    events = None
+    # Plugins whose module defines classes that end up pickled in storage
+    # can't be reloaded, since pickle refuses to save instances of a class
+    # that has been replaced in its module.
+    reloadable = True
+    # Seconds between player_manager's checks of the plugin's storage for
+    # changes made in place without calling `touch` on it (see
+    # `utilities.PluginStorage`). None for plugins that always touch it.
+    storage_check_interval = 30
 
     def __init__(self):
         self.loop = asyncio.get_event_loop()
@@ -60,8 +85,14 @@ class BasePlugin(metaclass=BaseMeta):
         pass
 
     # helper to ensure background tasks get properly referenced until awaited
-    def background(self, coro):
-        return background(coro)
+    def background(self, coro, name=None, connection=None):
+        """
+        Runs a coroutine as a background task owned by this plugin, so it
+        is cancelled when the plugin is deactivated. Pass `connection` for
+        work done on behalf of a player, so it also stops when they leave.
+        """
+        return background(coro, name=name, connection=connection,
+                          plugin=self.name)
 
     async def on_protocol_request(self, data, connection):
         """Packet type: 0 """
@@ -344,6 +375,10 @@ class SimpleCommandPlugin(BasePlugin):
                 for alias in attr._aliases:
                     self.plugins['command_dispatcher'].register(attr, alias)
 
+    async def deactivate(self):
+        await super().deactivate()
+        self.plugins['command_dispatcher'].unregister(self)
+
 
 class StoragePlugin(BasePlugin):
     name = "storage_plugin"
@@ -351,7 +386,7 @@ class StoragePlugin(BasePlugin):
 
     async def activate(self):
         await super().activate()
-        self.storage = self.plugins.player_manager.get_storage(self.name)
+        self.storage = self.plugins.player_manager.get_storage(self)
 
 
 class StorageCommandPlugin(SimpleCommandPlugin):
@@ -0,0 +1,65 @@
+"""
+Benchmark: per-packet cost of PluginManager.do for coroutine hooks versus
+plain synchronous hooks.
+
+Run from the repository root:
+
+    python -m benchmarks.dispatch [hooks] [packets]
+"""
+
+import asyncio
+import sys
+import time
+
+from base_plugin import BasePlugin
+from configuration_manager import ConfigurationManager
+from plugin_manager import PluginManager
+
+
+def make_plugin(index, sync):
+    if sync:
+        def on_tile_update(self, data, connection):
+            return True
+    else:
+        async def on_tile_update(self, data, connection):
+            return True
+    return type("Bench%d" % index, (BasePlugin,),
+                {"name": "bench_%d" % index,
+                 "on_tile_update": on_tile_update})
+
+
+def build_manager(hooks, sync):
+    config = ConfigurationManager()
+    config._config = {"min_cache_size": 16, "packet_reap_time": 600,
+                      "plugins": {}}
+    manager = PluginManager(config)
+    for index in range(hooks):
+        cls = make_plugin(index, sync)
+        cls.config = config
+        manager._seen_classes.add(cls)
+    manager.resolve_dependencies()
+    return manager
+
+
+async def run(hooks, sync, count):
+    packet = {"type": 27, "size": 0, "data": b"", "original_data": b"",
+              "direction": 1}
+    manager = build_manager(hooks, sync)
+    await manager.activate_all()
+    start = time.perf_counter()
+    for _ in range(count):
+        await manager.do(None, "tile_update", packet)
+    elapsed = time.perf_counter() - start
+    manager._packet_parser._reaper.cancel()
+    return elapsed
+
+
+def main(hooks=25, count=100000):
+    for label, sync in (("async", False), ("sync", True)):
+        elapsed = asyncio.run(run(hooks, sync, count))
+        print("{:>5} hooks x{}: {:.2f} us/packet".format(
+            label, hooks, elapsed / count * 1e6))
+
+
+if __name__ == "__main__":
+    main(*[int(x) for x in sys.argv[1:]])
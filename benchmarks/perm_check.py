@@ -0,0 +1,64 @@
+"""
+Benchmark: Player.perm_check throughput checking permission sets the way
+it used to (lowercasing the permission, then looking it up in up to three
+sets) versus as bitsets of interned permission IDs.
+
+Run from the repository root:
+
+    python -m benchmarks.perm_check [calls]
+"""
+
+import json
+import sys
+import time
+import types
+
+from plugins.player_manager import Player, PlayerManager
+
+
+def legacy_perm_check(player, perm):
+    # perm_check as it was, with the player's permissions in a set.
+    if not perm:
+        return True
+    elif "special.allperms" in player.permissions:
+        return True
+    elif perm.lower() in player.revoked_perms:
+        return False
+    elif perm.lower() in player.permissions:
+        return True
+    else:
+        return False
+
+
+def rate(f, player, perm, calls):
+    start = time.perf_counter()
+    for _ in range(calls):
+        f(player, perm)
+    return calls / (time.perf_counter() - start) / 1e6
+
+
+def main(calls=1000000):
+    with open("config/permissions.json.default") as file:
+        ranks = PlayerManager._rebuild_ranks(None, json.load(file))
+    cases = (("guest, planet_protect.bypass (no)", "guest",
+              "planet_protect.bypass"),
+             ("guest, general_commands.who (yes)", "guest",
+              "general_commands.who"),
+             ("admin, planet_protect.bypass (yes)", "admin",
+              "planet_protect.bypass"),
+             ("owner, anything (special.allperms)", "owner",
+              "emsg_blocker.bypass"))
+    for name, rank, perm in cases:
+        player = Player("uuid", ranks={rank})
+        player.update_ranks(ranks)
+        legacy = types.SimpleNamespace(permissions=set(player.permissions),
+                                       revoked_perms=set())
+        old = rate(legacy_perm_check, legacy, perm, calls)
+        Player.rank_table = ranks
+        new = rate(Player.perm_check, player, perm, calls)
+        print("{}: {:.1f} M checks/s (sets), {:.1f} M checks/s "
+              "(bitsets)".format(name, old, new))
+
+
+if __name__ == "__main__":
+    main(*[int(x) for x in sys.argv[1:]])
@@ -0,0 +1,101 @@
+"""
+Benchmark: looking players up by alias and IP by scanning the player
+database (as PlayerManager does until its index is built) versus through
+the PlayerIndex, plus the time it takes to build the index; and looking
+online players up by client ID by scanning versus the OnlineRegistry.
+
+Run from the repository root:
+
+    python -m benchmarks.player_lookup [players] [lookups]
+"""
+
+import sys
+import time
+
+from plugins.player_manager import OnlineRegistry, Player, PlayerIndex
+
+
+def make_players(count, online):
+    players = {}
+    for x in range(count):
+        player = Player("uuid%d" % x, name="Player %d" % x,
+                        alias="Player%d" % x,
+                        ip="10.%d.%d.%d" % (x >> 16, x >> 8 & 255, x & 255))
+        if x % 100 == 0:
+            player.client_id = x
+            player.logged_in = True
+            online.add(player)
+        players[player.uuid] = player
+    return players
+
+
+def scan_alias(players, alias):
+    alias = alias.lower()
+    for player in players.values():
+        if player.alias.lower() == alias:
+            return player
+
+
+def scan_ip(players, ip):
+    for player in players.values():
+        if player.ip == ip:
+            return player
+
+
+def scan_client_id(players, client_id):
+    for player in players.values():
+        if player.client_id == client_id and player.logged_in:
+            return player
+
+
+def index_alias(index, alias):
+    for player in index.find("alias", alias):
+        return player
+
+
+def index_ip(index, ip):
+    for player in index.find("ip", ip):
+        return player
+
+
+def per_lookup(f, target, keys):
+    start = time.perf_counter()
+    for key in keys:
+        f(target, key)
+    return (time.perf_counter() - start) / len(keys) * 1e6
+
+
+def main(count=50000, lookups=200):
+    online = OnlineRegistry()
+    players = make_players(count, online)
+    start = time.perf_counter()
+    index = PlayerIndex(players)
+    for _ in index.build():
+        pass
+    print("{} players: index built in {:.0f} ms".format(
+        count, (time.perf_counter() - start) * 1000))
+
+    step = max(1, count // lookups)
+    client_ids = list(range(0, count, 100))[:lookups]
+    cases = (
+        ("alias", scan_alias, index, index_alias,
+         ["PLAYER%d" % x for x in range(0, count, step)],
+         ["Nobody%d" % x for x in range(lookups)]),
+        ("ip", scan_ip, index, index_ip,
+         ["10.%d.%d.%d" % (x >> 16, x >> 8 & 255, x & 255)
+          for x in range(0, count, step)],
+         ["192.168.0.%d" % (x & 255) for x in range(lookups)]),
+        ("client id", scan_client_id, online, OnlineRegistry.by_client_id,
+         client_ids, [-x - 2 for x in range(lookups)]),
+    )
+    for name, scan, target, lookup, hits, misses in cases:
+        print("by {}: hit {:.1f} us (scan), {:.2f} us (index); "
+              "miss {:.1f} us (scan), {:.2f} us (index)".format(
+                  name, per_lookup(scan, players, hits),
+                  per_lookup(lookup, target, hits),
+                  per_lookup(scan, players, misses),
+                  per_lookup(lookup, target, misses)))
+
+
+if __name__ == "__main__":
+    main(*[int(x) for x in sys.argv[1:]])
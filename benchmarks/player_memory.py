@@ -0,0 +1,103 @@
+"""
+Benchmark: memory taken by players loaded from the player database, as
+they were saved before Player had slots (each with its own __dict__ and
+permission sets), loaded into the old dict-based class and into the
+current slotted one.
+
+Run from the repository root:
+
+    python -m benchmarks.player_memory [players]
+"""
+
+import datetime
+import gc
+import io
+import json
+import pickle
+import sys
+import tracemalloc
+
+from plugins.player_manager import Player, PlayerManager, Planet
+from utilities import Tracked
+
+
+class LegacyPlayer(Tracked):
+    """
+    Players as they were loaded before they had slots.
+    """
+
+
+def old_records(count, ranks):
+    planets = [Planet((x, -x, 0), x % 12, 0) for x in range(100)]
+    now = datetime.datetime.now()
+    records = []
+    for x in range(count):
+        player_ranks = {"Guest"} if x % 10 else {"Guest", "Registered"}
+        permissions = set()
+        for rank in player_ranks:
+            permissions |= ranks[rank.lower()]["permissions"]
+        planet = planets[x % len(planets)]
+        records.append(dict(
+            uuid="%032x" % x, species="human", name="Player %d" % x,
+            alias="Player%d" % x, last_seen=now, ranks=player_ranks,
+            granted_perms=set(), revoked_perms=set(),
+            permissions=permissions, chat_prefix="", priority=0,
+            logged_in=False, client_id=-1,
+            ip="10.%d.%d.%d" % (x >> 16, x >> 8 & 255, x & 255),
+            location=planet, last_location=planet, muted=False,
+            team_id=None))
+    return records
+
+
+def pickles(records):
+    # Old records, as the old class pickled them.
+    data = []
+    for state in records:
+        player = LegacyPlayer.__new__(LegacyPlayer)
+        player.__dict__.update(state)
+        data.append(pickle.dumps(player, 4))
+    return data
+
+
+class Unpickler(pickle.Unpickler):
+    # Loads the old records into a different class.
+    cls = None
+
+    def find_class(self, module, name):
+        if name == "LegacyPlayer":
+            return self.cls
+        return super().find_class(module, name)
+
+
+def load(data, cls):
+    Unpickler.cls = cls
+    gc.collect()
+    tracemalloc.start()
+    players = []
+    for record in data:
+        players.append(Unpickler(io.BytesIO(record)).load())
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return used, players
+
+
+def main(count=100000):
+    with open("config/permissions.json.default") as file:
+        ranks = PlayerManager._rebuild_ranks(None, json.load(file))
+    Player.rank_table = ranks
+    data = pickles(old_records(count, ranks))
+    old, players = load(data, LegacyPlayer)
+    del players
+    new, players = load(data, Player)
+    sizes = [len(pickle.dumps(x, 4)) for x in players[:1000]]
+    print("{} players: {:.1f} MB with a __dict__, {:.1f} MB slotted "
+          "({:.0f}% less)".format(count, old / 2 ** 20, new / 2 ** 20,
+                                  (1 - new / old) * 100))
+    print("record size: {:.0f} bytes before, {:.0f} bytes saved again"
+          .format(sum(len(x) for x in data[:1000]) / 1000,
+                  sum(sizes) / len(sizes)))
+
+
+if __name__ == "__main__":
+    main(*[int(x) for x in sys.argv[1:]])
@@ -0,0 +1,114 @@
+"""
+Benchmark: startup, lookup and save times of the player database storage
+engines, and startup time and memory use with and without lazy loading.
+
+Run from the repository root:
+
+    python -m benchmarks.storage [players]
+"""
+
+import asyncio
+import gc
+import multiprocessing
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from plugins.player_manager import Player
+from storage import ENGINES
+from utilities import memory_usage
+
+
+def make_players(count):
+    return {"uuid%d" % x: Player("uuid%d" % x, name="Player %d" % x,
+                                 alias="Player%d" % x,
+                                 ip="10.%d.%d.%d" % (x >> 16, x >> 8 & 255,
+                                                     x & 255))
+            for x in range(count)}
+
+
+def timed(f, *args):
+    start = time.perf_counter()
+    result = f(*args)
+    return time.perf_counter() - start, result
+
+
+def scan(players, ip):
+    for player in players.values():
+        if player.ip == ip:
+            return player
+
+
+def run(engine, count, tmp):
+    cls = ENGINES[engine]
+    filename = str(Path(tmp) / engine)
+    shelf = cls(filename)
+    shelf["players"] = make_players(count)
+    shelf["plugins"] = {}
+    first_save, _ = timed(shelf.sync)
+    shelf.close()
+
+    startup, shelf = timed(cls, filename)
+    players = shelf["players"]
+    ips = ["10.%d.%d.%d" % (x >> 16, x >> 8 & 255, x & 255)
+           for x in range(0, count, max(1, count // 100))]
+    scan_time, _ = timed(lambda: [scan(players, x) for x in ips])
+    if hasattr(shelf, "find"):
+        find_time, _ = timed(lambda: [shelf.find("players", "ip", x)
+                                      for x in ips])
+    else:
+        find_time = None
+    for x in range(0, count, max(1, count // 100)):
+        players["uuid%d" % x].alias = "Renamed%d" % x
+    asyncio.run(shelf.save())
+    stall, save = shelf.last_stall, shelf.last_sync_time
+    shelf.close()
+
+    print("{}: first save {:.2f} s, startup {:.2f} s, save of {} changes "
+          "{:.1f} ms ({:.1f} ms on the loop)".format(
+              engine, first_save, startup, len(ips), save * 1000,
+              stall * 1000))
+    print("{}: lookup by IP {:.1f} us (scan){}".format(
+        engine, scan_time / len(ips) * 1e6,
+        "" if find_time is None else
+        ", {:.1f} us (index)".format(find_time / len(ips) * 1e6)))
+
+
+def open_database(engine, filename, lazy):
+    # Run in a fresh process, so the memory it uses is this database's.
+    before = memory_usage()
+    startup, shelf = timed(ENGINES[engine], filename, "c", None, "utf-8",
+                           None, lazy)
+    players = shelf["players"]
+    # Everyone online at once on a busy server.
+    for uuid in list(players)[:100]:
+        players[uuid]
+    gc.collect()
+    used = memory_usage() - before
+    shelf.dict = None
+    return startup, used
+
+
+def compare_lazy(engine, count, tmp):
+    filename = str(Path(tmp) / engine)
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(1, maxtasksperchild=1) as pool:
+        eager = pool.apply(open_database, (engine, filename, None))
+    with context.Pool(1, maxtasksperchild=1) as pool:
+        lazy = pool.apply(open_database, (engine, filename,
+                                          {"players": 1024}))
+    for name, (startup, used) in (("eager", eager), ("lazy", lazy)):
+        print("{}: {} startup {:.2f} s, {:.0f} MB RSS".format(
+            engine, name, startup, used / 2 ** 20))
+
+
+def main(count=100000):
+    with tempfile.TemporaryDirectory() as tmp:
+        for engine in ENGINES:
+            run(engine, count, tmp)
+            compare_lazy(engine, count, tmp)
+
+
+if __name__ == "__main__":
+    main(*[int(x) for x in sys.argv[1:]])
@@ -0,0 +1,241 @@
+"""
+Typed events for things that happen to players, as opposed to packets.
+
+player_manager emits these once its own state is consistent (the player is
+attached to the connection, their location is resolved, and so on), so
+subscribers don't have to hook the underlying packets and wait for
+player_manager to catch up.
+
+Plugins subscribe by decorating a method:
+
+    @subscribe(PlayerJoined)
+    async def greet(self, event):
+        send_message(event.connection, "Hi, {}!".format(event.player.alias))
+
+Every subscriber has its own queue and worker, so a slow subscriber only
+delays its own events.
+"""
+
+import asyncio
+import inspect
+import time
+
+from utilities import background
+
+
+class Event:
+    """
+    Base class of all events.
+    """
+    def __repr__(self):
+        return "<{} {}>".format(type(self).__name__, ", ".join(
+            "{}={!r}".format(k, v) for k, v in vars(self).items()))
+
+
+class PlayerEvent(Event):
+    """
+    Base class of events about one player. `connection` is None once the
+    player's connection has gone.
+    """
+    def __init__(self, player, connection=None):
+        self.player = player
+        self.connection = connection
+
+
+class PlayerJoined(PlayerEvent):
+    """
+    A player has finished connecting, and is logged in and online.
+    """
+
+
+class PlayerLeft(PlayerEvent):
+    """
+    A player has gone offline: cleanly, kicked, or because their connection
+    was reaped.
+    """
+
+
+class WorldChanged(PlayerEvent):
+    """
+    A player has arrived on a world. `location` is their resolved location
+    (a Planet, Ship, or None for worlds player_manager doesn't track), and
+    `first` is True for the first world after they joined.
+    """
+    def __init__(self, player, connection=None, location=None, first=False):
+        super().__init__(player, connection)
+        self.location = location
+        self.first = first
+
+
+class PlayerRenamed(PlayerEvent):
+    """
+    A player's alias has changed, on login or through a command.
+    """
+    def __init__(self, player, connection=None, old_alias=None):
+        super().__init__(player, connection)
+        self.old_alias = old_alias
+
+
+class subscribe:
+    """
+    Decorator marking a plugin method as a subscriber to one or more event
+    types (subclasses included). The plugin manager picks these up when the
+    plugin is activated, and drops them when it is deactivated.
+    """
+    def __init__(self, *event_types):
+        self.event_types = event_types
+
+    def __call__(self, f):
+        f.event_types = getattr(f, "event_types", ()) + self.event_types
+        return f
+
+
+class Subscriber:
+    """
+    One subscribed plugin method, with the bounded queue and worker task
+    that deliver its events in order. When the queue is full, new events
+    are dropped and counted rather than making the emitter wait.
+    """
+    def __init__(self, plugin, method, maxsize, logger):
+        self.plugin = plugin
+        self.method = method
+        self.event_types = method.event_types
+        self.maxsize = maxsize
+        self.logger = logger
+        self.is_async = inspect.iscoroutinefunction(method)
+        self.delivered = 0
+        self.dropped = 0
+        self.total_time = 0.0
+        self._queue = None
+        self._task = None
+
+    def put(self, event):
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+            self._task = background(self._run(), name=repr(self))
+        if self._queue.qsize() >= self.maxsize:
+            self.dropped += 1
+            if self.dropped == 1:
+                self.logger.warning("Event queue full; dropping events for "
+                                    "%s.%s.", self.plugin.name,
+                                    self.method.__name__)
+            return False
+        self._queue.put_nowait(event)
+        return True
+
+    def close(self):
+        """
+        Lets the worker finish what is already queued, then stop. Returns
+        the worker task (if it was ever started), which may be awaited.
+        """
+        if self._queue is not None:
+            self._queue.put_nowait(None)
+        return self._task
+
+    async def _call(self, event):
+        result = self.method(event)
+        if self.is_async:
+            await result
+
+    async def _run(self):
+        while True:
+            event = await self._queue.get()
+            if event is None:
+                return
+            start = time.perf_counter()
+            try:
+                if self.plugin.isolation is not None:
+                    await self.plugin.isolation.call(self._call(event))
+                else:
+                    await self._call(event)
+            except Exception:
+                self.logger.exception("Exception in %s.%s handling %r.",
+                                      self.plugin.name,
+                                      self.method.__name__, event)
+            self.delivered += 1
+            self.total_time += time.perf_counter() - start
+
+    def __repr__(self):
+        return "<subscriber {}.{}>".format(self.plugin.name,
+                                           self.method.__name__)
+
+
+class EventBus:
+    """
+    Delivers events to the subscribers of activated plugins. `emit` never
+    blocks: it only queues the event for each interested subscriber.
+    """
+    def __init__(self, logger, maxsize=256):
+        self.logger = logger
+        self.maxsize = maxsize
+        self.emitted = 0
+        self._subscribers = {}
+        self._routes = {}
+        self._closing = set()
+
+    def rebuild(self, plugins):
+        """
+        Re-collects the subscribers of `plugins`, keeping the queue of every
+        subscriber that is still there. Subscribers that went away still get
+        the events already queued for them (see `drain`).
+
+        :param plugins: Activated plugins, in dependency order.
+        :return: Null.
+        """
+        old = self._subscribers
+        subscribers = {}
+        for plugin in plugins:
+            for name in dir(type(plugin)):
+                if not hasattr(getattr(type(plugin), name, None),
+                               "event_types"):
+                    continue
+                key = (plugin, name)
+                if key in old:
+                    subscribers[key] = old.pop(key)
+                else:
+                    subscribers[key] = Subscriber(plugin,
+                                                  getattr(plugin, name),
+                                                  self.maxsize, self.logger)
+        self._subscribers = subscribers
+        self._routes = {}
+        for subscriber in old.values():
+            task = subscriber.close()
+            if task is not None and not task.done():
+                self._closing.add(task)
+                task.add_done_callback(self._closing.discard)
+
+    async def drain(self, timeout=None):
+        """
+        Waits for removed subscribers to finish their queued events.
+
+        :param timeout: Seconds to wait at most, or None to wait for all.
+        :return: Null.
+        """
+        if self._closing:
+            await asyncio.wait(set(self._closing), timeout=timeout)
+
+    def subscribers(self, event_type):
+        """
+        The subscribers for an event type, cached per type.
+        """
+        try:
+            return self._routes[event_type]
+        except KeyError:
+            found = [x for x in self._subscribers.values()
+                     if issubclass(event_type, x.event_types)]
+            self._routes[event_type] = found
+            return found
+
+    def emit(self, event):
+        """
+        Queues an event for every subscriber to its type.
+
+        :param event: Event instance.
+        :return: Number of subscribers it was queued for.
+        """
+        self.emitted += 1
+        queued = 0
+        for subscriber in self.subscribers(type(event)):
+            if subscriber.put(event):
+                queued += 1
+        return queued
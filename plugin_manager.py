@@ -1,14 +1,335 @@
 import asyncio
+import functools
 import importlib.machinery
 import inspect
 import logging
 import pathlib
+import sys
+import threading
+import time
+import types
 from types import ModuleType
 
 from base_plugin import BasePlugin
 from configuration_manager import ConfigurationManager
+from events import EventBus
 from pparser import PacketParser
-from utilities import detect_overrides
+from utilities import detect_overrides, HookKind, background, Direction, \
+    tasks
+
+
+@types.coroutine
+def _resume(coro, yielded):
+    """
+    Finishes a coroutine that has already been stepped once and yielded
+    `yielded`, passing everything between it and the awaiting task.
+    """
+    while True:
+        try:
+            sent = yield yielded
+        except GeneratorExit:
+            coro.close()
+            raise
+        except BaseException as exc:
+            try:
+                yielded = coro.throw(exc)
+            except StopIteration as stop:
+                return stop.value
+        else:
+            try:
+                yielded = coro.send(sent)
+            except StopIteration as stop:
+                return stop.value
+
+
+class HookStats:
+    """
+    Running counters for one plugin's hook on one packet type. Times are
+    wall-clock seconds, so they include any time a coroutine hook spends
+    awaiting.
+    """
+    def __init__(self, plugin, action):
+        self.plugin = plugin
+        self.action = action
+        self.calls = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.vetoes = 0
+        self.slow = 0
+        self.timeouts = 0
+        self.unmatched = 0
+        self.by_direction = {x: 0 for x in Direction}
+
+    def record(self, elapsed, vetoed, direction):
+        self.calls += 1
+        self.by_direction[direction] += 1
+        self.total_time += elapsed
+        if elapsed > self.max_time:
+            self.max_time = elapsed
+        if vetoed:
+            self.vetoes += 1
+
+    @property
+    def mean_time(self):
+        if not self.calls:
+            return 0.0
+        return self.total_time / self.calls
+
+
+class HookEntry:
+    """
+    A single plugin's hook for one packet type, as held in the dispatch
+    tables. Dispatch settings declared through `utilities.Hook` are read
+    once here, so `do` doesn't have to look them up per packet.
+    """
+    def __init__(self, plugin, method, stats, timeout=0,
+                 timeout_policy="cancel", isolation=None):
+        self.plugin = plugin
+        self.method = method
+        self.stats = stats
+        self.kind = getattr(method, "hook_kind", HookKind.FILTER)
+        self.priority = getattr(method, "hook_priority", 0)
+        self.always = getattr(method, "hook_always", False)
+        self.direction = getattr(method, "hook_direction", None)
+        self.when = getattr(method, "hook_when", None)
+        self.is_async = inspect.iscoroutinefunction(method)
+        if isolation is not None:
+            # Observers of an isolated plugin are handed off without waiting,
+            # so a slow bridge never holds up the connection's observer queue.
+            self.method = isolation.wrap_hook(
+                method, wait=self.kind != HookKind.OBSERVER)
+            self.is_async = True
+        self.timeout = getattr(method, "hook_timeout", None)
+        if self.timeout is None:
+            # Failing open would skip what these hooks are there for.
+            self.timeout = 0 if self.always else timeout
+        self.timeout_policy = getattr(method, "hook_timeout_policy", None)
+        if self.timeout_policy is None:
+            self.timeout_policy = timeout_policy
+
+    async def call(self, packet, connection):
+        result = self.method(packet, connection)
+        if self.is_async:
+            result = await result
+        return result
+
+    def __repr__(self):
+        flags = " always" if self.always else ""
+        if self.direction is not None:
+            flags += " " + self.direction.name.lower()
+        if self.when is not None:
+            flags += " when={!r}".format(self.when)
+        return "<{} {}.{} priority={}{}>".format(self.kind.name.lower(),
+                                                 self.plugin.name,
+                                                 self.method.__name__,
+                                                 self.priority, flags)
+
+
+class ObserverQueue:
+    """
+    Bounded queue of observer hook calls for a single connection. A worker
+    task runs the queued calls in order, off the packet forwarding path. When
+    the queue is full, new calls are dropped and counted instead of making
+    the connection wait.
+
+    Each call runs as a task of its plugin, so it is cancelled with the
+    plugin's other tasks when the plugin is deactivated or reloaded. Calls
+    are timed and held to the manager's slow hook threshold, like filters.
+    """
+    def __init__(self, manager, connection, maxsize):
+        self.manager = manager
+        self.connection = connection
+        self.maxsize = maxsize
+        self.dropped = 0
+        self.logger = manager.logger
+        self._queue = asyncio.Queue()
+        # Not scoped to the connection: calls queued when it dies still run.
+        self._task = tasks.spawn(self._run(), name="observers",
+                                 limited=False)
+
+    def put(self, hook, packet):
+        """
+        Queues an observer call. Returns False if it had to be dropped.
+        """
+        if self._queue.qsize() >= self.maxsize:
+            self.dropped += 1
+            if self.dropped == 1:
+                self.logger.warning("Observer queue full; dropping observer "
+                                    "calls for %s.", hook.plugin.name)
+            return False
+        self._queue.put_nowait((hook, packet))
+        return True
+
+    def close(self):
+        """
+        Lets the worker finish what is already queued, then stop. Returns
+        the worker task, which may be awaited.
+        """
+        self._queue.put_nowait(None)
+        return self._task
+
+    def discard(self, plugin):
+        """
+        Drops the queued calls to a plugin's observers. Returns how many
+        were dropped.
+        """
+        items = []
+        while not self._queue.empty():
+            items.append(self._queue.get_nowait())
+        kept = [x for x in items if x is None or x[0].plugin is not plugin]
+        for item in kept:
+            self._queue.put_nowait(item)
+        return len(items) - len(kept)
+
+    async def _run(self):
+        while True:
+            item = await self._queue.get()
+            if item is None:
+                return
+            hook, packet = item
+            start = time.perf_counter()
+            # The task supervisor logs the exception, if there is one.
+            task = tasks.spawn(hook.call(packet, self.connection),
+                               name=repr(hook), plugin=hook.plugin.name,
+                               limited=False)
+            await asyncio.wait((task,))
+            elapsed = time.perf_counter() - start
+            hook.stats.record(elapsed, False, packet["direction"])
+            if elapsed > self.manager.slow_hook_threshold:
+                self.manager._slow_hook(hook, elapsed)
+
+
+class LoopLagMonitor:
+    """
+    Measures how late an event loop wakes up from a sleep of `interval`
+    seconds. The overshoot is how long a ready callback on that loop had
+    to wait for its turn, so it's a direct measure of how busy the loop is.
+    """
+    def __init__(self, name, interval=0.5):
+        self.name = name
+        self.interval = interval
+        self.lag = 0.0
+        self.max_lag = 0.0
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.lag = max(0.0, loop.time() - expected)
+            self.max_lag = max(self.max_lag, self.lag)
+
+
+class IsolatedLoop:
+    """
+    An event loop on its own thread, shared by the plugins that name it in
+    `BasePlugin.isolate`. Their hooks, activation and network I/O run here,
+    so a stalled chat bridge can't delay packet forwarding on the main loop.
+
+    `call` and `call_main` move a coroutine to this loop or back to the
+    main loop, and are what `utilities.on_plugin_loop` and
+    `utilities.on_main_loop` are built on.
+    """
+    def __init__(self, name, main_loop, logger):
+        self.name = name
+        self.main_loop = main_loop
+        self.logger = logger
+        self.loop = asyncio.new_event_loop()
+        self.monitor = LoopLagMonitor(name)
+        self._thread = threading.Thread(target=self._run,
+                                        name="plugins-{}".format(name),
+                                        daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.create_task(self.monitor.run())
+        try:
+            self.loop.run_forever()
+        finally:
+            pending = asyncio.all_tasks(self.loop)
+            for task in pending:
+                task.cancel()
+            self.loop.run_until_complete(
+                asyncio.gather(*pending, return_exceptions=True))
+            self.loop.close()
+
+    def submit(self, coro):
+        """
+        Schedules a coroutine on this loop without waiting for it. Safe to
+        call from any thread; exceptions are logged.
+
+        :param coro: Coroutine to run.
+        :return: concurrent.futures.Future of the result.
+        """
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        future.add_done_callback(self._log_failure)
+        return future
+
+    async def call(self, coro):
+        """
+        Runs a coroutine on this loop and waits for its result.
+
+        :param coro: Coroutine to run.
+        :return: The coroutine's result.
+        """
+        if asyncio.get_running_loop() is self.loop:
+            return await coro
+        return await asyncio.wrap_future(
+            asyncio.run_coroutine_threadsafe(coro, self.loop))
+
+    async def call_main(self, coro):
+        """
+        Runs a coroutine on the main loop and waits for its result.
+
+        :param coro: Coroutine to run.
+        :return: The coroutine's result.
+        """
+        if asyncio.get_running_loop() is self.main_loop:
+            return await coro
+        return await asyncio.wrap_future(
+            asyncio.run_coroutine_threadsafe(coro, self.main_loop))
+
+    def wrap_hook(self, method, wait=True):
+        """
+        Wraps a packet hook so that it runs on this loop. With `wait`, the
+        caller gets the hook's result; otherwise the hook is only scheduled
+        and the wrapper returns True.
+        """
+        is_async = inspect.iscoroutinefunction(method)
+
+        async def run(packet, connection):
+            result = method(packet, connection)
+            if is_async:
+                result = await result
+            return result
+
+        if wait:
+            async def hook(packet, connection):
+                return await self.call(run(packet, connection))
+        else:
+            async def hook(packet, connection):
+                self.submit(run(packet, connection))
+                return True
+        return functools.update_wrapper(hook, method)
+
+    async def stop(self, timeout=5):
+        """
+        Stops the loop, cancels whatever is still running on it, and waits
+        for the thread to finish.
+        """
+        if self.loop.is_closed():
+            return
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        await asyncio.to_thread(self._thread.join, timeout)
+
+    def _log_failure(self, future):
+        if future.cancelled():
+            return
+        exc = future.exception()
+        if exc is not None:
+            self.logger.error("Exception on the %s plugin loop.", self.name,
+                              exc_info=exc)
 
 
 class PluginManager:
@@ -24,9 +345,43 @@ class PluginManager:
         self._resolved = False
         self._overrides = set()
         self._override_cache = set()
+        self._dispatch = {}
+        self._observers = {}
+        self._routes = {x: ({}, {}) for x in Direction}
+        self._guarded = {x: set() for x in Direction}
+        self.packets_parsed = {x: 0 for x in Direction}
+        self.packets_skipped = {x: 0 for x in Direction}
+        self._observer_queues = {}
+        self.observer_drops = 0
+        self.hook_stats = {}
+        self.slow_hook_threshold = 0.05
+        self.hook_timeout = 2.0
+        self.hook_timeout_policy = "cancel"
+        self.hook_timeouts = 0
+        self.plugin_isolation = True
+        self._isolated = {}
+        self.loop_monitor = LoopLagMonitor("main")
+        self._loop_monitor_task = None
+        if config is not None:
+            self.plugin_isolation = config.config.get("plugin_isolation",
+                                                      self.plugin_isolation)
+            self.slow_hook_threshold = config.config.get(
+                "slow_hook_threshold", self.slow_hook_threshold)
+            self.hook_timeout = config.config.get("hook_timeout",
+                                                  self.hook_timeout)
+            self.hook_timeout_policy = config.config.get(
+                "hook_timeout_policy", self.hook_timeout_policy)
+            tasks.connection_limit = config.config.get(
+                "task_limit_per_connection", tasks.connection_limit)
+            tasks.plugin_limit = config.config.get(
+                "task_limit_per_plugin", tasks.plugin_limit)
         self._packet_parser = PacketParser(self.config)
         self._factory = factory
         self.logger = logging.getLogger("starrypy.plugin_manager")
+        self.events = EventBus(logging.getLogger("starrypy.events"))
+        if config is not None:
+            self.events.maxsize = config.config.get("event_queue_size",
+                                                    self.events.maxsize)
 
     def list_plugins(self):
         return self._plugins
@@ -36,21 +391,155 @@ class PluginManager:
         Calls an action on all loaded plugins.
         """
         try:
-            if ("on_%s" % action) in self._overrides:
-                packet = await self._packet_parser.parse(packet)
-                send_flag = True
-                for plugin in self._plugins.values():
-                    p = getattr(plugin, "on_%s" % action)
-                    if not (await p(packet, connection)):
-                        send_flag = False
-                return send_flag
-            else:
+            direction = packet["direction"]
+            filters, observers = self._routes[direction]
+            hooks = filters.get(action)
+            observers = observers.get(action)
+            if action in self._guarded[direction]:
+                hooks = self._matching(hooks, packet, connection)
+                observers = self._matching(observers, packet, connection)
+            if not hooks and not observers:
+                self.packets_skipped[direction] += 1
                 return True
+            self.packets_parsed[direction] += 1
+            packet = await self._packet_parser.parse(packet)
+            send_flag = True
+            if hooks:
+                for hook in hooks:
+                    if send_flag or hook.always:
+                        start = time.perf_counter()
+                        # Plain functions are called directly; only
+                        # coroutine hooks pay for a coroutine per packet.
+                        if hook.is_async:
+                            if hook.timeout:
+                                result = await self._call_with_deadline(
+                                    hook, packet, connection)
+                            else:
+                                result = await hook.method(packet,
+                                                           connection)
+                        else:
+                            result = hook.method(packet, connection)
+                        elapsed = time.perf_counter() - start
+                        hook.stats.record(elapsed, not result, direction)
+                        if elapsed > self.slow_hook_threshold:
+                            self._slow_hook(hook, elapsed)
+                        if not result:
+                            send_flag = False
+                            packet["vetoed"] = True
+            if observers:
+                queue = self._get_observer_queue(connection)
+                for hook in observers:
+                    if not queue.put(hook, packet):
+                        self.observer_drops += 1
+            return send_flag
         except Exception:
             self.logger.exception("Exception encountered in plugin on action: "
                                   "%s", action, exc_info=True)
             return True
 
+    @staticmethod
+    def _matching(hooks, packet, connection):
+        """
+        Narrows a hook chain to the hooks whose `when` predicate (if any)
+        accepts the packet's envelope. Runs before the packet is parsed.
+        """
+        if not hooks:
+            return hooks
+        matching = []
+        for hook in hooks:
+            if hook.when is None or hook.when(packet, connection):
+                matching.append(hook)
+            else:
+                hook.stats.unmatched += 1
+        return matching
+
+    async def _call_with_deadline(self, hook, packet, connection):
+        """
+        Awaits a coroutine hook for at most `hook.timeout` seconds. A hook
+        that overruns is cancelled, or detached and left to finish in the
+        background, according to its policy. Either way it fails open: the
+        packet is let through as if the hook had returned True.
+
+        Most hooks finish without ever suspending, so the coroutine is
+        stepped once by hand first, and a deadline (which costs a timer)
+        is only set up for the hooks that actually wait on something.
+        """
+        coro = hook.method(packet, connection)
+        try:
+            yielded = coro.send(None)
+        except StopIteration as stop:
+            return stop.value
+        if hook.timeout_policy == "detach":
+            # Already running, so it isn't held to (or counted against) the
+            # connection's task limit; it is still cancelled with the
+            # connection or the plugin.
+            task = tasks.spawn(_resume(coro, yielded),
+                               name="{}.{}".format(hook.plugin.name,
+                                                   hook.method.__name__),
+                               connection=connection, plugin=hook.plugin.name,
+                               limited=False)
+            done, _ = await asyncio.wait((task,), timeout=hook.timeout)
+            if done:
+                if not task.cancelled() and task.exception() is not None:
+                    # The task supervisor has logged it; fail open.
+                    return True
+                return task.result()
+            self._hook_timed_out(hook, "detached")
+            return True
+        try:
+            async with asyncio.timeout(hook.timeout):
+                return await _resume(coro, yielded)
+        except TimeoutError:
+            self._hook_timed_out(hook, "cancelled")
+            return True
+
+    def _hook_timed_out(self, hook, outcome):
+        hook.stats.timeouts += 1
+        self.hook_timeouts += 1
+        self.logger.warning("Hook %s.%s ran past its %.2fs deadline on %s "
+                            "and was %s; letting the packet through.",
+                            hook.plugin.name, hook.method.__name__,
+                            hook.timeout, hook.stats.action, outcome)
+
+    def _slow_hook(self, hook, elapsed):
+        hook.stats.slow += 1
+        self.logger.warning("Slow hook: %s took %.1f ms on %s.",
+                            hook.plugin.name, elapsed * 1000,
+                            hook.stats.action)
+
+    def top_hooks(self, count=10, key="total_time"):
+        """
+        Returns the hook counters with the highest value of `key`, which may
+        be any HookStats attribute (total_time, max_time, mean_time, calls,
+        vetoes, slow, timeouts or unmatched).
+        """
+        stats = [x for x in self.hook_stats.values()
+                 if x.calls or x.unmatched]
+        stats.sort(key=lambda x: getattr(x, key), reverse=True)
+        return stats[:count]
+
+    def _get_observer_queue(self, connection):
+        try:
+            return self._observer_queues[connection]
+        except KeyError:
+            maxsize = 256
+            if self.config is not None:
+                maxsize = self.config.config.get("observer_queue_size",
+                                                 maxsize)
+            queue = ObserverQueue(self, connection, maxsize)
+            self._observer_queues[connection] = queue
+            return queue
+
+    def release_connection(self, connection):
+        """
+        Called when a connection goes away. Observer calls already queued for
+        it still run, so that e.g. a disconnect announcement isn't lost.
+        Returns the observer worker task for the connection, if any.
+        """
+        queue = self._observer_queues.pop(connection, None)
+        if queue is not None:
+            return queue.close()
+
     def load_from_path(self, plugin_path: pathlib.Path):
         blacklist = ["__init__", "__pycache__"]
         loaded = set()
@@ -102,6 +591,7 @@ class PluginManager:
             if inspect.isclass(obj):
                 if issubclass(obj, self.base) and obj is not self.base:
                     obj.config = self.config
+                    obj.events = self.events
                     obj.logger = logging.getLogger("starrypy.plugin.%s" %
                                                    obj.name)
                     class_list.append(obj)
@@ -138,26 +628,287 @@ class PluginManager:
         self._resolved = True
 
     async def get_overrides(self):
+        """
+        Collects the packet hooks overridden by activated plugins, and builds
+        the dispatch tables used by `do`. The tables map each action to the
+        hooks of only those plugins that override it, so packets are never
+        handed to the inherited no-op hooks. Filters and observers (see
+        `utilities.Hook`) are kept apart, and filters are ordered by
+        priority, then by dependency order. Each table is also narrowed per
+        packet direction, leaving out hooks declared for the other one, and
+        the actions with `when` predicates are noted so `do` only checks
+        predicates where there are any. Event subscribers (see `events`) are
+        re-collected at the same time.
+
+        The result is cached against the identity of the activated plugin
+        set, which is replaced (never mutated) whenever a plugin is activated
+        or deactivated.
+        """
         if self._override_cache is self._activated_plugins:
             return self._overrides
         else:
             overrides = set()
-            for plugin in self._activated_plugins:
+            dispatch = {}
+            observers = {}
+            for plugin in self._plugins.values():
+                if plugin not in self._activated_plugins:
+                    continue
                 override = await detect_overrides(BasePlugin, plugin)
                 overrides.update({x for x in override})
+                for hook in sorted(override):
+                    if hook.startswith("on_"):
+                        key = (plugin.name, hook[3:])
+                        if key not in self.hook_stats:
+                            self.hook_stats[key] = HookStats(*key)
+                        entry = HookEntry(plugin, getattr(plugin, hook),
+                                          self.hook_stats[key],
+                                          self.hook_timeout,
+                                          self.hook_timeout_policy,
+                                          plugin.isolation)
+                        if entry.kind == HookKind.OBSERVER:
+                            table = observers
+                        else:
+                            table = dispatch
+                        table.setdefault(hook[3:], []).append(entry)
+            for hooks in dispatch.values():
+                hooks.sort(key=lambda x: -x.priority)
+            routes = {}
+            guarded = {}
+            for direction in Direction:
+                routes[direction] = (self._for_direction(dispatch, direction),
+                                     self._for_direction(observers,
+                                                         direction))
+                guarded[direction] = {
+                    action for table in routes[direction]
+                    for action, hooks in table.items()
+                    if any(x.when is not None for x in hooks)}
             self._overrides = overrides
+            self._dispatch = dispatch
+            self._observers = observers
+            self._routes = routes
+            self._guarded = guarded
+            self.events.rebuild([x for x in self._plugins.values()
+                                 if x in self._activated_plugins])
             self._override_cache = self._activated_plugins
+            self.logger.debug("Hook chains:\n%s", self.dump_hook_chains())
             return overrides
 
+    @staticmethod
+    def _for_direction(table, direction):
+        """
+        Narrows a dispatch table to the hooks that want packets flowing in
+        `direction`, dropping actions left without any.
+        """
+        narrowed = {}
+        for action, hooks in table.items():
+            hooks = [x for x in hooks if x.direction in (None, direction)]
+            if hooks:
+                narrowed[action] = hooks
+        return narrowed
+
+    def dump_hook_chains(self, action=None):
+        """
+        Describes the effective hook chain for each packet type (or only for
+        `action`), in the order `do` runs it.
+
+        :param action: Optional packet name, e.g. "chat_sent".
+        :return: String. One line per packet type.
+        """
+        lines = []
+        actions = sorted(set(self._dispatch) | set(self._observers))
+        if action is not None:
+            actions = [action]
+        for name in actions:
+            chain = self._dispatch.get(name, []) + self._observers.get(name,
+                                                                       [])
+            lines.append("{}: {}".format(
+                name, ", ".join(repr(x) for x in chain) or "(none)"))
+        return "\n".join(lines)
+
+    def _isolate(self, plugin):
+        """
+        Moves a plugin that asks for it (see `BasePlugin.isolate`) onto its
+        isolated loop, starting the loop if this is its first plugin.
+        """
+        if not plugin.isolate or not self.plugin_isolation:
+            return
+        if plugin.isolate not in self._isolated:
+            self._isolated[plugin.isolate] = IsolatedLoop(
+                plugin.isolate, asyncio.get_running_loop(), self.logger)
+        plugin.isolation = self._isolated[plugin.isolate]
+        plugin.loop = plugin.isolation.loop
+
+    async def _run_on_plugin_loop(self, plugin, coro):
+        if plugin.isolation is None:
+            return await coro
+        return await plugin.isolation.call(coro)
+
+    def loop_lag(self):
+        """
+        Reports the lag of the main loop and of each isolated plugin loop.
+
+        :return: List of LoopLagMonitor, main loop first.
+        """
+        return [self.loop_monitor] + [x.monitor
+                                      for x in self._isolated.values()]
+
+    async def activate_plugin(self, plugin):
+        """
+        Activates a single plugin and rebuilds the dispatch table.
+        """
+        self.logger.info(plugin.name)
+        self._isolate(plugin)
+        await self._run_on_plugin_loop(plugin, plugin.activate())
+        self._activated_plugins = self._activated_plugins | {plugin}
+        await self.get_overrides()
+
+    async def deactivate_plugin(self, plugin):
+        """
+        Deactivates a single plugin and rebuilds the dispatch table.
+        """
+        self.logger.info("Deactivating %s", plugin.name)
+        self._activated_plugins = self._activated_plugins - {plugin}
+        await self.get_overrides()
+        await self._run_on_plugin_loop(plugin, plugin.deactivate())
+        self._cancel_tasks(plugin)
+
+    def _cancel_tasks(self, plugin):
+        """
+        Cancels a plugin's tasks, running observer calls included, and drops
+        the observer calls still queued for it.
+        """
+        tasks.cancel(plugin=plugin.name)
+        for queue in self._observer_queues.values():
+            queue.discard(plugin)
+
+    def _dependents(self, names):
+        """
+        Finds the loaded plugins that depend, directly or through other
+        plugins, on any of `names`.
+
+        :param names: Set of plugin names.
+        :return: Set of plugin names, not including `names` themselves.
+        """
+        found = set()
+        changed = True
+        while changed:
+            changed = False
+            for plugin in self._plugins.values():
+                if plugin.name in found or plugin.name in names:
+                    continue
+                if set(plugin.depends) & (names | found):
+                    found.add(plugin.name)
+                    changed = True
+        return found
+
+    async def reload_plugin(self, name):
+        """
+        Reloads the module that defines plugin `name`, replacing every plugin
+        from that module with a fresh instance of its new class. Connections
+        are left alone. Plugins depending on the replaced ones are restarted
+        too, so they pick up the new instances in activate(), and the
+        dispatch tables are rebuilt once everything is back.
+
+        Nothing is deactivated until the new module has loaded and its
+        dependencies check out, so a broken edit leaves the running plugin
+        in place.
+
+        :param name: Name of a loaded plugin.
+        :return: List of the restarted plugin names, in activation order.
+        :raise: KeyError if the plugin isn't loaded, ValueError if it can't
+                be reloaded, or whatever importing the module raises.
+        """
+        old = self._plugins[name]
+        module_name = type(old).__module__
+        replaced = {x.name: x for x in self._plugins.values()
+                    if type(x).__module__ == module_name}
+        stuck = [x for x in replaced if not replaced[x].reloadable]
+        if stuck:
+            raise ValueError("{} can't be reloaded; restart the server "
+                             "instead.".format(", ".join(stuck)))
+        file_path = pathlib.Path(sys.modules[module_name].__file__)
+        if file_path.stem == "__init__":
+            file_path = file_path.parent
+        module = self._load_module(file_path)
+        classes = {x.name: x for x in self.get_classes(module)
+                   if x.__module__ == module_name}
+        for plugin_name in replaced:
+            if plugin_name not in classes:
+                raise ImportError("{} no longer defines {}.".format(
+                    file_path.name, plugin_name))
+            missing = set(classes[plugin_name].depends) - set(self._plugins)
+            if missing:
+                raise ImportError("{} depends on {}, which isn't "
+                                  "loaded.".format(plugin_name,
+                                                   ", ".join(missing)))
+
+        restart_names = set(replaced) | self._dependents(set(replaced))
+        restart = [x for x in self._plugins.values()
+                   if x.name in restart_names]
+        was_active = {x.name for x in restart
+                      if x in self._activated_plugins}
+        self.logger.info("Reloading %s (restarting %s).", file_path.name,
+                         ", ".join(x.name for x in restart))
+        self._activated_plugins = self._activated_plugins - set(restart)
+        await self.get_overrides()
+        for plugin in reversed(restart):
+            if plugin.name in was_active:
+                await self._run_on_plugin_loop(plugin, plugin.deactivate())
+            # Before the new instance starts tasks in the same scope.
+            self._cancel_tasks(plugin)
+
+        for plugin_name, plugin in replaced.items():
+            cls = classes[plugin_name]
+            cls.factory = self._factory
+            self._seen_classes.discard(type(plugin))
+            self._seen_classes.add(cls)
+            new = cls()
+            if hasattr(plugin, "storage"):
+                new.storage = plugin.storage
+            # Keeps the plugin's place in the (dependency ordered) dict.
+            self._plugins[plugin_name] = new
+            if plugin_name in self.base.plugins:
+                self.base.plugins[plugin_name] = new
+
+        restarted = []
+        for plugin in [self._plugins[x.name] for x in restart]:
+            if plugin.name not in was_active:
+                continue
+            try:
+                self._isolate(plugin)
+                await self._run_on_plugin_loop(plugin, plugin.activate())
+            except Exception:
+                self.logger.exception("Failed to reactivate %s after "
+                                      "reload.", plugin.name)
+                continue
+            self._activated_plugins = self._activated_plugins | {plugin}
+            restarted.append(plugin.name)
+        await self.get_overrides()
+        return restarted
+
     async def activate_all(self):
+        if self._loop_monitor_task is None:
+            self._loop_monitor_task = background(self.loop_monitor.run(),
+                                                 name="loop_monitor")
         self.logger.info("Activating plugins:")
         for plugin in self._plugins.values():
             self.logger.info(plugin.name)
-            await plugin.activate()
-            self._activated_plugins.add(plugin)
+            self._isolate(plugin)
+            await self._run_on_plugin_loop(plugin, plugin.activate())
+            self._activated_plugins = self._activated_plugins | {plugin}
         await self.get_overrides()
 
     async def deactivate_all(self):
+        self._activated_plugins = set()
+        await self.get_overrides()
+        await self.events.drain(timeout=5)
         for plugin in self._plugins.values():
             self.logger.info("Deactivating %s", plugin.name)
-            await plugin.deactivate()
+            await self._run_on_plugin_loop(plugin, plugin.deactivate())
+            self._cancel_tasks(plugin)
+        for isolated in self._isolated.values():
+            await isolated.stop()
+        self._isolated = {}
+        if self._loop_monitor_task is not None:
+            self._loop_monitor_task.cancel()
+            self._loop_monitor_task = None
@@ -7,6 +7,7 @@ Original authors: kharidiron
 """
 
 from base_plugin import BasePlugin
+from utilities import Hook, HookKind
 
 
 class ChatLogger(BasePlugin):
@@ -18,7 +19,8 @@ class ChatLogger(BasePlugin):
     async def activate(self):
         await super().activate()
 
-    async def on_chat_sent(self, data, connection):
+    @Hook(kind=HookKind.OBSERVER)
+    def on_chat_sent(self, data, connection):
         """
         Catch when someone sends any form of message or command and log it.
 
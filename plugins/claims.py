@@ -8,10 +8,12 @@ Author: medeor413
 """
 
 import asyncio
+
 import packets
 
 from base_plugin import StorageCommandPlugin
 from data_parser import PlayerWarp
+from events import WorldChanged, subscribe
 from pparser import build_packet
 from utilities import Command, send_message, link_plugin_if_available
 
@@ -19,6 +21,7 @@ from utilities import Command, send_message, link_plugin_if_available
 class Claims(StorageCommandPlugin):
     name = "claims"
     depends = ["player_manager", "command_dispatcher", "planet_protect"]
+    storage_check_interval = None
     default_config = {"max_claims_per_person": 6,
                       "auto_claim_ships": True}
 
@@ -50,18 +53,20 @@ class Claims(StorageCommandPlugin):
         else:
             return True
 
-    async def on_world_start(self, data, connection):
+    @subscribe(WorldChanged)
+    async def _world_changed(self, event):
         """
         Catch when a player beams onto a world.
 
-        :param data: The packet containing the world information.
-        :param connection: The connection from which the packet came.
-        :return: Boolean: True. Must be true, so that packet get passed on.
+        :param event: WorldChanged event of the player beaming in.
+        :return: Null.
         """
         if self.config.get_plugin_config(self.name)["auto_claim_ships"]:
-            self.background(self._protect_ship(connection))
-        self.background(self._access_check(connection))
-        return True
+            await self._protect_ship(event.connection)
+        # The event is emitted before world_start reaches the client; give
+        # it time to load the world before warping them back out.
+        self.background(self._access_check(event.connection, event.location),
+                        connection=event.connection)
 
     async def _protect_ship(self, connection):
         """
@@ -90,13 +95,14 @@ class Claims(StorageCommandPlugin):
                         self.storage["owners"][uuid] = [str(ship)]
                     elif str(ship) not in self.storage["owners"][uuid]:
                         self.storage["owners"][uuid].append(str(ship))
+                    self.storage.touch()
         except AttributeError:
             pass
 
-    async def _access_check(self, connection):
+    async def _access_check(self, connection, location):
         await asyncio.sleep(.5)
-        if str(connection.player.location) in self.storage["access"]:
-            access = self.storage["access"][str(connection.player.location)]
+        if str(location) in self.storage["access"]:
+            access = self.storage["access"][str(location)]
             if connection.player.perm_check("planet_protect.bypass"):
                 return
             elif connection.player.uuid in access["list"] and not \
@@ -147,6 +153,7 @@ class Claims(StorageCommandPlugin):
         elif uuid not in self.storage["owners"]:
             self.storage["owners"][uuid] = []
             self.storage["owners"][uuid].append(str(location))
+            self.storage.touch()
             self.planet_protect.add_protection(location, connection.player)
             send_message(connection, "Successfully claimed planet {}."
                          .format(location))
@@ -156,6 +163,7 @@ class Claims(StorageCommandPlugin):
                                          "number of claimed planets.")
             else:
                 self.storage["owners"][uuid].append(str(location))
+                self.storage.touch()
                 self.planet_protect.add_protection(location, connection.player)
                 send_message(connection, "Successfully claimed planet {}."
                              .format(location))
@@ -176,6 +184,7 @@ class Claims(StorageCommandPlugin):
             self.storage["owners"][uuid].remove(str(location))
             if len(self.storage["owners"][uuid]) == 0:
                 self.storage["owners"].pop(uuid)
+            self.storage.touch()
             self.planet_protect.disable_protection(location)
             send_message(connection, "Unclaimed planet {} "
                                      "successfully.".format(location))
@@ -197,6 +206,7 @@ class Claims(StorageCommandPlugin):
             else:
                 protection = self.planet_protect.get_protection(location)
                 protection.add_builder(target)
+                self.planet_protect.storage.touch()
                 try:
                     send_message(connection, "Granted build access to player"
                                              " {}.".format(target.alias))
@@ -232,6 +242,7 @@ class Claims(StorageCommandPlugin):
             else:
                 protection = self.planet_protect.get_protection(location)
                 protection.del_builder(target)
+                self.planet_protect.storage.touch()
                 send_message(connection, "Player {} was removed from the "
                                          "build list for location {}."
                              .format(target.alias, location))
@@ -315,6 +326,7 @@ class Claims(StorageCommandPlugin):
 
                 if len(self.storage["owners"][uuid]) == 0:
                     self.storage["owners"].pop(uuid)
+                self.storage.touch()
                 self.planet_protect.add_protection(location, target)
                 send_message(connection, "Transferred ownership of {} to {}."
                              .format(location, target.alias))
@@ -357,10 +369,12 @@ class Claims(StorageCommandPlugin):
                     if location in self.planet_announcer.storage["greetings"]:
                         self.planet_announcer.storage["greetings"].pop(
                             location)
+                        self.planet_announcer.storage.touch()
                         send_message(connection, "Greeting message "
                                                             "cleared.")
                 else:
                     self.planet_announcer.storage["greetings"][location] = msg
+                    self.planet_announcer.storage.touch()
                     send_message(connection, "Greeting message "
                                                         "set to \"{}\"."
                                             .format(msg))
@@ -397,11 +411,13 @@ class Claims(StorageCommandPlugin):
                 if data[1].lower() == "true":
                     access["whitelist"] = True
                     access["list"] = [uuid]
+                    self.storage.touch()
                     send_message(connection, "Switched to whitelist mode "
                                              "and access list cleared.")
                 elif data[1].lower() == "false":
                     access["whitelist"] = False
                     access["list"] = []
+                    self.storage.touch()
                     send_message(connection, "Switched to blacklist mode "
                                              "and access list cleared.")
                 else:
@@ -439,6 +455,7 @@ class Claims(StorageCommandPlugin):
                                                  "the blacklist!")
                     else:
                         access["list"].append(target.uuid)
+                        self.storage.touch()
                         send_message(connection, "{} is now {} access to "
                                                  "this planet"
                                      .format(target.alias, allow))
@@ -454,6 +471,7 @@ class Claims(StorageCommandPlugin):
                                                  "the whitelist!")
                     else:
                         access["list"].remove(target.uuid)
+                        self.storage.touch()
                         send_message(connection, "{} has been removed from "
                                                  "the {} list for this planet."
                                      .format(target.alias, allow))
@@ -473,6 +491,7 @@ class Claims(StorageCommandPlugin):
         target = self.plugins.player_manager.find_player(" ".join(data))
         if target.uuid in self.storage['owners']:
             self.storage['owners'][target.uuid] = []
+            self.storage.touch()
             send_message(connection, "Purged claims of {}"
                                     .format(target.alias))
         else:
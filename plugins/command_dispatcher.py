@@ -17,7 +17,7 @@ import asyncio
 import packets
 
 from base_plugin import BasePlugin
-from utilities import extractor, get_syntax, send_message
+from utilities import background, extractor, get_syntax, send_message
 from data_parser import ChatSent
 from pparser import build_packet
 
@@ -68,9 +68,11 @@ class CommandDispatcher(BasePlugin):
             if command not in self.commands:
                 return True  # There's no command here that we know of.
             else:
-                self.background(self.run_command(command,
-                                                       connection,
-                                                       to_parse[1:]))
+                # Scoped to the connection only: in the plugin's scope,
+                # long-running commands would hold up everyone's.
+                background(self.run_command(command, connection,
+                                            to_parse[1:]),
+                           name="command:" + command, connection=connection)
                 return False  # We're handling the command in the event loop.
         else:
             # Not a command, just text, so pass it along.
@@ -109,6 +111,18 @@ class CommandDispatcher(BasePlugin):
         else:
             self.commands[name] = fn
 
+    def unregister(self, plugin):
+        """
+        Removes every command (and alias) registered by a plugin, e.g. when
+        it is deactivated or reloaded.
+
+        :param plugin: The plugin instance whose commands should be removed.
+        :return: Null.
+        """
+        for name, fn in list(self.commands.items()):
+            if getattr(fn, "__self__", None) is plugin:
+                del self.commands[name]
+
     def _send_syntax_error(self, command, error, connection):
         """
         Sends a syntax error to the user regarding a command.
@@ -14,7 +14,9 @@ import asyncio
 import discord
 
 from base_plugin import BasePlugin
-from utilities import ChatSendMode, ChatReceiveMode, link_plugin_if_available
+from events import PlayerJoined, PlayerLeft, subscribe
+from utilities import ChatSendMode, ChatReceiveMode, link_plugin_if_available, \
+    Hook, HookKind, on_plugin_loop, on_main_loop
 
 
 # Mock Objects
@@ -93,6 +95,7 @@ class DiscordClient(discord.Client):
 class DiscordPlugin(BasePlugin):
     name = "discord_bot"
     depends = ['command_dispatcher']
+    isolate = "chat_bridge"
     default_config = {
         "enabled": True,
         "token": "-- token --",
@@ -177,34 +180,27 @@ class DiscordPlugin(BasePlugin):
             await self.discord_client.close()
         await super().deactivate()
 
-    # Packet hooks - look for these packets and act on them
+    # Player events - sent by player_manager
 
-    async def on_connect_success(self, data, connection):
+    @subscribe(PlayerJoined, PlayerLeft)
+    def announce_player(self, event):
         """
-        Hook on bot successfully connecting to server.
+        Player event on a player joining or leaving the server.
 
-        :param data:
-        :param connection:
-        :return: Boolean: True. Must be true, so packet moves on.
+        :param event: PlayerJoined or PlayerLeft.
+        :return: Null.
         """
         if not self.enabled:
-            return True;
-        self.background(self.make_announce(connection, "joined")).add_done_callback(self.error_handler)
-        return True
-
-    async def on_client_disconnect_request(self, data, connection):
-        """
-        Hook on bot disconnecting from the server.
+            return
+        if isinstance(event, PlayerJoined):
+            circumstance = "joined"
+        else:
+            circumstance = "left"
+        self.background(self.make_announce(event.player, circumstance)).add_done_callback(self.error_handler)
 
-        :param data:
-        :param connection:
-        :return: Boolean: True. Must be true, so packet moves on.
-        """
-        if not self.enabled:
-            return True;
-        self.background(self.make_announce(connection, "left")).add_done_callback(self.error_handler)
-        return True
+    # Packet hooks - look for these packets and act on them
 
+    @Hook(kind=HookKind.OBSERVER)
     async def on_chat_sent(self, data, connection):
         """
         Hook on message being broadcast on server. Display it in Discord.
@@ -253,6 +249,7 @@ class DiscordPlugin(BasePlugin):
             self.logger.exception("Caught exception in Discord run; shutting down: {}", e)
             raise e
 
+    @on_main_loop
     async def send_to_game(self, message):
         """
         Broadcast a message on the server. Make sure it isn't coming from the
@@ -283,18 +280,16 @@ class DiscordPlugin(BasePlugin):
                     self.background(self.irc.bot_write(
                                           "[DC] <{}> {}".format(nick, text)))
 
-    async def make_announce(self, connection, circumstance):
+    async def make_announce(self, player, circumstance):
         """
         Send a message to Discord when someone joins/leaves the server.
 
-        :param connection: Connection of connecting player on server.
+        :param player: Player joining or leaving the server.
         :param circumstance:
         :return: Null.
         """
-        await asyncio.sleep(1)
-        if hasattr(connection, "player"):
-            await self.bot_write("**{}** has {} the server.".format(
-                connection.player.alias, circumstance))
+        await self.bot_write("**{}** has {} the server.".format(
+            player.alias, circumstance))
 
     async def handle_command(self, data, user):
         split = data.split()
@@ -325,6 +320,7 @@ class DiscordPlugin(BasePlugin):
             await self.bot_write("Command not found.",
                                       target=self.command_target)
 
+    @on_plugin_loop
     async def bot_write(self, msg, target=None):
         if self.discord_client == None or not self.discord_client.is_ready():
             await self.start_bot()
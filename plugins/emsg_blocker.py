@@ -7,7 +7,7 @@ Original authors: medeor413
 """
 
 from base_plugin import BasePlugin
-from utilities import Direction
+from utilities import Direction, Hook, State, When
 
 
 class ChatLogger(BasePlugin):
@@ -33,16 +33,22 @@ class ChatLogger(BasePlugin):
             "invinciblePlayers"
         ]
 
-    async def on_world_stop(self, data, connection):
+    @Hook(always=True)
+    def on_world_stop(self, data, connection):
         self.in_transit_players.add(connection)
         return True
 
-    async def on_world_start(self, data, connection):
+    @Hook(always=True)
+    def on_world_start(self, data, connection):
         if connection in self.in_transit_players:
             self.in_transit_players.remove(connection)
         return True
 
-    async def on_entity_message(self, data, connection):
+    # The server probably isn't sending malicious messages, and until the
+    # handshake is done there is no player to check permissions against.
+    @Hook(direction=Direction.TO_SERVER,
+          when=When(min_state=State.CONNECTED))
+    def on_entity_message(self, data, connection):
         """
         Catch when an entity message is sent and block it, depending on its
         contents.
@@ -52,26 +58,22 @@ class ChatLogger(BasePlugin):
         :return: Boolean; True if the message is allowed, false if it's
         blocked.
         """
-        if data['direction'] == Direction.TO_CLIENT:
-            # The server probably isn't sending malicious messages
-            return True
-        else:
-            if data['parsed']['message_name'] in self.blocked_messages:
-                if not connection.player.perm_check("emsg_blocker.bypass"):
-                    self.logger.debug("Blocked message {} from player {}."
-                                      .format(data['parsed']['message_name'],
-                                              connection.player.alias))
-                    return False
-            return True
+        if data['parsed']['message_name'] in self.blocked_messages:
+            if not connection.player.perm_check("emsg_blocker.bypass"):
+                self.logger.debug("Blocked message {} from player {}."
+                                  .format(data['parsed']['message_name'],
+                                          connection.player.alias))
+                return False
+        return True
 
-    async def on_entity_message_response(self, data, connection):
-        if connection in self.in_transit_players and data['direction'] == \
-                Direction.TO_CLIENT:
-            return False
-        else:
-            return True
+    @Hook(direction=Direction.TO_CLIENT)
+    def on_entity_message_response(self, data, connection):
+        return connection not in self.in_transit_players
 
-    async def on_update_world_properties(self, data, connection):
+    # The server is just informing the clients of changes.
+    @Hook(direction=Direction.TO_SERVER,
+          when=When(min_state=State.CONNECTED))
+    def on_update_world_properties(self, data, connection):
         """
         Catch when world properties are modified and block it, depending on
         its contents.
@@ -79,15 +81,11 @@ class ChatLogger(BasePlugin):
         :param connection:
         :return: Boolean: True if the change is allowed, false otherwise
         """
-        if data['direction'] == Direction.TO_CLIENT:
-            # The server is just informing the clients of changes.
-            return True
-        else:
-            for key in data['parsed'].keys():
-                if key in self.blocked_world_properties:
-                    if not connection.player.perm_check("emsg_blocker.bypass"):
-                        self.logger.debug("Blocked change of world property "
-                                          "{} from player {}.".format(
-                            key, connection.player.alias))
-                        return False
-            return True
\ No newline at end of file
+        for key in data['parsed'].keys():
+            if key in self.blocked_world_properties:
+                if not connection.player.perm_check("emsg_blocker.bypass"):
+                    self.logger.debug("Blocked change of world property "
+                                      "{} from player {}.".format(
+                        key, connection.player.alias))
+                    return False
+        return True
\ No newline at end of file
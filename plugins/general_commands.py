@@ -16,7 +16,9 @@ import packets
 import pparser
 import data_parser
 from base_plugin import SimpleCommandPlugin
-from utilities import send_message, Command, broadcast, link_plugin_if_available, State
+from events import PlayerRenamed
+from utilities import send_message, Command, broadcast, link_plugin_if_available, State, \
+    Direction, tasks
 
 
 ###
@@ -116,8 +118,7 @@ class GeneralCommands(SimpleCommandPlugin):
         :return: Null.
         """
         ret_list = []
-        for player in self.plugins['player_manager'].players_online:
-            target = self.plugins['player_manager'].get_player_by_uuid(player)
+        for target in self.plugins['player_manager'].players_online.players():
             if connection.player.perm_check("general_commands.who_clientids"):
                 ret_list.append(
                     "[^red;{}^reset;] {}{}^reset;".format(target.client_id,
@@ -146,7 +147,7 @@ class GeneralCommands(SimpleCommandPlugin):
         if len(data) == 0:
             raise SyntaxWarning("No target provided.")
         name = " ".join(data)
-        info = self.plugins['player_manager'].find_player(name)
+        info = await self.plugins['player_manager'].find_any_player(name)
         if info is not None:
             send_message(connection, self.generate_whois(info))
         else:
@@ -242,6 +243,8 @@ class GeneralCommands(SimpleCommandPlugin):
                 return
             old_alias = target.alias
             target.alias = clean_alias
+            self.events.emit(PlayerRenamed(target, target.connection,
+                                           old_alias))
             broadcast(connection, "{}'s name has been changed to {}".format(
                 old_alias, clean_alias))
 
@@ -272,8 +275,7 @@ class GeneralCommands(SimpleCommandPlugin):
         """
         ret_list = []
         location = str(connection.player.location)
-        for uid in self.plugins.player_manager.players_online:
-            p = self.plugins.player_manager.get_player_by_uuid(uid)
+        for p in self.plugins.player_manager.players_online.players():
             if str(p.location) == location:
                 if connection.player.perm_check(
                         "general_commands.who_clientids"):
@@ -344,3 +346,94 @@ class GeneralCommands(SimpleCommandPlugin):
             self.maintenance = True
             broadcast(self, "^red;NOTICE: The server is now in maintenance "
                             "mode. ^reset;No additional clients can connect.")
+
+    @Command("plugin_stats",
+             perm="general_commands.plugin_stats",
+             doc="Shows the plugin hooks that have cost the most time.",
+             syntax=("[count]",
+                     "[total|max|mean|calls|vetoes|slow|timeouts|"
+                     "unmatched]"))
+    async def _plugin_stats(self, data, connection):
+        """
+        Lists the plugin hooks with the highest cumulative (or max, mean,
+        call, veto, slow-call, timeout or unmatched) count since the server
+        started.
+
+        :param data: The packet containing the command.
+        :param connection: The connection from which the packet came.
+        :return: Null.
+        """
+        count = 10
+        key = "total_time"
+        keys = {"total": "total_time", "max": "max_time",
+                "mean": "mean_time", "calls": "calls", "vetoes": "vetoes",
+                "slow": "slow", "timeouts": "timeouts",
+                "unmatched": "unmatched"}
+        for arg in data:
+            if arg.isdigit():
+                count = int(arg)
+            elif arg.lower() in keys:
+                key = keys[arg.lower()]
+            else:
+                raise SyntaxWarning("Unknown sort key {}.".format(arg))
+        manager = self.factory.plugin_manager
+        lines = ["Loop lag: {}".format(", ".join(
+            "{} {:.1f} ms (max {:.1f} ms)".format(x.name, x.lag * 1000,
+                                                 x.max_lag * 1000)
+            for x in manager.loop_lag()))]
+        lines.append("Packets parsed/skipped: {}".format(", ".join(
+            "{} {}/{}".format(x.name.lower().replace("_", " "),
+                              manager.packets_parsed[x],
+                              manager.packets_skipped[x])
+            for x in Direction)))
+        lines.append("Background tasks: {} running (peak {}), {} waiting, "
+                     "{} failed, {} started.".format(
+                         tasks.count, tasks.peak, tasks.waiting,
+                         tasks.failed, tasks.spawned))
+        stats = manager.top_hooks(count, key)
+        if not stats:
+            lines.append("No hook calls recorded yet.")
+            send_message(connection, "\n".join(lines))
+            return
+        lines.append("Top plugin hooks by {}:".format(key.replace("_", " ")))
+        for s in stats:
+            lines.append("{}.{}: {} calls ({} to server, {} to client), "
+                         "{:.1f} ms total, {:.2f} ms max, {} vetoes, "
+                         "{} slow, {} timeouts, {} unmatched".format(
+                             s.plugin, s.action, s.calls,
+                             s.by_direction[Direction.TO_SERVER],
+                             s.by_direction[Direction.TO_CLIENT],
+                             s.total_time * 1000, s.max_time * 1000,
+                             s.vetoes, s.slow, s.timeouts, s.unmatched))
+        send_message(connection, "\n".join(lines))
+
+    @Command("reload",
+             perm="general_commands.reload",
+             doc="Reloads a plugin's code without disconnecting anyone.",
+             syntax="(plugin)")
+    async def _reload(self, data, connection):
+        """
+        Reload the module of a plugin, restarting it and the plugins that
+        depend on it. Connected players stay connected.
+
+        :param data: The packet containing the command.
+        :param connection: The connection from which the packet came.
+        :return: Null.
+        """
+        if not data:
+            raise SyntaxWarning("No plugin name given.")
+        name = data[0]
+        self.logger.warning("{} is reloading plugin {}.".format(
+            connection.player.alias, name))
+        try:
+            restarted = await self.factory.plugin_manager.reload_plugin(name)
+        except KeyError:
+            send_message(connection,
+                         "No plugin named {} is loaded.".format(name))
+        except Exception as e:
+            self.logger.exception("Reloading plugin {} failed.".format(name))
+            send_message(connection, "Reload of {} failed: {}".format(name,
+                                                                      e))
+        else:
+            send_message(connection, "Reloaded {}; restarted {}.".format(
+                name, ", ".join(restarted) or "nothing"))
@@ -14,7 +14,9 @@ import asyncio
 import irc3
 
 from base_plugin import BasePlugin
-from utilities import ChatSendMode, ChatReceiveMode, link_plugin_if_available
+from events import PlayerJoined, PlayerLeft, subscribe
+from utilities import ChatSendMode, ChatReceiveMode, link_plugin_if_available, \
+    Hook, HookKind, on_plugin_loop, on_main_loop
 
 
 # Mock Objects
@@ -58,6 +60,7 @@ class MockConnection:
         self.owner = owner
         self.player = MockPlayer()
 
+    @on_main_loop
     async def send_message(self, *messages):
         for message in messages:
             color_strip = re.compile("\^(.*?);")
@@ -107,6 +110,7 @@ def _reverse(text):
 class IRCPlugin(BasePlugin):
     name = "irc_bot"
     depends = ['command_dispatcher']
+    isolate = "chat_bridge"
     default_config = {
         "enabled": True,
         "server": "irc.freenode.net",
@@ -157,7 +161,7 @@ class IRCPlugin(BasePlugin):
         self.username = self.config.get_plugin_config(self.name)["username"]
         self.sc = self.config.get_plugin_config(self.name)["strip_colors"]
 
-        self.bot = irc3.IrcBot(nick=self.username,
+        self.bot = irc3.IrcBot(nick=self.username, loop=self.loop,
                                autojoins=[self.channel],
                                host=self.server)
         self.bot.log = self.logger
@@ -189,32 +193,7 @@ class IRCPlugin(BasePlugin):
 
     # Packet hooks - look for these packets and act on them
 
-    async def on_connect_success(self, data, connection):
-        """
-        Hook on bot successfully connecting to server.
-
-        :param data:
-        :param connection:
-        :return: Boolean: True. Must be true, so packet moves on.
-        """
-        if not self.enabled:
-            return True
-        self.background(self.announce_join(connection))
-        return True
-
-    async def on_client_disconnect_request(self, data, connection):
-        """
-        Hook on bot disconnecting from the server.
-
-        :param data:
-        :param connection:
-        :return: Boolean: True. Must be true, so packet moves on.
-        """
-        if not self.enabled:
-            return True
-        self.background(self.announce_leave(connection.player))
-        return True
-
+    @Hook(kind=HookKind.OBSERVER)
     async def on_chat_sent(self, data, connection):
         """
         Hook on message being broadcast on server. Display it in IRC.
@@ -262,6 +241,7 @@ class IRCPlugin(BasePlugin):
             self.background(self.send_message(data, nick))
         return None
 
+    @on_main_loop
     async def announce_irc_join(self, mask, event, channel, data):
         if self.config.get_plugin_config(self.name)["announce_join_leave"]:
             nick = mask.split("!")[0]
@@ -294,6 +274,7 @@ class IRCPlugin(BasePlugin):
         self.ops = set(
             [nick[1:] for nick in nicknames.split() if nick[0] == "@"])
 
+    @on_main_loop
     async def send_message(self, data, nick):
         """
         Broadcast a message on the server.
@@ -330,29 +311,35 @@ class IRCPlugin(BasePlugin):
                                               "{}".format(nick, message),
                                               mode=ChatReceiveMode.BROADCAST)
 
-    async def announce_join(self, connection):
+    @subscribe(PlayerJoined)
+    async def announce_join(self, event):
         """
         Send a message to IRC when someone joins the server.
 
-        :param connection: Connection of connecting player on server.
+        :param event: PlayerJoined event.
         :return: Null.
         """
-        await asyncio.sleep(1)
+        if not self.enabled:
+            return
         await self.bot_write(
             "{} has joined the server.".format(_color(_bold(
-                connection.player.alias), "10")))
+                event.player.alias), "10")))
 
-    async def announce_leave(self, player):
+    @subscribe(PlayerLeft)
+    async def announce_leave(self, event):
         """
         Send a message to IRC when someone leaves the server.
 
-        :param player: Player leaving server.
+        :param event: PlayerLeft event.
         :return: Null.
         """
+        if not self.enabled:
+            return
         await self.bot_write(
             "{} has left the server.".format(_color(_bold(
-                player.alias), "10")))
+                event.player.alias), "10")))
 
+    @on_plugin_loop
     async def bot_write(self, msg, target=None):
         """
         Method for writing messages to IRC channel.
@@ -365,6 +352,7 @@ class IRCPlugin(BasePlugin):
             target = self.channel
         self.bot.privmsg(target, msg)
 
+    @on_main_loop
     async def handle_command(self, target, data, mask):
         """
         Handle commands that have been sent in via IRC.
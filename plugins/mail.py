@@ -7,10 +7,10 @@ that they have new messages.
 
 Author: medeor413
 """
-import asyncio
 import datetime
 
 from base_plugin import StorageCommandPlugin
+from events import PlayerJoined, subscribe
 from utilities import Command, send_message
 
 
@@ -25,6 +25,8 @@ class Mail:
 class MailPlugin(StorageCommandPlugin):
     name = "mail"
     depends = ["player_manager", "command_dispatcher"]
+    reloadable = False
+    storage_check_interval = None
     default_config = {"max_mail_storage": 25}
 
     def __init__(self):
@@ -35,23 +37,20 @@ class MailPlugin(StorageCommandPlugin):
     async def activate(self):
         await super().activate()
         self.max_mail = self.plugin_config.max_mail_storage
-        self.find_player = self.plugins.player_manager.find_player
+        self.find_player = self.plugins.player_manager.find_any_player
         if 'mail' not in self.storage:
             self.storage['mail'] = {}
 
-    async def on_connect_success(self, data, connection):
+    @subscribe(PlayerJoined)
+    def _display_unread(self, event):
         """
-        Catch when a player successfully connects to the server, and send them
-        a new mail message.
-        :param data:
-        :param connection:
-        :return: True. Must always be true so the packet continues.
-        """
-        self.background(self._display_unread(connection))
-        return True
+        Catch when a player successfully connects to the server, and tell
+        them about their unread mail.
 
-    async def _display_unread(self, connection):
-        await asyncio.sleep(3)
+        :param event: PlayerJoined event.
+        :return: Null.
+        """
+        connection = event.connection
         if connection.player.uuid not in self.storage['mail']:
             self.storage['mail'][connection.player.uuid] = []
         mailbox = self.storage['mail'][connection.player.uuid]
@@ -75,6 +74,7 @@ class MailPlugin(StorageCommandPlugin):
         """
         mail = Mail(message, author)
         self.storage['mail'][target.uuid].insert(0, mail)
+        self.storage.touch()
 
     @Command("sendmail",
              perm="mail.sendmail",
@@ -82,7 +82,7 @@ class MailPlugin(StorageCommandPlugin):
              syntax="(user) (message)")
     async def _sendmail(self, data, connection):
         if data:
-            target = self.find_player(data[0])
+            target = await self.find_player(data[0])
             if not target:
                 raise SyntaxWarning("Couldn't find target.")
             if not data[1]:
@@ -97,6 +97,7 @@ class MailPlugin(StorageCommandPlugin):
             else:
                 mail = Mail(" ".join(data[1:]), connection.player)
                 mailbox.insert(0, mail)
+                self.storage.touch()
                 send_message(connection, "Mail delivered to {}."
                                         .format(target.alias))
                 if target.logged_in:
@@ -120,6 +121,7 @@ class MailPlugin(StorageCommandPlugin):
                 index = int(data[0]) - 1
                 mail = mailbox[index]
                 mail.unread = False
+                self.storage.touch()
                 send_message(connection, "From {} on {}: \n{}"
                                         .format(mail.author.alias,
                                                 mail.time.strftime("%d %b "
@@ -141,7 +143,9 @@ class MailPlugin(StorageCommandPlugin):
                                                     mail.time
                                                     .strftime("%d %b %H:%M"),
                                                     mail.message))
-            if not unread_mail:
+            if unread_mail:
+                self.storage.touch()
+            else:
                 send_message(connection, "No unread mail to "
                                                     "display.")
 
@@ -209,21 +213,25 @@ class MailPlugin(StorageCommandPlugin):
         if data:
             if data[0] == "all":
                 self.storage['mail'][uid] = []
+                self.storage.touch()
                 send_message(connection, "Deleted all mail.")
             elif data[0] == "unread":
                 for mail in mailbox:
                     if mail.unread:
                         self.storage['mail'][uid].remove(mail)
+                self.storage.touch()
                 send_message(connection, "Deleted all unread mail.")
             elif data[0] == "read":
                 for mail in mailbox:
                     if not mail.unread:
                         self.storage['mail'][uid].remove(mail)
+                self.storage.touch()
                 send_message(connection, "Deleted all read mail.")
             else:
                 try:
                     index = int(data[0]) - 1
                     self.storage['mail'][uid].pop(index)
+                    self.storage.touch()
                     send_message(connection, "Deleted mail {}."
                                             .format(data[0]))
                 except ValueError:
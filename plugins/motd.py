@@ -9,6 +9,7 @@ Ported by: kharidiron
 import asyncio
 
 from base_plugin import SimpleCommandPlugin
+from events import PlayerJoined, subscribe
 from utilities import Command, send_message
 
 
@@ -28,35 +29,18 @@ class MOTD(SimpleCommandPlugin):
         await super().activate()
         self.motd = self.config.get_plugin_config(self.name)["message"]
 
-    # Packet hooks - look for these packets and act on them
+    # Player events - sent by player_manager
 
-    async def on_connect_success(self, data, connection):
+    @subscribe(PlayerJoined)
+    def _display_motd(self, event):
         """
-        Client successfully connected hook. If a client connects, show them the
-        Message of the day. We have to wrap the display of the MOTD in a future
-        so that we can delay its display by one second. Otherwise, the packet
-        gets sent to the client before it has a chance to render it.
+        Player joined event. When a player finishes connecting, show them
+        the Message of the day.
 
-        :param data: The packet saying the client connected.
-        :param connection: The connection from which the packet came.
-        :return: Boolean: True. Anything else stops the client from being able
-                 to connect.
-        """
-        self.background(self._display_motd(connection))
-        return True
-
-    # Helper functions - Used by commands
-
-    async def _display_motd(self, connection):
-        """
-        Helper routine for displaying the MOTD on client connect. Sleeps for
-        one second before displaying the MOTD. Do this in a non-blocking
-        fashion.
-
-        :param connection: The connection we're showing the message to.
+        :param event: PlayerJoined event.
         :return: Null.
         """
-        send_message(connection, "{}".format(self.motd))
+        send_message(event.connection, "{}".format(self.motd))
 
     # Commands - In-game actions that can be performed
 
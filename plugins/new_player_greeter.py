@@ -15,6 +15,7 @@ import packets
 import pparser
 from base_plugin import SimpleCommandPlugin
 from data_parser import GiveItem
+from events import WorldChanged, subscribe
 from utilities import send_message, ChatReceiveMode, DotDict
 
 
@@ -39,27 +40,26 @@ class NewPlayerGreeter(SimpleCommandPlugin):
         self.greeting = self.config.get_plugin_config(self.name)["greeting"]
         self.gifts = self.config.get_plugin_config(self.name)["gifts"]
 
-    async def on_world_start(self, data, connection):
+    @subscribe(WorldChanged)
+    def _world_changed(self, event):
         """
-        Client on world hook. After a client connects, when their world
-        first loads, check if they are new to the server (never been seen
-        before). If they're new, send them a nice message and give them some
-        starter items.
-
-        :param data: The packet saying the client connected.
-        :param connection: The connection from which the packet came.
-        :return: Boolean: True. Anything else stops the client from being able
-                 to connect.
+        Player event. After a client connects, when their world first loads,
+        check if they are new to the server (never been seen before). If
+        they're new, send them a nice message and give them some starter
+        items. The greeting and gifts still wait a moment, so they arrive
+        after the beam-in rather than during it.
+
+        :param event: WorldChanged event of the player beaming in.
+        :return: Null.
         """
-        player = self.plugins['player_manager'].get_player_by_name(
-            connection.player.name)
-        if hasattr(player, 'seen_before'):
-            return True
-        else:
-            self.background(self._new_player_greeter(connection))
-            self.background(self._new_player_gifter(connection))
-            player.seen_before = True
-        return True
+        player = event.player
+        if not event.first or hasattr(player, 'seen_before'):
+            return
+        self.background(self._new_player_greeter(event.connection),
+                        connection=event.connection)
+        self.background(self._new_player_gifter(event.connection),
+                        connection=event.connection)
+        player.seen_before = True
 
     # Helper functions - Used by commands
 
@@ -7,15 +7,15 @@ Allows Admins to set a custom greeting message on a world.
 Reimplemented for StarryPy3k by medeor413.
 """
 
-import asyncio
-
 from base_plugin import StorageCommandPlugin
+from events import WorldChanged, subscribe
 from utilities import send_message, Command
 
 
 class PlanetAnnouncer(StorageCommandPlugin):
     name = "planet_announcer"
     depends = ["player_manager", "command_dispatcher"]
+    storage_check_interval = None
 
     def __init__(self):
         super().__init__()
@@ -25,22 +25,18 @@ class PlanetAnnouncer(StorageCommandPlugin):
         if "greetings" not in self.storage:
             self.storage["greetings"] = {}
 
-    async def on_world_start(self, data, connection):
-        self.background(self._announce(connection))
-        return True
-
-    async def _announce(self, connection):
+    @subscribe(WorldChanged)
+    def _announce(self, event):
         """
         Announce to all players in the world when a new player beams in,
         and display the greeting message to the new player, if set.
 
-        :param connection: The connection of the player beaming in.
+        :param event: WorldChanged event of the player beaming in.
         :return: Null.
         """
-        await asyncio.sleep(.5)
-        location = str(connection.player.location)
-        for uuid in self.plugins["player_manager"].players_online:
-            p = self.plugins["player_manager"].get_player_by_uuid(uuid)
+        connection = event.connection
+        location = str(event.location)
+        for p in self.plugins["player_manager"].players_online.players():
             if str(p.location) == location and p.connection != connection:
                 send_message(p.connection, "{} has beamed down to the planet!"
                              .format(connection.player.alias))
@@ -57,9 +53,11 @@ class PlanetAnnouncer(StorageCommandPlugin):
         if not msg:
             if location in self.storage["greetings"]:
                 self.storage["greetings"].pop(location)
+                self.storage.touch()
                 send_message(connection, "Greeting message "
                                                     "cleared.")
         else:
             self.storage["greetings"][location] = msg
+            self.storage.touch()
             send_message(connection, "Greeting message set to \"{}"
                                                 "\".".format(msg))
@@ -17,7 +17,7 @@ import pparser
 from base_plugin import StorageCommandPlugin
 from data_parser import GiveItem
 from utilities import Direction, Command, send_message, \
-    EntityInteractionType, EntitySpawnType
+    EntityInteractionType, EntitySpawnType, Hook, State, When
 
 
 ###
@@ -54,6 +54,8 @@ class ProtectedLocation:
 class PlanetProtect(StorageCommandPlugin):
     name = "planet_protect"
     depends = ["player_manager", "command_dispatcher"]
+    reloadable = False
+    storage_check_interval = None
 
     async def activate(self):
         await super().activate()
@@ -72,7 +74,10 @@ class PlanetProtect(StorageCommandPlugin):
 
     # Packet hooks - look for these packets and act on them
 
-    async def on_spawn_entity(self, data, connection):
+    # Hooks that look at connection.player; before the handshake is done
+    # there's no player (or location) to check.
+    @Hook(when=When(min_state=State.CONNECTED))
+    def on_spawn_entity(self, data, connection):
         """
         Catch when a player tries spawning an object in the world.
 
@@ -97,19 +102,14 @@ class PlanetProtect(StorageCommandPlugin):
             action = data["parsed"]["spawn_type"]
             if action not in [EntitySpawnType.OBJECT, EntitySpawnType.VEHICLE]:
                 return True
-        await self._protection_warn(data, connection)
-
-        item_base = GiveItem.build(dict(name=data["parsed"]["payload"],
-                                        count=1,
-                                        variant_type=7,
-                                        description=""))
-        item_packet = pparser.build_packet(packets.packets['give_item'],
-                                           item_base)
-        await asyncio.sleep(.1)
-        await connection.raw_write(item_packet)
+        self._protection_warn(data, connection)
+        self.background(self._refund_item(data["parsed"]["payload"],
+                                          connection),
+                        connection=connection)
         return False
 
-    async def on_entity_interact_result(self, data, connection):
+    @Hook(when=When(min_state=State.CONNECTED))
+    def on_entity_interact_result(self, data, connection):
         """
         Catch when a player interacts with an object in the world.
 
@@ -142,24 +142,24 @@ class PlanetProtect(StorageCommandPlugin):
                           EntityInteractionType.GO_PRONE,
                           EntityInteractionType.NOMINAL]:
                 return True
-        await self._protection_warn(data, connection)
+        self._protection_warn(data, connection)
         return False
 
-    async def on_tile_update(self, data, connection):
+    @Hook(direction=Direction.TO_SERVER,
+          when=When(min_state=State.CONNECTED))
+    def on_tile_update(self, data, connection):
         """
         Hook for tile update packet. Use to verify if changes to tiles are
-        allowed for player.
+        allowed for player. Only sees packets sent by the client; the ones
+        the server generates pass without being parsed.
 
         :param data: The packet containing the action.
         :param connection: The connection from which the packet came.
-        :return: Boolean, Varied. If the server generates the packet,
-                 let it pass. If planet is not protected, let it pass.
+        :return: Boolean, Varied. If planet is not protected, let it pass.
                  If player is an Admin, let it pass. If player is list of
                  builders, let it pass. Otherwise, block the packet from
                  reaching the server.
         """
-        if data["direction"] == Direction.TO_CLIENT:
-            return True
         if not self.check_protection(connection.player.location):
             return True
         protection = self.get_protection(connection.player.location)
@@ -170,7 +170,7 @@ class PlanetProtect(StorageCommandPlugin):
         elif protection.check_builder(connection.player):
             return True
         else:
-            await self._protection_warn(data, connection)
+            self._protection_warn(data, connection)
             return False
 
     # Rather than recreating the same check for every different type of
@@ -226,6 +226,7 @@ class PlanetProtect(StorageCommandPlugin):
             protection = self.storage["locations"][str(location)]
             protection.protect()
             protection.add_builder(player)
+        self.storage.touch()
         return protection
 
     def disable_protection(self, location):
@@ -236,8 +237,27 @@ class PlanetProtect(StorageCommandPlugin):
         :return: Null.
         """
         self.storage["locations"][str(location)].unprotect()
+        self.storage.touch()
+
+    async def _refund_item(self, name, connection):
+        """
+        Give back an item whose placement was blocked. Done after a short
+        delay, off the packet path, so the client sees it arrive.
+
+        :param name: Name of the item to give back.
+        :param connection: The connection to give it to.
+        :return: Null.
+        """
+        item_base = GiveItem.build(dict(name=name,
+                                        count=1,
+                                        variant_type=7,
+                                        description=""))
+        item_packet = pparser.build_packet(packets.packets['give_item'],
+                                           item_base)
+        await asyncio.sleep(.1)
+        await connection.raw_write(item_packet)
 
-    async def _protection_warn(self, data, connection):
+    def _protection_warn(self, data, connection):
         """
         Warn a player about planet being protected (if they do a restricted
         activity). One minute cool-down between warnings.
@@ -310,6 +330,7 @@ class PlanetProtect(StorageCommandPlugin):
         if p is not None:
             protection = self.get_protection(location)
             protection.add_builder(p)
+            self.storage.touch()
             send_message(connection,
                          "Added {} to allowed list for {}".format(
                              p.alias, connection.player.location))
@@ -342,6 +363,7 @@ class PlanetProtect(StorageCommandPlugin):
         if p is not None:
             protection = self.get_protection(connection.player.location)
             protection.del_builder(p)
+            self.storage.touch()
             send_message(connection,
                          "Removed player from build list for this location.")
         else:
@@ -12,23 +12,65 @@ Updated for release: kharidiron
 
 import asyncio
 import datetime
+import pickle
 import pprint
 import re
 import json
+import sys
+import time
+from pathlib import Path
+from itertools import chain
 from operator import attrgetter
 
 from base_plugin import SimpleCommandPlugin
 from data_parser import ConnectFailure, ServerDisconnect
+from events import PlayerJoined, PlayerLeft, PlayerRenamed, WorldChanged
 from pparser import build_packet
-from utilities import Command, DotDict, State, broadcast, send_message, \
-    WarpType, WarpWorldType, WarpAliasType, Cupboard
+from storage import PlayerArchive, backup, expire_backups, open_storage
+from utilities import Command, State, broadcast, send_message, \
+    WarpType, WarpWorldType, WarpAliasType, Hook, Tracked, TrackedRecord, \
+    PluginStorage, memory_usage
 from packets import packets
 
 
-class Player:
+# Distinct sets of ranks and permissions, see share.
+_shared_sets = {}
+
+
+def share(values):
+    """
+    A frozenset of `values`, shared with every other player that has the
+    same ranks or permission grants.
+    """
+    values = frozenset(values)
+    return _shared_sets.setdefault(values, values)
+
+
+class Player(TrackedRecord):
     """
     Prototype class for a player.
+
+    A player's permissions are those of their ranks, shared with every
+    player with the same ranks (see RankTable), plus any granted to them
+    and minus any revoked from them; only the grants and revocations are
+    their own. `perm_check` tests them as a bitset of Player.rank_table's
+    permission IDs, worked out when first needed after they change.
     """
+    _fields = ("uuid", "species", "name", "alias", "last_seen", "ranks",
+               "granted_perms", "revoked_perms", "chat_prefix", "priority",
+               "logged_in", "client_id", "ip", "location", "last_location",
+               "muted", "team_id", "seen_before")
+    __slots__ = _fields + ("connection", "warned", "_permissions", "_bits")
+    _volatile = frozenset({"connection", "warned"})
+    # The PlayerIndex of the player database, kept up to date as players
+    # in it change.
+    index = None
+    # The RankTable, for the permissions of players whose ranks haven't
+    # been updated since they were loaded, and for perm_check.
+    rank_table = None
+    _permission_attributes = frozenset({"ranks", "granted_perms",
+                                        "revoked_perms"})
+
     def __init__(self, uuid, species="unknown", name="", alias="",
                  last_seen=None, ranks=None, logged_in=False,
                  connection=None, client_id=-1, ip="", planet="",
@@ -59,13 +101,9 @@ class Player:
             self.last_seen = datetime.datetime.now()
         else:
             self.last_seen = last_seen
-        if ranks is None:
-            self.ranks = set()
-        else:
-            self.ranks = set(ranks)
-        self.granted_perms = set()
-        self.revoked_perms = set()
-        self.permissions = set()
+        self.ranks = share(ranks or ())
+        self.granted_perms = share(())
+        self.revoked_perms = share(())
         self.chat_prefix = ""
         self.priority = 0
         self.logged_in = logged_in
@@ -83,23 +121,48 @@ class Player:
 
         :return: Pretty-printed dictionary of Player object.
         """
-        return pprint.pformat(self.__dict__)
+        return pprint.pformat(super().__getstate__())
 
     def __getstate__(self):
         """
         Strip unpicklable attributes when called for pickling.
-        :return: The object's __dict__ with connection-related attributes
-        removed.
+        :return: The object's saved attributes, with connection-related
+        ones reset.
         """
-        res = self.__dict__.copy()
-        if "connection" in res:
-            del res["connection"]
+        res = super().__getstate__()
         if res["logged_in"]:
             res["logged_in"] = False
             res["location"] = None
             res["last_seen"] = datetime.datetime.now()
         return res
 
+    def __setstate__(self, state):
+        """
+        Each player's record holds its own copies of their locations, ranks
+        and the like; swap them for shared ones when unpickling. Records
+        from before players had slots also hold their permissions, which
+        are worked out again instead.
+        """
+        super().__setstate__(state)
+        for name in ("ranks", "granted_perms", "revoked_perms"):
+            object.__setattr__(self, name, share(state.get(name, ())))
+        for name in ("species", "chat_prefix"):
+            value = state.get(name)
+            if isinstance(value, str):
+                object.__setattr__(self, name, sys.intern(value))
+        self.intern_locations()
+
+    def intern_locations(self):
+        """
+        Points the player's locations at the shared Planet and Ship objects,
+        without counting as a change.
+        """
+        for name in ("location", "last_location"):
+            location = getattr(self, name, None)
+            interned = intern_location(location)
+            if interned is not location:
+                object.__setattr__(self, name, interned)
+
     def __eq__(self, other):
         """
         Comparison function to check if this player object equals another.
@@ -114,23 +177,56 @@ class Player:
     def __hash__(self):
         return id(self)
 
+    def __setattr__(self, name, value):
+        if name in self._permission_attributes:
+            object.__setattr__(self, "_permissions", None)
+            object.__setattr__(self, "_bits", None)
+        index = Player.index
+        if index is None or name not in index.attributes:
+            return super().__setattr__(name, value)
+        old = getattr(self, name, None)
+        super().__setattr__(name, value)
+        if old != value:
+            index.changed(self, name, old)
+
+    @property
+    def permissions(self):
+        """
+        The player's effective permissions, as a frozenset.
+        """
+        permissions = getattr(self, "_permissions", None)
+        if permissions is None:
+            permissions = self._resolve(Player.rank_table)
+        return permissions
+
+    def _resolve(self, ranks):
+        if ranks is None:
+            permissions = frozenset()
+        else:
+            permissions = ranks.permissions(self.ranks)
+        if self.granted_perms or self.revoked_perms:
+            permissions = share((permissions | self.granted_perms)
+                                - self.revoked_perms)
+        if ranks is not None:
+            object.__setattr__(self, "_permissions", permissions)
+            object.__setattr__(self, "_bits", None)
+        return permissions
+
     def update_ranks(self, ranks):
         """
         Update the player's info to match any changes made to their ranks.
 
+        :param ranks: RankTable of the ranks there are.
         :return: Null.
         """
-        self.permissions = set()
         highest_rank = None
-        self.ranks = {x.lower() for x in self.ranks}
+        self.ranks = share(x.lower() for x in self.ranks)
         for r in self.ranks:
             if not highest_rank:
                 highest_rank = r
-            self.permissions |= ranks[r]['permissions']
             if ranks[r]['priority'] > ranks[highest_rank]['priority']:
                 highest_rank = r
-        self.permissions |= self.granted_perms
-        self.permissions -= self.revoked_perms
+        self._resolve(ranks)
         if highest_rank:
             self.priority = ranks[highest_rank]['priority']
             self.chat_prefix = ranks[highest_rank]['prefix']
@@ -141,23 +237,49 @@ class Player:
     def perm_check(self, perm):
         if not perm:
             return True
-        elif "special.allperms" in self.permissions:
+        table = Player.rank_table
+        if table is not None:
+            try:
+                bits = self._bits
+                if bits == -1:
+                    # special.allperms: no mask to look up.
+                    return True
+                return bits & table.masks[perm] != 0
+            except (AttributeError, TypeError, KeyError):
+                # No bitset yet, or none since the player's permissions
+                # changed (None), or a permission not checked for before.
+                bits = getattr(self, "_bits", None)
+                if bits is None:
+                    bits = table.bits(self.permissions)
+                    object.__setattr__(self, "_bits", bits)
+                return bits == -1 or bits & table.mask(perm) != 0
+        permissions = self.permissions
+        if "special.allperms" in permissions:
             return True
         elif perm.lower() in self.revoked_perms:
             return False
-        elif perm.lower() in self.permissions:
+        elif perm.lower() in permissions:
             return True
         else:
             return False
 
-class Ship:
+class Ship(TrackedRecord):
     """
     Prototype class for a Ship.
     """
+    _fields = ("uuid", "player")
+    __slots__ = _fields
+    # The ships shelf, by key (see intern_location).
+    interned = None
+
     def __init__(self, uuid, player):
         self.uuid = uuid
         self.player = player
 
+    @property
+    def key(self):
+        return self.uuid
+
     def __str__(self):
         return "{}'s ship".format(self.player)
 
@@ -165,10 +287,15 @@ class Ship:
         return "ShipWorld"
 
 
-class Planet:
+class Planet(TrackedRecord):
     """
     Prototype class for a planet.
     """
+    _fields = ("x", "y", "z", "planet", "satellite", "name")
+    __slots__ = _fields + ("_key",)
+    # The planets shelf, by key (see intern_location).
+    interned = None
+
     def __init__(self, location=(0, 0, 0), planet=0,
                  satellite=0, name=""):
         self.x, self.y, self.z = location
@@ -183,16 +310,130 @@ class Planet:
             s.append(":{}".format(self.satellite))
         return "".join(s)
 
+    @staticmethod
+    def make_key(location, planet, satellite):
+        """
+        The key of the planet at these celestial coordinates, both in the
+        planets shelf and wherever plugins store things by planet.
+        """
+        x, y, z = location
+        return "CelestialWorld:{}:{}:{}:{}:{}".format(x, y, z, planet,
+                                                      satellite)
+
+    @property
+    def key(self):
+        key = getattr(self, "_key", None)
+        if key is None:
+            key = self.make_key((self.x, self.y, self.z), self.planet,
+                                self.satellite)
+            object.__setattr__(self, "_key", key)
+        return key
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, "_key", None)
+        super().__setattr__(name, value)
+
     def __str__(self):
-        return "CelestialWorld:{}:{}:{}:{}:{}".format(self.x, self.y, self.z,
-                                                      self.planet,
-                                                      self.satellite)
+        return self.key
 
     def locationtype(self):
         return "CelestialWorld"
 
 
-class IPBan:
+def intern_location(location):
+    """
+    The shared object for a player's location: the Planet or Ship in the
+    player database with the same key, or the one instance world string.
+    Anything else (and anything not in the database) is returned as is.
+
+    :param location: Planet, Ship, instance world string or None.
+    :return: Interned location.
+    """
+    if isinstance(location, str):
+        return sys.intern(location)
+    interned = getattr(type(location), "interned", None)
+    if interned is None:
+        return location
+    return interned.get(location.key, location)
+
+
+class RankTable(dict):
+    """
+    The ranks in permissions.json by lowercased name, each with every
+    permission it has (its own and those it inherits) as a frozenset.
+
+    Permissions also get integer IDs, so a set of them can be checked as
+    a bitset (see `bits` and `mask`). The permissions of the ranks get
+    theirs up front, others as they turn up.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._combined = {}
+        # Permission -> ID.
+        self._ids = {}
+        # Permission as checked for -> bit of its lowercased ID.
+        self.masks = {}
+        # Shared set of permissions -> bitset.
+        self._bits = {}
+        for rank in self.values():
+            for permission in sorted(rank["permissions"]):
+                self._id(permission)
+
+    def _id(self, permission):
+        return self._ids.setdefault(permission, len(self._ids))
+
+    def mask(self, permission):
+        """
+        The bit for a permission, as perm_check tests it (lowercased).
+
+        :param permission: Permission name.
+        :return: Integer with the permission's bit set.
+        """
+        try:
+            return self.masks[permission]
+        except KeyError:
+            mask = 1 << self._id(permission.lower())
+            self.masks[permission] = mask
+            return mask
+
+    def bits(self, permissions):
+        """
+        A set of permissions as a bitset. special.allperms sets every bit.
+
+        :param permissions: Frozenset of permissions.
+        :return: Integer bitset (-1 for every bit).
+        """
+        try:
+            return self._bits[permissions]
+        except KeyError:
+            if "special.allperms" in permissions:
+                bits = -1
+            else:
+                bits = 0
+                for permission in permissions:
+                    bits |= 1 << self._id(permission)
+            self._bits[permissions] = bits
+            return bits
+
+    def permissions(self, ranks):
+        """
+        The permissions of a set of ranks, shared between every player who
+        has those ranks.
+
+        :param ranks: Frozenset of lowercased rank names.
+        :return: Frozenset of permissions.
+        """
+        try:
+            return self._combined[ranks]
+        except KeyError:
+            permissions = share(chain.from_iterable(
+                self[x.lower()]["permissions"] for x in ranks
+                if x.lower() in self))
+            self._combined[ranks] = permissions
+            return permissions
+
+
+class IPBan(Tracked):
     """
     Prototype class a Ban object.
     """
@@ -204,24 +445,244 @@ class IPBan:
         self.banned_at = datetime.datetime.now()
 
 
+class PlayerIndex:
+    """
+    Hash indexes of the player database: lowercased name and alias, and IP,
+    to the uuids of the players that have them. (Online players are looked
+    up by client ID through `OnlineRegistry`.)
+
+    Players are indexed when they are added to the database (`add`) and
+    dropped when they are removed (`remove`); in between, `Player` reports
+    changes to the indexed attributes itself. Until `ready`, the index may
+    be incomplete (see `build`).
+    """
+    columns = ("name", "alias", "ip")
+    attributes = frozenset(columns)
+
+    def __init__(self, players):
+        self.players = players
+        self.ready = False
+        # Column -> value -> uuid, or set of uuids if there are several.
+        self.values = {x: {} for x in self.columns}
+
+    @staticmethod
+    def _fold(column, value):
+        if column != "ip" and isinstance(value, str):
+            return value.lower()
+        return value
+
+    def _link(self, column, value, uuid):
+        index = self.values[column]
+        value = self._fold(column, value)
+        uuids = index.get(value)
+        if uuids is None or uuids == uuid:
+            index[value] = uuid
+        elif isinstance(uuids, set):
+            uuids.add(uuid)
+        else:
+            index[value] = {uuids, uuid}
+
+    def _unlink(self, column, value, uuid):
+        index = self.values[column]
+        value = self._fold(column, value)
+        uuids = index.get(value)
+        if uuids == uuid:
+            del index[value]
+        elif isinstance(uuids, set):
+            uuids.discard(uuid)
+            if len(uuids) == 1:
+                index[value] = uuids.pop()
+
+    def add(self, player):
+        """
+        Indexes a player that has been added to the database.
+        """
+        for column in self.columns:
+            self._link(column, getattr(player, column, None), player.uuid)
+
+    def remove(self, player):
+        """
+        Drops a player that has been removed from the database.
+        """
+        for column in self.columns:
+            self._unlink(column, getattr(player, column, None), player.uuid)
+
+    def changed(self, player, attribute, old):
+        """
+        Called by `Player` when an indexed attribute of it changes.
+        """
+        if self.players.get(player.uuid) is not player:
+            # Not (or no longer) in the database.
+            return
+        self._unlink(attribute, old, player.uuid)
+        self._link(attribute, getattr(player, attribute), player.uuid)
+
+    def build(self, chunk=1000):
+        """
+        Indexes every player in the database, a chunk at a time: a
+        generator to iterate through, which yields between chunks. Players
+        added, changed or removed meanwhile are kept track of as usual.
+        """
+        for n, uuid in enumerate(list(self.players)):
+            player = self.players.get(uuid)
+            if player is not None:
+                self.add(player)
+            if n % chunk == chunk - 1:
+                yield n + 1
+        self.ready = True
+
+    def find(self, column, value):
+        """
+        Players in the database with `value` in `column` (lowercased for
+        names and aliases).
+
+        :param column: "name", "alias" or "ip".
+        :param value: Value to look for.
+        :return: List of Player objects.
+        """
+        uuids = self.values[column].get(self._fold(column, value))
+        if uuids is None:
+            return []
+        if not isinstance(uuids, set):
+            uuids = (uuids,)
+        return [self.players[x] for x in uuids if x in self.players]
+
+
+class OnlineRegistry:
+    """
+    The players who are online, by uuid, client ID and connection.
+
+    Iterating over the registry gives the uuids of the players online, and
+    `players` gives the players themselves; both are snapshots, so players
+    may come and go meanwhile. `version` goes up whenever someone does, for
+    anything worth caching until then.
+    """
+    def __init__(self):
+        self.version = 0
+        # uuid -> (player, client ID, connection) as they were on joining,
+        # since both are cleared before the player is removed.
+        self._entries = {}
+        self._client_ids = {}
+        self._connections = {}
+        self._snapshot = (-1, ())
+
+    def add(self, player):
+        """
+        Registers a player who has just come online, replacing any earlier
+        entry for them.
+        """
+        self.discard(player)
+        self._entries[player.uuid] = (player, player.client_id,
+                                      player.connection)
+        self._client_ids[player.client_id] = player
+        if player.connection is not None:
+            self._connections[player.connection] = player
+        self.version += 1
+
+    def discard(self, player):
+        """
+        Removes a player who has gone offline, if they were online.
+
+        :return: Boolean: Whether they were.
+        """
+        entry = self._entries.pop(player.uuid, None)
+        if entry is None:
+            return False
+        player, client_id, connection = entry
+        if self._client_ids.get(client_id) is player:
+            del self._client_ids[client_id]
+        if self._connections.get(connection) is player:
+            del self._connections[connection]
+        self.version += 1
+        return True
+
+    def get(self, uuid):
+        """
+        :return: The online player with that uuid, or None.
+        """
+        entry = self._entries.get(uuid)
+        return None if entry is None else entry[0]
+
+    def by_client_id(self, client_id):
+        """
+        :return: The online player with that client ID, or None.
+        """
+        return self._client_ids.get(client_id)
+
+    def by_connection(self, connection):
+        """
+        :return: The online player on that connection, or None.
+        """
+        return self._connections.get(connection)
+
+    def players(self):
+        """
+        :return: Tuple of the players online, in the order they joined.
+        """
+        version, players = self._snapshot
+        if version != self.version:
+            players = tuple(x[0] for x in self._entries.values())
+            self._snapshot = (self.version, players)
+        return players
+
+    def __iter__(self):
+        return iter([x.uuid for x in self.players()])
+
+    def __contains__(self, uuid):
+        return uuid in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+
 ###
 
 class PlayerManager(SimpleCommandPlugin):
     name = "player_manager"
+    reloadable = False
 
     def __init__(self):
         self.default_config = {"player_db": "config/player",
+                               "archive_db": "config/player.archive",
+                               "archive_after_days": 0,
+                               "backup_dir": "config/backups",
+                               "backup_interval": 0,
+                               "backup_keep": 7,
+                               "storage": "dbm",
+                               "sqlite_db": "config/player.sqlite3",
+                               "journal_interval": 2,
+                               "lazy_cache_size": 0,
                                "owner_uuid": "!--REPLACE IN CONFIG FILE--!",
                                "owner_ranks": ["Owner"],
                                "new_user_ranks": ["Guest"],
                                "db_save_interval": 900}
         super().__init__()
-        self.shelf = Cupboard(self.plugin_config.player_db)
+        self.players_online = OnlineRegistry()
+        # Plugin name -> [check interval, next check], see get_storage.
+        self._storage_checks = {}
+        # Connections that haven't had their first world_start yet.
+        self._awaiting_world = set()
+        journal = self.plugin_config.journal_interval > 0
+        lazy = None
+        if self.plugin_config.lazy_cache_size > 0:
+            lazy = dict.fromkeys(("players", "planets", "ships"),
+                                 self.plugin_config.lazy_cache_size)
+        if self.plugin_config.storage == "dbm":
+            self.shelf = open_storage("dbm", self.plugin_config.player_db,
+                                      journal=journal, lazy=lazy)
+        else:
+            self.shelf = open_storage(self.plugin_config.storage,
+                                      self.plugin_config.sqlite_db,
+                                      self.plugin_config.player_db,
+                                      self.logger, journal, lazy)
         self.sync()
         self.players = self.shelf["players"]
         self.planets = self.shelf["planets"]
         self.plugin_shelf = self.shelf["plugins"]
-        self.players_online = []
+        self.index = PlayerIndex(self.players)
+        Player.index = self.index
+        Planet.interned = self.planets
+        Ship.interned = self.shelf["ships"]
         try:
             with open("config/permissions.json", "r") as file:
                 self.rank_config = json.load(file)
@@ -234,12 +695,42 @@ class PlayerManager(SimpleCommandPlugin):
             self.logger.error(e)
             raise SystemExit
         self.ranks = self._rebuild_ranks(self.rank_config)
-        self.reap_task = asyncio.create_task(self._reap())
-        self.save_task = asyncio.create_task(self._save_shelf())
+        Player.rank_table = self.ranks
+        self.archive = PlayerArchive(self.plugin_config.archive_db)
+        # Players restored from the archive since the last prune.
+        self._restored = set()
+        self.last_prune = None
+        self.index_task = None
+        if lazy is None:
+            self._intern_locations()
+            for _ in self.index.build():
+                pass
+        else:
+            # Lazily loaded players are interned as they're decoded, but
+            # planets filed under old keys have to be moved once.
+            if "planets_keyed" not in self.shelf:
+                self._intern_locations()
+            # Indexing means decoding every player; don't wait for that.
+            self.index_task = self.background(self._build_index())
+        self.reap_task = self.background(self._reap())
+        self.save_task = self.background(self._save_shelf())
+        self.journal_task = None
+        if journal:
+            self.journal_task = self.background(self._flush_journal())
+        self.prune_task = None
+        if self.plugin_config.archive_after_days > 0:
+            self.prune_task = self.background(self._prune_daily())
+        self.backup_task = None
+        if self.plugin_config.backup_interval > 0:
+            self.backup_task = self.background(self._backup_regularly())
     
-    # Packet hooks - look for these packets and act on them
+    # Packet hooks - look for these packets and act on them. These track
+    # connection and player state, so they run ahead of other plugins' hooks
+    # and still see packets another plugin has vetoed. They have no
+    # deadline: letting a packet through half-handled would skip ban checks.
 
-    async def on_protocol_request(self, data, connection):
+    @Hook(priority=100, always=True)
+    def on_protocol_request(self, data, connection):
         """
         Catch when a client first pings the server for a connection. Set the
         'state' variable to keep track of this.
@@ -251,7 +742,8 @@ class PlayerManager(SimpleCommandPlugin):
         connection.state = State.VERSION_SENT
         return True
 
-    async def on_handshake_challenge(self, data, connection):
+    @Hook(priority=100, always=True)
+    def on_handshake_challenge(self, data, connection):
         """
         Catch when a client tries to handshake with server. Update the 'state'
         variable to keep track of this. Note: This step only occurs when a
@@ -264,7 +756,8 @@ class PlayerManager(SimpleCommandPlugin):
         connection.state = State.HANDSHAKE_CHALLENGE_SENT
         return True
 
-    async def on_handshake_response(self, data, connection):
+    @Hook(priority=100, always=True)
+    def on_handshake_response(self, data, connection):
         """
         Catch when the server responds to a client's handshake. Update the
         'state' variable to keep track of this. Note: This step only occurs
@@ -277,6 +770,7 @@ class PlayerManager(SimpleCommandPlugin):
         connection.state = State.HANDSHAKE_RESPONSE_RECEIVED
         return True
 
+    @Hook(priority=100, always=True, timeout=0)
     async def on_client_connect(self, data, connection):
         """
         Catch when a the client updates the server with its connection
@@ -302,27 +796,37 @@ class PlayerManager(SimpleCommandPlugin):
         connection.player = player
         return True
 
-    async def on_connect_success(self, data, connection):
+    @Hook(priority=-100, always=True)
+    def on_connect_success(self, data, connection):
         """
         Catch when a successful connection is established. Update the 'state'
         variable to keep track of this. Since the client successfully
         connected, update their details in storage (client id, location,
         logged_in state).
 
+        Unlike the other hooks here, this one runs after every other
+        plugin's, so a join another plugin refused (in maintenance mode, say)
+        is never announced.
+
         :param data:
         :param connection:
         :return: Boolean: True. Must be true, so that packet get passed on.
         """
+        if data.get("vetoed"):
+            return True
         response = data["parsed"]
         connection.player.connection = connection
         connection.player.client_id = response["client_id"]
         connection.state = State.CONNECTED
         connection.player.logged_in = True
         connection.player.last_seen = datetime.datetime.now()
-        self.players_online.append(connection.player.uuid)
+        self._go_online(connection.player)
+        self._awaiting_world.add(connection)
+        self.events.emit(PlayerJoined(connection.player, connection))
         return True
 
-    async def on_client_disconnect_request(self, data, connection):
+    @Hook(priority=100, always=True)
+    def on_client_disconnect_request(self, data, connection):
         """
         Catch when a client requests a disconnect from the server. At this
         point, we need to clean up the connection information we have for the
@@ -334,7 +838,8 @@ class PlayerManager(SimpleCommandPlugin):
         """
         return True
 
-    async def on_server_disconnect(self, data, connection):
+    @Hook(priority=100, always=True)
+    def on_server_disconnect(self, data, connection):
         """
         Catch when the server disconnects a client. Similar to the client
         disconnect packet, use this as a cue to perform cleanup, if it wasn't
@@ -347,6 +852,7 @@ class PlayerManager(SimpleCommandPlugin):
         self._set_offline(connection)
         return True
 
+    @Hook(priority=100, always=True, timeout=0)
     async def on_world_start(self, data, connection):
         """
         Hook when a new world instance is started. Use the details passed to
@@ -365,8 +871,13 @@ class PlayerManager(SimpleCommandPlugin):
         self.logger.info("Player {} is now at location: {}".format(
             connection.player.alias,
             connection.player.location))
+        first = connection in self._awaiting_world
+        self._awaiting_world.discard(connection)
+        self.events.emit(WorldChanged(connection.player, connection,
+                                      connection.player.location, first))
         return True
 
+    @Hook(priority=100, always=True, timeout=0)
     async def on_player_warp_result(self, data, connection):
         """
         Hook when a player warps to a world. This action is also used when
@@ -448,7 +959,8 @@ class PlayerManager(SimpleCommandPlugin):
     #             continue
     #     return True
 
-    async def on_step_update(self, data, connection):
+    @Hook(priority=100, always=True)
+    def on_step_update(self, data, connection):
         """
         Catch when the first heartbeat packet is sent to a player. This is the
         final confirmation in the connection process. Update the 'state'
@@ -473,15 +985,15 @@ class PlayerManager(SimpleCommandPlugin):
         while True:
             await asyncio.sleep(10)
             # self.logger.debug("Player reaper running:")
-            for player in self.players_online:
-                target = self.get_player_by_uuid(player)
+            for target in self.players_online.players():
                 if target.connection.state is State.DISCONNECTED or not target.connection:
                     self.logger.warning("Removing stale player connection: {}"
                                         "".format(target.name))
+                    self._awaiting_world.discard(target.connection)
                     target.connection = None
                     target.logged_in = False
                     target.location = None
-                    self.players_online.remove(target.uuid)
+                    self._go_offline(target)
 
     async def _save_shelf(self):
         """
@@ -491,7 +1003,248 @@ class PlayerManager(SimpleCommandPlugin):
         """
         while True:
             await asyncio.sleep(self.plugin_config.db_save_interval)
-            self.sync()
+            try:
+                await self.save()
+            except Exception:
+                self.logger.exception("Error while saving the player "
+                                      "database.")
+
+    async def _flush_journal(self):
+        """
+        Appends changes to the player DB's journal every few seconds, so a
+        crash loses at most that much. The journal is compacted into the
+        database on every save.
+
+        :return: Null.
+        """
+        while True:
+            await asyncio.sleep(self.plugin_config.journal_interval)
+            try:
+                self._check_storage()
+                await self.shelf.flush()
+            except Exception:
+                self.logger.exception("Error while writing the player "
+                                      "database journal.")
+
+    async def _prune_daily(self):
+        """
+        Prunes the player DB shortly after startup, then once a day.
+
+        :return: Null.
+        """
+        while True:
+            await asyncio.sleep(60)
+            try:
+                await self.prune()
+            except Exception:
+                self.logger.exception("Error while pruning the player "
+                                      "database.")
+            await asyncio.sleep(86400 - 60)
+
+    def _intern_locations(self):
+        """
+        Files every planet under its key, and points every player's
+        locations at the planets and ships in the database, so each location
+        is one object rather than a copy per player. Planets used to be
+        logged again on every visit, leaving players with copies of their
+        own. Lazily loaded databases only need this once, since it means
+        decoding every planet and player, so it is marked as done.
+
+        :return: Null.
+        """
+        moved = 0
+        for key, planet in list(self.planets.items()):
+            if isinstance(planet, Planet) and planet.key != key:
+                del self.planets[key]
+                self.planets.setdefault(planet.key, planet)
+                moved += 1
+        for player in self.players.values():
+            for location in (player.location, player.last_location):
+                if isinstance(location, Planet) \
+                        and location.key not in self.planets:
+                    self.planets[location.key] = location
+                    moved += 1
+            player.intern_locations()
+        if moved:
+            self.logger.info("Filed %d planets under their keys.", moved)
+        if "planets_keyed" not in self.shelf:
+            self.shelf["planets_keyed"] = True
+
+    async def _build_index(self):
+        """
+        Builds the player index a chunk at a time, letting the server get on
+        in between. Lookups scan the database until it is done.
+
+        :return: Null.
+        """
+        start = time.perf_counter()
+        for _ in self.index.build():
+            await asyncio.sleep(0)
+        self.logger.debug("Indexed %d players in %.1f s.", len(self.players),
+                          time.perf_counter() - start)
+
+    def _add_player(self, player):
+        """
+        Adds a player to the database, and its index.
+        """
+        self.players[player.uuid] = player
+        self.index.add(player)
+
+    def _remove_player(self, player):
+        """
+        Removes a player from the database, and its index.
+        """
+        del self.players[player.uuid]
+        self.index.remove(player)
+
+    async def _backup_regularly(self):
+        """
+        Backs up the player DB every `backup_interval` seconds.
+
+        :return: Null.
+        """
+        while True:
+            await asyncio.sleep(self.plugin_config.backup_interval)
+            try:
+                await self.backup()
+            except Exception:
+                self.logger.exception("Error while backing up the player "
+                                      "database.")
+
+    async def backup(self):
+        """
+        Writes a timestamped, gzipped backup of the player DB and its
+        archive to `backup_dir`, and deletes all but the newest
+        `backup_keep` backups. The database is copied as of its last save
+        or journal flush, in a worker thread; saves made meanwhile wait
+        for the copy without holding up the server.
+
+        :return: Tuple: (path of the backup, size in bytes, seconds taken).
+        """
+        start = time.perf_counter()
+        directory = Path(self.plugin_config.backup_dir)
+        path = directory / "player-{:%Y%m%d-%H%M%S}.tar.gz".format(
+            datetime.datetime.now())
+        size = await asyncio.to_thread(backup, path, self.shelf, self.archive)
+        await asyncio.to_thread(expire_backups, directory,
+                                "player-*.tar.gz",
+                                max(1, self.plugin_config.backup_keep))
+        duration = time.perf_counter() - start
+        self.logger.info("Backed up the player database to %s: %d bytes in "
+                         "%.1f s.", path, size, duration)
+        return path, size, duration
+
+    def _stale(self, player, cutoff):
+        """
+        Whether a player can be archived: they haven't been seen since
+        `cutoff`, aren't online or banned, and have no ranks or
+        permissions beyond what new players get.
+        """
+        if player.logged_in or player.uuid == self.plugin_config.owner_uuid:
+            return False
+        if player.last_seen is not None and player.last_seen > cutoff:
+            return False
+        if player.ip in self.shelf["bans"]:
+            return False
+        new_ranks = {x.lower() for x in self.plugin_config.new_user_ranks}
+        return ({x.lower() for x in player.ranks} <= new_ranks
+                and not getattr(player, "granted_perms", None))
+
+    async def prune(self):
+        """
+        Moves players who haven't been seen in `archive_after_days` days
+        (see `_stale`) to the archive, drops their ships, and drops planets
+        that no remaining player is on or was last on. Archived players are
+        restored when they connect or a command changes them.
+
+        :return: Tuple: (players archived, planets dropped).
+        """
+        cutoff = datetime.datetime.now() - datetime.timedelta(
+            days=self.plugin_config.archive_after_days)
+        stale = []
+        records = []
+        for n, uuid in enumerate(list(self.players)):
+            player = self.players.get(uuid)
+            if player is not None and self._stale(player, cutoff):
+                stale.append(player)
+                records.append((uuid, player.name, player.alias, player.ip,
+                                pickle.dumps(player, 4)))
+            if n % 1000 == 999:
+                # Big databases take a while; let the server get on.
+                await asyncio.sleep(0)
+        # Archived copies of players restored before this prune are out of
+        # date, and they have been saved since.
+        restored, self._restored = self._restored, set()
+        restored -= {x.uuid for x in stale}
+        await asyncio.to_thread(self.archive.add, records)
+        archived = 0
+        for player in stale:
+            # Unless they came back while the archive was being written.
+            if self.players.get(player.uuid) is player \
+                    and self._stale(player, cutoff):
+                self._remove_player(player)
+                self.shelf["ships"].pop(player.uuid, None)
+                archived += 1
+        used = set()
+        for player in self.players.values():
+            for location in (player.location, player.last_location):
+                if isinstance(location, Planet):
+                    used.add(str(location))
+        orphans = [x for x in self.planets if x not in used]
+        for key in orphans:
+            del self.planets[key]
+        await self.save()
+        await asyncio.to_thread(self.archive.discard,
+                                [x for x in restored if x in self.players])
+        self.last_prune = (datetime.datetime.now(), archived, len(orphans))
+        self.logger.info("Pruned the player database: archived %d players, "
+                         "dropped %d planets.", archived, len(orphans))
+        return archived, len(orphans)
+
+    async def _unarchive(self, uuid):
+        """
+        Moves an archived player back into the player database.
+
+        :param uuid: UUID of the player.
+        :return: Player object, or None if no player is archived under that
+                 UUID.
+        """
+        player = await asyncio.to_thread(self.archive.get, uuid)
+        if player is None:
+            return None
+        return self._restore(player)
+
+    def _restore(self, player):
+        """
+        Puts a player read from the archive back into the player database,
+        unless they were restored while it was being read.
+
+        :param player: Player read from the archive.
+        :return: The player in the database.
+        """
+        if player.uuid in self.players:
+            return self.players[player.uuid]
+        self._add_player(player)
+        self._restored.add(player.uuid)
+        self.logger.info("Restored archived player {}.".format(player.alias))
+        return player
+
+    def _read_archive(self, column, value, match):
+        # Runs in a worker thread: archived players with `value` in
+        # `column` that pass `match`.
+        players = (self.archive.get(x) for x in self.archive.find(column,
+                                                                   value))
+        return [x for x in players if x is not None and match(x)]
+
+    async def _from_archive(self, column, value, match):
+        """
+        Reads the first archived player with `value` in `column` that passes
+        `match`, if any, leaving them in the archive.
+        """
+        for player in await asyncio.to_thread(self._read_archive, column,
+                                              value, match):
+            if player.uuid not in self.players:
+                return player
 
     def _set_offline(self, connection):
         """
@@ -504,9 +1257,23 @@ class PlayerManager(SimpleCommandPlugin):
         connection.player.logged_in = False
         connection.player.location = None
         connection.player.last_seen = datetime.datetime.now()
-        self.players_online.remove(connection.player.uuid)
+        self._go_offline(connection.player)
+        self._awaiting_world.discard(connection)
         return True
 
+    def _go_online(self, player):
+        self.players_online.add(player)
+        # With lazy loading, keep online players decoded.
+        if hasattr(self.players, "pin"):
+            self.players.pin(player.uuid)
+
+    def _go_offline(self, player):
+        # However they went, subscribers hear of it once.
+        if self.players_online.discard(player):
+            self.events.emit(PlayerLeft(player))
+        if hasattr(self.players, "unpin"):
+            self.players.unpin(player.uuid)
+
     def clean_name(self, name):
         color_strip = re.compile("\^(.*?);")
         alias = color_strip.sub("", name)
@@ -551,8 +1318,53 @@ class PlayerManager(SimpleCommandPlugin):
             self.shelf["bans"] = {}
         if "ships" not in self.shelf:
             self.shelf["ships"] = {}
-        self.logger.debug("Saved the player database.")
+        self._touch_online()
+        self._check_storage(everything=True)
         self.shelf.sync()
+        self._log_save()
+
+    async def save(self):
+        """
+        Saves the player database without holding up the event loop for
+        long: only collecting the changes runs on the loop, and they are
+        written to disk in a worker thread.
+
+        :return: Null
+        """
+        self._touch_online()
+        self._check_storage(everything=True)
+        await self.shelf.save()
+        self._log_save()
+
+    def _touch_online(self):
+        # Online players are saved with a fresh last_seen.
+        for player in self.players_online.players():
+            player.touch()
+
+    def _check_storage(self, everything=False):
+        """
+        Checks plugins' storage for changes they made without touching it,
+        each on its own plugin's interval (or all of them, before a save).
+
+        :param everything: Whether to check every plugin's storage now.
+        :return: Null
+        """
+        now = time.monotonic()
+        for name, due in self._storage_checks.items():
+            if not everything and now < due[1]:
+                continue
+            storage = self.plugin_shelf.get(name)
+            if storage is not None:
+                storage.check()
+            due[1] = now + due[0]
+
+    def _log_save(self):
+        self.logger.debug("Saved the player database: %d records, %d bytes "
+                          "in %.1f ms (%.1f ms on the event loop).",
+                          self.shelf.last_sync_records,
+                          self.shelf.last_sync_bytes,
+                          self.shelf.last_sync_time * 1000,
+                          self.shelf.last_stall * 1000)
 
     async def deactivate(self):
         """
@@ -560,13 +1372,25 @@ class PlayerManager(SimpleCommandPlugin):
 
         :return: Null
         """
-        for player in self.shelf["players"].values():
+        for player in self.players_online.players():
             player.connection = None
             player.logged_in = False
         self.reap_task.cancel()
         self.save_task.cancel()
+        if self.journal_task is not None:
+            self.journal_task.cancel()
+        if self.prune_task is not None:
+            self.prune_task.cancel()
+        if self.backup_task is not None:
+            self.backup_task.cancel()
+        if self.index_task is not None:
+            self.index_task.cancel()
+        Player.index = None
+        Planet.interned = Ship.interned = None
+        Player.rank_table = None
         self.sync()
         self.shelf.close()
+        self.archive.close()
         self.logger.debug("Closed the shelf")
 
     def _rebuild_ranks(self, ranks):
@@ -574,7 +1398,7 @@ class PlayerManager(SimpleCommandPlugin):
         Rebuilds rank configuration from file, including inherited permissions.
 
         :param ranks: The initial rank config.
-        :return: Dict: The built rank permissions.
+        :return: RankTable: The built rank permissions.
         """
         final = {}
 
@@ -587,12 +1411,13 @@ class PlayerManager(SimpleCommandPlugin):
             return finalperms
 
         for rank, config in ranks.items():
-            config['permissions'] = set(config['permissions'])
+            permissions = set(config['permissions'])
             if 'inherits' in config:
-                config['permissions'] |= build_inherits(config['inherits'])
+                permissions |= build_inherits(config['inherits'])
+            config['permissions'] = share(permissions)
             final[rank.lower()] = config
 
-        return final
+        return RankTable(final)
 
     def kick_player(self, player, reason=""):
         if player.client_id == -1 or player.connection is None:
@@ -600,7 +1425,7 @@ class PlayerManager(SimpleCommandPlugin):
             player.logged_in = False
             player.location = None
             player.last_seen = datetime.datetime.now()
-            self.players_online.remove(player.uuid)
+            self._go_offline(player)
             return
         try:
             kick_packet = build_packet(packets["server_disconnect"],
@@ -613,7 +1438,7 @@ class PlayerManager(SimpleCommandPlugin):
         player.logged_in = False
         player.location = None
         player.last_seen = datetime.datetime.now()
-        self.players_online.remove(player.uuid)
+        self._go_offline(player)
 
     def ban_by_ip(self, ip, reason, connection):
         """
@@ -703,13 +1528,55 @@ class PlayerManager(SimpleCommandPlugin):
         Collect the storage for caller.
 
         :param caller: Entity requesting its storage
-        :return: Storage shelf for caller. If called doesn't have anything in
-                 storage, return an empty shelf.
+        :return: PluginStorage for caller. If called doesn't have anything in
+                 storage, return an empty one.
         """
         name = caller.name
-        if name not in self.plugin_shelf:
-            self.plugin_shelf[name] = DotDict({})
-        return self.plugin_shelf[name]
+        storage = self.plugin_shelf.get(name)
+        if not isinstance(storage, PluginStorage):
+            # New, or saved by an older version as a plain DotDict.
+            storage = PluginStorage({} if storage is None else storage)
+            self.plugin_shelf[name] = storage
+        interval = getattr(caller, "storage_check_interval", None)
+        if interval is None:
+            self._storage_checks.pop(name, None)
+        else:
+            storage.check()
+            self._storage_checks[name] = [interval,
+                                          time.monotonic() + interval]
+        return storage
+
+    def _indexed(self, column, value):
+        """
+        Players the storage engine has indexed under `value`, if it indexes
+        players (see storage.SqliteCupboard.find). The index reflects the
+        last save, so callers check the players they get, and fall back to
+        a scan when none match.
+
+        :param column: Indexed column: "name", "alias" or "ip".
+        :param value: Value to look for.
+        :return: List of Player objects.
+        """
+        if not hasattr(self.shelf, "find"):
+            return []
+        players = self.shelf["players"]
+        return [players[x] for x in self.shelf.find("players", column, value)
+                if x in players]
+
+    def _candidates(self, column, value):
+        """
+        Players that may have `value` in `column`: straight from the player
+        index once it is built, otherwise those the storage engine indexed,
+        followed by everyone else.
+
+        :param column: "name", "alias" or "ip".
+        :param value: Value to look for.
+        :return: Iterable of Player objects.
+        """
+        if self.index.ready:
+            return self.index.find(column, value)
+        return chain(self._indexed(column, value),
+                     self.shelf["players"].values())
 
     def get_player_by_uuid(self, uuid):
         """
@@ -735,7 +1602,7 @@ class PlayerManager(SimpleCommandPlugin):
         :return: Mixed: Boolean on logged_in check, player object otherwise.
         """
         lname = name.lower()
-        for player in self.shelf["players"].values():
+        for player in self._candidates("name", name):
             if player.name.lower() == lname:
                 if not check_logged_in or player.logged_in:
                     return player
@@ -751,7 +1618,7 @@ class PlayerManager(SimpleCommandPlugin):
         :return: Mixed: Boolean on logged_in check, player object otherwise.
         """
         lname = alias.lower()
-        for player in self.shelf["players"].values():
+        for player in self._candidates("alias", alias):
             if player.alias.lower() == lname:
                 if not check_logged_in or player.logged_in:
                     return player
@@ -763,9 +1630,7 @@ class PlayerManager(SimpleCommandPlugin):
         :param id: Integer: Client Id of the player to check.
         :return: Player object.
         """
-        for player in self.shelf["players"].values():
-            if player.client_id == id and player.logged_in:
-                return player
+        return self.players_online.by_client_id(id)
 
     def get_player_by_ip(self, ip, check_logged_in=False) -> Player:
         """
@@ -777,7 +1642,7 @@ class PlayerManager(SimpleCommandPlugin):
                                 (true), or the player's server object (false)
         :return: Mixed: Boolean on logged_in check, player object otherwise.
         """
-        for player in self.shelf["players"].values():
+        for player in self._candidates("ip", ip):
             if player.ip == ip:
                 if not check_logged_in or player.logged_in:
                     return player
@@ -812,6 +1677,48 @@ class PlayerManager(SimpleCommandPlugin):
         if player is not None:
             return player
 
+    async def _alias_taken(self, alias):
+        """
+        Whether a player, archived or not, already goes by `alias`.
+        """
+        if self.get_player_by_alias(alias) is not None:
+            return True
+        lname = alias.lower()
+        return await self._from_archive(
+            "alias", alias, lambda x: x.alias.lower() == lname) is not None
+
+    async def find_any_player(self, search, restore=False):
+        """
+        Like `find_player`, but also looks through the archive (in a worker
+        thread) for players pruned from the player database. Archived
+        players are left there unless `restore` is set, for commands that
+        change them.
+
+        :param search: The alias, raw name, uuid or IP of the player.
+        :param restore: Boolean: Move an archived player back into the
+                        player database.
+        :return: Player object, or None.
+        """
+        player = self.find_player(search)
+        if player is not None:
+            return player
+        lname = search.lower()
+        for column, match in (("alias", lambda x: x.alias.lower() == lname),
+                              ("name", lambda x: x.name.lower() == lname),
+                              ("ip", lambda x: x.ip == search)):
+            player = await self._from_archive(column, search, match)
+            if player is not None:
+                break
+        else:
+            if len(search) != 32:
+                return None
+            player = await asyncio.to_thread(self.archive.get, search)
+            if player is None:
+                return None
+        if restore:
+            return self._restore(player)
+        return player
+
     async def _add_or_get_player(self, uuid, species, name="", last_seen=None,
                            ranks=None, logged_in=False, connection=None,
                            client_id=-1, ip="", planet="", muted=False,
@@ -844,6 +1751,8 @@ class PlayerManager(SimpleCommandPlugin):
         if alias is None:
             alias = uuid[0:4]
 
+        if uuid not in self.shelf["players"]:
+            await self._unarchive(uuid)
         if uuid in self.shelf["players"]:
             self.logger.info("Known player is attempting to log in: "
                              "{}".format(alias))
@@ -857,14 +1766,17 @@ class PlayerManager(SimpleCommandPlugin):
             if p.name != name:
                 p.name = name
                 alias = self.clean_name(name)
-                if alias != p.alias and (self.get_player_by_alias(alias)
-                                         or alias is None):
+                if alias != p.alias and (alias is None
+                                         or await self._alias_taken(alias)):
                     alias = uuid[0:4]
+                old_alias = p.alias
                 p.alias = alias
+                if alias != old_alias:
+                    self.events.emit(PlayerRenamed(p, old_alias=old_alias))
             p.update_ranks(self.ranks)
             return p
         else:
-            if self.get_player_by_alias(alias) is not None:
+            if await self._alias_taken(alias):
                 raise NameError("A user with that name already exists.")
             self.logger.info("Adding new player to database: {} (UUID:{})"
                              "".format(alias, uuid))
@@ -876,7 +1788,7 @@ class PlayerManager(SimpleCommandPlugin):
                                 ranks, logged_in, connection, client_id, ip,
                                 planet, muted)
             new_player.update_ranks(self.ranks)
-            self.shelf["players"][uuid] = new_player
+            self._add_player(new_player)
             return new_player
 
     async def _add_or_get_ship(self, uuid):
@@ -908,17 +1820,15 @@ class PlayerManager(SimpleCommandPlugin):
         """
         # TODO: add planet names to this, since people seem to like using
         # those as a way to refer to the planets as well.
-        a, x, y = location
-        loc_string = "{}:{}:{}:{}:{}".format(a, x, y, planet, satellite)
-        if loc_string in self.shelf["planets"]:
-            self.logger.info("Returning to an already logged planet.")
-            planet = self.shelf["planets"][loc_string]
-        else:
-            self.logger.info("Logging new planet to database.")
-            planet = Planet(location=location, planet=planet,
-                            satellite=satellite)
-            self.shelf["planets"][str(planet)] = planet
-            self.junk = State
+        key = Planet.make_key(location, planet, satellite)
+        known = self.planets.get(key)
+        if known is not None:
+            self.logger.debug("Returning to an already logged planet.")
+            return known
+        self.logger.info("Logging new planet to database.")
+        planet = Planet(location=location, planet=planet,
+                        satellite=satellite)
+        self.planets[key] = planet
         return planet
 
     async def _add_or_get_instance(self, data):
@@ -937,7 +1847,7 @@ class PlayerManager(SimpleCommandPlugin):
         else:
             instance_string.append(":-")
 
-        return "".join(instance_string)
+        return intern_location("".join(instance_string))
 
     # Commands - In-game actions that can be performed
 
@@ -1005,7 +1915,8 @@ class PlayerManager(SimpleCommandPlugin):
         """
         try:
             target, reason = data[0], " ".join(data[1:])
-            if self.find_player(target).priority >= connection.player.priority:
+            player = await self.find_any_player(target)
+            if player.priority >= connection.player.priority:
                 send_message(connection, "Can't ban {}, they are equal or "
                                          "higher than your rank!"
                              .format(target))
@@ -1015,7 +1926,7 @@ class PlayerManager(SimpleCommandPlugin):
             if re.match(r"^(?:[0-9]{1,3}\.){3}[0-9]{1,3}$", target):
                 self.ban_by_ip(target, reason, connection)
             else:
-                self.ban_by_name(target, reason, connection)
+                self.ban_by_ip(player.ip, reason, connection)
         except:
             raise SyntaxWarning
 
@@ -1037,7 +1948,12 @@ class PlayerManager(SimpleCommandPlugin):
             if re.match(r"^(?:[0-9]{1,3}\.){3}[0-9]{1,3}$", target):
                 self.unban_by_ip(target, connection)
             else:
-                self.unban_by_name(target, connection)
+                player = await self.find_any_player(target)
+                if player is not None:
+                    self.unban_by_ip(player.ip, connection)
+                else:
+                    send_message(connection, "Couldn't find a player by the "
+                                             "name {}".format(target))
         except:
             raise SyntaxWarning
 
@@ -1092,7 +2008,7 @@ class PlayerManager(SimpleCommandPlugin):
             send_message(connection, "/user listranks (player)")
             send_message(connection, "Lists the ranks a player has.")
         elif data[0].lower() == "addperm":
-            target = self.find_player(data[1])
+            target = await self.find_any_player(data[1], restore=True)
             if target:
                 if not data[2]:
                     send_message(connection, "No permission "
@@ -1105,8 +2021,9 @@ class PlayerManager(SimpleCommandPlugin):
                                                         "has permission {}."
                                             .format(target.alias, data[2]))
                 else:
-                    target.revoked_perms.discard(data[2].lower())
-                    target.granted_perms.add(data[2].lower())
+                    perm = {data[2].lower()}
+                    target.revoked_perms = share(target.revoked_perms - perm)
+                    target.granted_perms = share(target.granted_perms | perm)
                     target.update_ranks(self.ranks)
                     if target.logged_in:
                         send_message(target.connection,
@@ -1121,7 +2038,7 @@ class PlayerManager(SimpleCommandPlugin):
                 send_message(connection, "User {} not "
                                                     "found.".format(data[1]))
         elif data[0].lower() == "rmperm":
-            target = self.find_player(data[1])
+            target = await self.find_any_player(data[1], restore=True)
             if target:
                 if not data[2]:
                     send_message(connection, "No permission "
@@ -1137,8 +2054,9 @@ class PlayerManager(SimpleCommandPlugin):
                                                         "have permission {}."
                                             .format(target.alias, data[2]))
                 else:
-                    target.granted_perms.discard(data[2].lower())
-                    target.revoked_perms.add(data[2].lower())
+                    perm = {data[2].lower()}
+                    target.granted_perms = share(target.granted_perms - perm)
+                    target.revoked_perms = share(target.revoked_perms | perm)
                     target.update_ranks(self.ranks)
                     if target.logged_in:
                         send_message(target.connection,
@@ -1153,7 +2071,7 @@ class PlayerManager(SimpleCommandPlugin):
                 send_message(connection, "User {} not "
                                                     "found.".format(data[1]))
         elif data[0].lower() == "addrank":
-            target = self.find_player(data[1])
+            target = await self.find_any_player(data[1], restore=True)
             if target:
                 search = data[2].lower()
                 if not search:
@@ -1172,7 +2090,7 @@ class PlayerManager(SimpleCommandPlugin):
                                                         "has rank {}."
                                             .format(target.alias, search))
                 else:
-                    target.ranks.add(search)
+                    target.ranks = share(target.ranks | {search})
                     target.update_ranks(self.ranks)
                     if target.logged_in:
                         send_message(target.connection,
@@ -1186,7 +2104,7 @@ class PlayerManager(SimpleCommandPlugin):
                 send_message(connection, "User {} not "
                                                     "found.".format(data[1]))
         elif data[0].lower() == "rmrank":
-            target = self.find_player(data[1])
+            target = await self.find_any_player(data[1], restore=True)
             if target:
                 search = data[2].lower()
                 if not search:
@@ -1204,7 +2122,7 @@ class PlayerManager(SimpleCommandPlugin):
                                                         "have rank {}."
                                             .format(target.alias, search))
                 else:
-                    target.ranks.remove(search)
+                    target.ranks = share(target.ranks - {search})
                     target.update_ranks(self.ranks)
                     if target.logged_in:
                         send_message(target.connection, "{} removed"
@@ -1219,7 +2137,7 @@ class PlayerManager(SimpleCommandPlugin):
                 send_message(connection, "User {} not "
                                                     "found.".format(data[1]))
         elif data[0].lower() == "listperms":
-            target = self.find_player(data[1])
+            target = await self.find_any_player(data[1])
             if target:
                 perms = ", ".join(target.permissions)
                 send_message(connection, "Permissions for user {}:"
@@ -1229,7 +2147,7 @@ class PlayerManager(SimpleCommandPlugin):
                 send_message(connection, "User {} not "
                                                     "found.".format(data[1]))
         elif data[0].lower() == "listranks":
-            target = self.find_player(data[1])
+            target = await self.find_any_player(data[1])
             if target:
                 ranks = ", ".join((x.capitalize() for x in target.ranks))
                 send_message(connection, "Ranks for user {}:"
@@ -1297,7 +2215,7 @@ class PlayerManager(SimpleCommandPlugin):
         else:
             force = False
         alias = " ".join(data)
-        player = self.find_player(alias)
+        player = await self.find_any_player(alias)
         if player is None:
             raise NameError
         if player.priority >= connection.player.priority:
@@ -1309,7 +2227,9 @@ class PlayerManager(SimpleCommandPlugin):
             raise ValueError(
                 "Can't delete a logged-in player; please kick them first. If "
                 "absolutely necessary, append *force to the command.")
-        self.players.pop(player.uuid)
+        if self.players.get(player.uuid) is player:
+            self._remove_player(player)
+        await asyncio.to_thread(self.archive.discard, [player.uuid])
         del player
         send_message(connection, "Player {} has been deleted.".format(alias))
 
@@ -1317,5 +2237,56 @@ class PlayerManager(SimpleCommandPlugin):
              perm="player_manager.save",
              doc="Saves the player database to disk.")
     async def _save(self, data, connection):
-        self.shelf.sync()
-        send_message(connection, "Player database saved successfully.")
+        await self.save()
+        send_message(connection, "Player database saved successfully "
+                                 "({} records, {} bytes in {:.1f} ms, "
+                                 "{:.1f} ms on the event loop)."
+                     .format(self.shelf.last_sync_records,
+                             self.shelf.last_sync_bytes,
+                             self.shelf.last_sync_time * 1000,
+                             self.shelf.last_stall * 1000))
+
+    @Command("backup",
+             perm="player_manager.backup",
+             doc="Backs up the player database, without stopping the "
+                 "server.")
+    async def _backup(self, data, connection):
+        send_message(connection, "Backing up the player database...")
+        path, size, duration = await self.backup()
+        send_message(connection, "Player database backed up to {} ({:.1f} "
+                                 "kB in {:.1f} s).".format(path.name,
+                                                           size / 1024,
+                                                           duration))
+
+    @Command("db_stats",
+             perm="player_manager.db_stats",
+             doc="Shows the size of the player database and the memory it "
+                 "takes up.")
+    async def _db_stats(self, data, connection):
+        shelf = self.shelf
+        counts = ", ".join("{} {}".format(len(shelf[x]), x) for x in
+                           ("players", "planets", "ships", "bans", "plugins"))
+        archived = await asyncio.to_thread(len, self.archive)
+        send_message(connection, "Player database: {}; {} online, {} "
+                                 "archived.".format(counts,
+                                                    len(self.players_online),
+                                                    archived))
+        cached = [(x, shelf[x]) for x in ("players", "planets", "ships")
+                  if hasattr(shelf[x], "cached")]
+        if cached:
+            send_message(connection, "Decoded: {}.".format(", ".join(
+                "{} of {} {}".format(x.cached, len(x), name)
+                for name, x in cached)))
+        send_message(connection, "Last save: {} records, {} bytes in {:.1f} "
+                                 "ms; journal: {} bytes."
+                     .format(shelf.last_sync_records, shelf.last_sync_bytes,
+                             shelf.last_sync_time * 1000, shelf.journal_bytes))
+        if self.last_prune is not None:
+            when, players, planets = self.last_prune
+            send_message(connection, "Last pruned {:%Y-%m-%d %H:%M}: {} "
+                                     "players archived, {} planets dropped."
+                         .format(when, players, planets))
+        rss = memory_usage()
+        if rss is not None:
+            send_message(connection, "Server memory: {:.1f} MB."
+                         .format(rss / 2 ** 20))
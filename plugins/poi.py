@@ -21,6 +21,7 @@ from utilities import Command, send_message, SystemLocationType
 class POI(StorageCommandPlugin):
     name = "poi"
     depends = ["command_dispatcher"]
+    storage_check_interval = None
 
     def __init__(self):
         super().__init__()
@@ -129,6 +130,7 @@ class POI(StorageCommandPlugin):
                          "You must be standing on a planet for this to work.")
             return
         self.storage["pois"][poi_name] = planet
+        self.storage.touch()
         send_message(connection,
                      "POI {} added to list!".format(poi_name))
 
@@ -151,6 +153,7 @@ class POI(StorageCommandPlugin):
         poi_name = " ".join(data).lower()
         if poi_name in self.storage["pois"]:
             self.storage["pois"].pop(poi_name)
+            self.storage.touch()
             send_message(connection,
                          "Deleted POI {}.".format(poi_name))
         else:
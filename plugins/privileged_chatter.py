@@ -69,8 +69,7 @@ class PrivilegedChatter(SimpleCommandPlugin):
                 sender = connection.player.name
             send_mode = ChatReceiveMode.BROADCAST
             channel = ""
-            for uuid in self.plugins["player_manager"].players_online:
-                p = self.plugins["player_manager"].get_player_by_uuid(uuid)
+            for p in self.plugins["player_manager"].players_online.players():
                 if p.perm_check("privileged_chatter.modchat"):
                     send_message(p.connection,
                                             "{}{}^reset;".format(
@@ -108,8 +107,7 @@ class PrivilegedChatter(SimpleCommandPlugin):
                                     name=sender,
                                     mode=send_mode,
                                     channel=channel)
-            for uuid in self.plugins["player_manager"].players_online:
-                p = self.plugins["player_manager"].get_player_by_uuid(uuid)
+            for p in self.plugins["player_manager"].players_online.players():
                 if p.perm_check("privileged_chatter.modchat"):
                     mods_online = True
                     send_message(p.connection,
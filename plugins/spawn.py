@@ -22,6 +22,7 @@ from utilities import Command, send_message, SystemLocationType
 class Spawn(StorageCommandPlugin):
     name = "spawn"
     depends = ["command_dispatcher"]
+    storage_check_interval = None
 
     def __init__(self):
         super().__init__()
@@ -110,6 +111,7 @@ class Spawn(StorageCommandPlugin):
                          "You must be standing on a planet for this to work.")
             return
         self.storage["spawn"]["spawn_location"] = planet
+        self.storage.touch()
         send_message(connection, "Spawn planet set to {}.".format(str(planet)))
 
     @Command("show_spawn",
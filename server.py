@@ -9,7 +9,8 @@ from data_parser import ChatReceived
 from packets import packets
 from pparser import build_packet
 from plugin_manager import PluginManager
-from utilities import path, read_packet, State, Direction, ChatReceiveMode
+from utilities import path, read_packet, State, Direction, ChatReceiveMode, \
+    tasks
 from zstd_reader import ZstdFrameReader
 from zstd_writer import ZstdFrameWriter
 
@@ -198,6 +199,7 @@ class StarryPyServer:
             self._client_writer.close()
             self._server_loop_future.cancel()
             self._client_loop_future.cancel()
+            tasks.cancel(connection=self)
             self.factory.remove(self)
             self.state = State.DISCONNECTED
             self._alive = False
@@ -263,6 +265,7 @@ class ServerFactory:
         :return: Null.
         """
         self.connections.remove(connection)
+        self.plugin_manager.release_connection(connection)
 
     def __call__(self, reader, writer):
         """
@@ -0,0 +1,473 @@
+"""
+Storage engines for the player database.
+
+Every engine is a `utilities.Cupboard`: a Shelf of top-level values, with
+dicts kept in memory as TrackedDicts and saved one record per key. They
+differ in where the records go:
+
+- "dbm": `utilities.Cupboard`, a dbm file.
+- "sqlite": `SqliteCupboard`, an SQLite database in WAL mode, with tables
+  (and indexes) of their own for players, bans and plugin data.
+
+`open_storage` opens the engine named in the config, and copies an
+existing dbm database over the first time another engine is used. Either
+engine can keep a journal (see `utilities.Cupboard.flush`), and load records
+lazily (see `utilities.LazyDict`).
+
+`PlayerArchive` is the cold store players who haven't been seen in a long
+time are moved to, out of whichever engine is in use.
+
+`backup` writes a compressed snapshot of any of these, taken without
+stopping the server, and `expire_backups` keeps the number of them down.
+"""
+
+import dbm
+import logging
+import os
+import pickle
+import shutil
+import sqlite3
+import tarfile
+import tempfile
+import threading
+from itertools import islice
+from pathlib import Path
+
+from utilities import Cupboard, Tracked
+
+
+class SqliteCupboard(Cupboard):
+    """
+    Cupboard kept in an SQLite database.
+
+    Players, bans and plugin data each get a table keyed by uuid, IP and
+    plugin name; players also have indexed name, alias and IP columns that
+    `find` queries. Everything else goes into a generic `records` table.
+    """
+    # Top-level key: (table, key column, indexed columns)
+    _tables = {
+        b"players": ("players", "uuid", ("name", "alias", "ip")),
+        b"bans": ("bans", "ip", ()),
+        b"plugins": ("plugin_data", "plugin", ()),
+    }
+    _schema = """
+        CREATE TABLE IF NOT EXISTS sections (
+            section TEXT PRIMARY KEY,
+            value BLOB
+        );
+        CREATE TABLE IF NOT EXISTS records (
+            section TEXT,
+            key BLOB,
+            value BLOB,
+            PRIMARY KEY (section, key)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS players (
+            uuid TEXT PRIMARY KEY,
+            name TEXT COLLATE NOCASE,
+            alias TEXT COLLATE NOCASE,
+            ip TEXT,
+            value BLOB
+        );
+        CREATE INDEX IF NOT EXISTS players_name ON players (name);
+        CREATE INDEX IF NOT EXISTS players_alias ON players (alias);
+        CREATE INDEX IF NOT EXISTS players_ip ON players (ip);
+        CREATE TABLE IF NOT EXISTS bans (
+            ip TEXT PRIMARY KEY,
+            value BLOB
+        );
+        CREATE TABLE IF NOT EXISTS plugin_data (
+            plugin TEXT PRIMARY KEY,
+            value BLOB
+        );
+    """
+
+    def __init__(self, filename, flag='c', protocol=None, keyencoding='utf-8',
+                 journal=None, lazy=None):
+        # Writes happen in worker threads, one at a time (see
+        # Cupboard._write); `find` has a connection of its own.
+        self._conn = sqlite3.connect(filename, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(self._schema)
+        self._reader = None
+        super().__init__(filename, flag, protocol, keyencoding, journal,
+                         lazy)
+
+    def _read(self):
+        conn = self._conn
+        for section, value in conn.execute(
+                "SELECT section, value FROM sections"):
+            yield section.encode(self.keyencoding), None, value
+        for section, (table, column, _) in self._tables.items():
+            for key, value in conn.execute(
+                    "SELECT {}, value FROM {}".format(column, table)):
+                yield section, key, value
+        for section, key, value in conn.execute(
+                "SELECT section, key, value FROM records"):
+            yield (section.encode(self.keyencoding), self._load_key(key),
+                   value)
+
+    def _fields(self, top, record):
+        try:
+            columns = self._tables[top][2]
+        except KeyError:
+            return None
+        return tuple(getattr(record, x, None) for x in columns)
+
+    def _table(self, top, key):
+        if isinstance(key, str):
+            return self._tables.get(top)
+        return None
+
+    def _store(self, batch):
+        conn = self._conn
+        with conn:
+            for top in batch.purge:
+                section = top.decode(self.keyencoding)
+                conn.execute("DELETE FROM sections WHERE section = ?",
+                             (section,))
+                conn.execute("DELETE FROM records WHERE section = ?",
+                             (section,))
+                if top in self._tables:
+                    conn.execute("DELETE FROM {}".format(
+                        self._tables[top][0]))
+            for top, key in batch.delete:
+                table = self._table(top, key)
+                if table is not None:
+                    conn.execute("DELETE FROM {} WHERE {} = ?".format(
+                        *table[:2]), (key,))
+                else:
+                    conn.execute("DELETE FROM records WHERE section = ? "
+                                 "AND key = ?",
+                                 (top.decode(self.keyencoding),
+                                  self._dump_key(key)))
+            for top in batch.sections:
+                conn.execute("INSERT OR REPLACE INTO sections VALUES (?, ?)",
+                             (top.decode(self.keyencoding), None))
+            for (top, key), data in batch.write.items():
+                if key is None:
+                    conn.execute("INSERT OR REPLACE INTO sections "
+                                 "VALUES (?, ?)",
+                                 (top.decode(self.keyencoding), data))
+                    continue
+                table = self._table(top, key)
+                if table is None:
+                    conn.execute("INSERT OR REPLACE INTO records "
+                                 "VALUES (?, ?, ?)",
+                                 (top.decode(self.keyencoding),
+                                  self._dump_key(key), data))
+                    continue
+                name, column, indexed = table
+                fields = batch.fields.get((top, key), ())
+                conn.execute("INSERT OR REPLACE INTO {} ({}) VALUES ({})"
+                             .format(name,
+                                     ", ".join((column,) + indexed +
+                                               ("value",)),
+                                     ", ".join("?" * (len(indexed) + 2))),
+                             (key,) + tuple(fields) + (data,))
+
+    def find(self, section, column, value):
+        """
+        Looks up records by an indexed column (case-insensitively for names
+        and aliases). This queries what was last saved, so callers should
+        check the records they get against the current values, and not rely
+        on finding records changed since.
+
+        :param section: Top-level key, e.g. "players".
+        :param column: Indexed column, e.g. "ip".
+        :param value: Value to look for.
+        :return: List of record keys.
+        """
+        table, key, indexed = self._tables[section.encode(self.keyencoding)]
+        if column not in indexed:
+            raise ValueError("{} isn't indexed in {}.".format(column, table))
+        if self._reader is None:
+            self._reader = sqlite3.connect(self.db)
+        return [x for x, in self._reader.execute(
+            "SELECT {} FROM {} WHERE {} = ?".format(key, table, column),
+            (value,))]
+
+    def _copy(self, directory):
+        # SQLite's online backup, for a consistent copy of the database
+        # (and whatever of its WAL has been committed).
+        target = str(Path(directory) / Path(self.db).name)
+        source = sqlite3.connect(self.db)
+        try:
+            copy = sqlite3.connect(target)
+            try:
+                source.backup(copy)
+            finally:
+                copy.close()
+        finally:
+            source.close()
+        return [target]
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            if self._reader is not None:
+                self._reader.close()
+                self._reader = None
+            self._conn.close()
+
+
+ENGINES = {"dbm": Cupboard, "sqlite": SqliteCupboard}
+
+
+def open_storage(engine, filename, migrate_from=None, logger=None,
+                 journal=False, lazy=None):
+    """
+    Opens a storage engine. If its database doesn't exist yet but a dbm
+    database does at `migrate_from`, the dbm database is copied into it
+    (and left in place, untouched). The copy is only moved into place once
+    it is complete.
+
+    :param engine: Name of the engine, a key of ENGINES.
+    :param filename: Database file.
+    :param migrate_from: dbm database to migrate from, if any.
+    :param logger: Logger to report a migration to.
+    :param journal: Whether to keep a journal, in `filename` + ".journal".
+    :param lazy: Top-level keys to load lazily, with their cache sizes (see
+                 `utilities.LazyDict`).
+    :return: The opened Cupboard.
+    """
+    if logger is None:
+        logger = logging.getLogger("starrypy.storage")
+    try:
+        cls = ENGINES[engine]
+    except KeyError:
+        raise ValueError("Unknown storage engine {}.".format(engine))
+    migrate = (cls is not Cupboard and migrate_from is not None
+               and not Path(filename).exists()
+               and dbm.whichdb(str(migrate_from)))
+    if migrate:
+        _migrate(cls, filename, migrate_from, logger, engine)
+    storage = cls(filename,
+                  journal=str(filename) + ".journal" if journal else None,
+                  lazy=lazy)
+    return storage
+
+
+def _migrate(cls, filename, migrate_from, logger, engine):
+    # Copied into a file of its own and only moved into place once synced,
+    # so an interrupted migration is started over rather than leaving an
+    # incomplete database behind.
+    partial = str(filename) + ".part"
+    for leftover in (partial, partial + "-wal", partial + "-shm"):
+        if os.path.exists(leftover):
+            os.remove(leftover)
+    logger.info("Migrating %s to the %s storage engine.", migrate_from,
+                engine)
+    storage = cls(partial)
+    old = Cupboard(str(migrate_from), "r")
+    try:
+        for top, value in old.dict.items():
+            if isinstance(value, dict):
+                # A fresh TrackedDict, with every record to be written.
+                value = dict(value)
+            elif isinstance(value, Tracked):
+                value.touch()
+            storage[top.decode(storage.keyencoding)] = value
+        storage.sync()
+        logger.info("Migrated %d records.", storage.last_sync_records)
+    finally:
+        # Read-only; don't let closing it try to write.
+        old.dict = None
+        storage.close()
+    os.replace(partial, str(filename))
+
+
+class PlayerArchive:
+    """
+    Cold store for players pruned from the player database: a dbm file of
+    pickled players keyed by uuid, along with entries listing the uuids of
+    the players with each (lowercased) name, alias and IP. Nothing is read
+    until a player isn't found among the current ones, and the file isn't
+    even opened until then.
+
+    `add` and `discard` are safe to run in a worker thread while lookups go
+    on in the event loop (or other worker threads). They take the lock a
+    batch of players at a time, so a lookup never waits for a whole prune.
+    """
+    _columns = {"name": b"n", "alias": b"a", "ip": b"i"}
+    _batch = 100
+
+    def __init__(self, filename):
+        self.filename = str(filename)
+        self._db = None
+        self._lock = threading.Lock()
+
+    def _open(self, create=False):
+        if self._db is None:
+            if not create and not dbm.whichdb(self.filename):
+                return None
+            self._db = dbm.open(self.filename, "c")
+        return self._db
+
+    @staticmethod
+    def _key(prefix, value):
+        return prefix + str(value).lower().encode("utf-8")
+
+    def add(self, players):
+        """
+        Archives players, replacing any earlier copies.
+
+        :param players: Iterable of (uuid, name, alias, ip, pickled player).
+        :return: Number of players archived.
+        """
+        count = 0
+        for batch in self._batches(players):
+            with self._lock:
+                db = self._open(create=True)
+                for uuid, name, alias, ip, data in batch:
+                    db[self._key(b"p", uuid)] = data
+                    for prefix, value in ((b"n", name), (b"a", alias),
+                                          (b"i", ip)):
+                        key = self._key(prefix, value)
+                        uuids = pickle.loads(db[key]) if key in db else set()
+                        if uuid not in uuids:
+                            uuids.add(uuid)
+                            db[key] = pickle.dumps(uuids, 4)
+                    count += 1
+        with self._lock:
+            self._sync(self._open(create=True))
+        return count
+
+    def discard(self, uuids):
+        """
+        Removes players from the archive. Entries for their names, aliases
+        and IPs are left to point at nothing, which `get` tolerates.
+
+        :param uuids: Iterable of uuids.
+        :return: Null.
+        """
+        for batch in self._batches(uuids):
+            with self._lock:
+                db = self._open()
+                if db is None:
+                    return
+                for uuid in batch:
+                    try:
+                        del db[self._key(b"p", uuid)]
+                    except KeyError:
+                        pass
+        with self._lock:
+            db = self._open()
+            if db is not None:
+                self._sync(db)
+
+    def _batches(self, items):
+        items = iter(items)
+        while True:
+            batch = list(islice(items, self._batch))
+            if not batch:
+                return
+            yield batch
+
+    @staticmethod
+    def _sync(db):
+        try:
+            db.sync()
+        except AttributeError:
+            pass
+
+    def get(self, uuid):
+        """
+        :param uuid: Player uuid.
+        :return: The archived Player, or None.
+        """
+        with self._lock:
+            db = self._open()
+            if db is None:
+                return None
+            data = db.get(self._key(b"p", uuid))
+        return None if data is None else pickle.loads(data)
+
+    def find(self, column, value):
+        """
+        Looks up archived players by name, alias or IP (case-insensitively).
+
+        :param column: "name", "alias" or "ip".
+        :param value: Value to look for.
+        :return: List of uuids, which may include players no longer in the
+                 archive.
+        """
+        with self._lock:
+            db = self._open()
+            if db is None:
+                return []
+            data = db.get(self._key(self._columns[column], value))
+        return [] if data is None else sorted(pickle.loads(data))
+
+    def snapshot(self, directory):
+        """
+        Copies the archive into `directory`, like `Cupboard.snapshot`.
+
+        :param directory: Existing directory to copy into.
+        :return: List of the files written.
+        """
+        files = []
+        with self._lock:
+            if self._db is not None:
+                self._sync(self._db)
+            for suffix in Cupboard.dbm_suffixes:
+                source = Path(self.filename + suffix)
+                if source.is_file():
+                    files.append(shutil.copy2(source, directory))
+        return files
+
+    def __len__(self):
+        with self._lock:
+            db = self._open()
+            if db is None:
+                return 0
+            return sum(1 for x in db.keys() if x[:1] == b"p")
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+def backup(path, *stores):
+    """
+    Writes a gzipped tar of snapshots of `stores` (Cupboards, or anything
+    else with a `snapshot` method) to `path`. Each store is only locked
+    while it is being copied, and the compressing is done after. Meant for
+    a worker thread.
+
+    :param path: File to write; only appears once it is complete.
+    :param stores: Stores to back up.
+    :return: Size of the backup in bytes.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    partial = path.with_name(path.name + ".part")
+    with tempfile.TemporaryDirectory(dir=path.parent) as tmp:
+        files = []
+        for store in stores:
+            files.extend(store.snapshot(tmp))
+        with tarfile.open(partial, "w:gz") as tar:
+            for name in files:
+                tar.add(name, arcname=Path(name).name)
+    os.replace(partial, path)
+    return path.stat().st_size
+
+
+def expire_backups(directory, pattern, keep):
+    """
+    Deletes all but the newest `keep` backups matching `pattern` (a glob),
+    going by their names, which should sort by age (a fixed prefix and a
+    timestamp, say).
+
+    :param directory: Directory the backups are in.
+    :param pattern: Glob matching the backups.
+    :param keep: Number of backups to keep.
+    :return: List of the backups deleted.
+    """
+    backups = sorted(Path(directory).glob(pattern), reverse=True)
+    for old in backups[keep:]:
+        old.unlink()
+    return backups[keep:]
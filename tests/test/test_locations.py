@@ -0,0 +1,49 @@
+import pickle
+
+from nose.tools import *
+
+from plugins.player_manager import Planet, Player, Ship, intern_location
+
+
+class TestLocations:
+    def test_planet_keys(self):
+        """
+        A planet's key is what it was logged under and what it prints as,
+        and follows its coordinates without being saved.
+
+        :return: Null.
+        """
+        planet = Planet((1, -2, 3), 4, 0)
+        assert_equal(planet.key, Planet.make_key((1, -2, 3), 4, 0))
+        assert_equal(str(planet), "CelestialWorld:1:-2:3:4:0")
+        assert_not_in("_key", planet.__getstate__())
+        planet.satellite = 2
+        assert_equal(str(planet), "CelestialWorld:1:-2:3:4:2")
+
+    def test_unpickled_players_share_locations(self):
+        """
+        Players unpickled while the planets and ships shelves are set share
+        their Planet and Ship objects, unless those aren't in the database.
+
+        :return: Null.
+        """
+        home = Planet((1, 2, 3), 4, 0)
+        ship = Ship("u1", "Bob")
+        player = Player("u1")
+        player.location = Planet((1, 2, 3), 4, 0)
+        player.last_location = ship
+        data = pickle.dumps(player)
+        Planet.interned = {home.key: home}
+        Ship.interned = {}
+        try:
+            loaded = pickle.loads(data)
+            assert_is(loaded.location, home)
+            assert_is_not(loaded.last_location, ship)
+            Ship.interned[ship.key] = ship
+            assert_is(pickle.loads(data).last_location, ship)
+            instance = "".join(["InstanceWorld:", "outpost:-"])
+            assert_is(intern_location(instance),
+                      intern_location("InstanceWorld:outpost:-"))
+        finally:
+            Planet.interned = Ship.interned = None
+        assert_is_not(pickle.loads(data).location, home)
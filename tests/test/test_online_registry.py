@@ -0,0 +1,71 @@
+from nose.tools import *
+
+from plugins.player_manager import OnlineRegistry, Player
+
+
+class Connection:
+    pass
+
+
+def join(registry, n):
+    player = Player("u{}".format(n), "human", "Name{}".format(n),
+                    "Name{}".format(n), None, set(), True, Connection(), n,
+                    "10.0.0.1", "", False)
+    registry.add(player)
+    return player
+
+
+def leave(registry, player):
+    player.connection = None
+    player.client_id = -1
+    player.logged_in = False
+    return registry.discard(player)
+
+
+class TestOnlineRegistry:
+    def test_lookups(self):
+        """
+        Online players are found by uuid, client ID and connection, and not
+        once they have left, even though their client ID and connection
+        are cleared first.
+
+        :return: Null.
+        """
+        registry = OnlineRegistry()
+        alice = join(registry, 1)
+        bob = join(registry, 2)
+        connection = bob.connection
+        assert_equal(len(registry), 2)
+        assert_in("u2", registry)
+        assert_is(registry.get("u2"), bob)
+        assert_is(registry.by_client_id(2), bob)
+        assert_is(registry.by_connection(connection), bob)
+        assert_true(leave(registry, bob))
+        assert_false(leave(registry, bob))
+        assert_not_in("u2", registry)
+        assert_is_none(registry.get("u2"))
+        assert_is_none(registry.by_client_id(2))
+        assert_is_none(registry.by_connection(connection))
+        assert_is(registry.by_client_id(1), alice)
+        assert_equal(list(registry), ["u1"])
+
+    def test_snapshots(self):
+        """
+        Players can leave while the registry is being iterated over, and
+        the snapshot of who is online only changes when someone does.
+
+        :return: Null.
+        """
+        registry = OnlineRegistry()
+        players = [join(registry, n) for n in range(5)]
+        version = registry.version
+        snapshot = registry.players()
+        assert_equal(snapshot, tuple(players))
+        assert_is(registry.players(), snapshot)
+        for uuid in registry:
+            leave(registry, registry.get(uuid))
+        assert_equal(len(registry), 0)
+        assert_equal(registry.version, version + 5)
+        assert_equal(registry.players(), ())
+        rejoined = join(registry, 3)
+        assert_equal(registry.players(), (rejoined,))
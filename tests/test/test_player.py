@@ -0,0 +1,120 @@
+import pickle
+
+from nose.tools import *
+
+from plugins.player_manager import Player, PlayerManager, share
+
+
+def rank_table():
+    return PlayerManager._rebuild_ranks(None, {
+        "Guest": {"permissions": ["general_commands.who"], "priority": 0,
+                  "prefix": ""},
+        "Admin": {"permissions": ["player_manager.kick"],
+                  "inherits": ["Guest"], "priority": 100,
+                  "prefix": "^red;"}})
+
+
+class TestPlayer:
+    def test_shared_permissions(self):
+        """
+        Players with the same ranks share their ranks and permissions;
+        grants and revocations are applied on top.
+
+        :return: Null.
+        """
+        ranks = rank_table()
+        alice = Player("u1", ranks={"Guest", "Admin"})
+        bob = Player("u2", ranks={"admin", "guest"})
+        alice.update_ranks(ranks)
+        bob.update_ranks(ranks)
+        assert_is(alice.ranks, bob.ranks)
+        assert_is(alice.permissions, bob.permissions)
+        assert_equal(alice.priority, 100)
+        assert_true(alice.perm_check("Player_Manager.Kick"))
+        bob.revoked_perms = share(bob.revoked_perms | {"player_manager.kick"})
+        bob.granted_perms = share({"poi.set_poi"})
+        bob.update_ranks(ranks)
+        assert_false(bob.perm_check("player_manager.kick"))
+        assert_true(bob.perm_check("poi.set_poi"))
+        assert_true(bob.perm_check("general_commands.who"))
+        assert_true(alice.perm_check("player_manager.kick"))
+        assert_false(alice.perm_check("poi.set_poi"))
+
+    def test_old_records_load(self):
+        """
+        Records saved before players had slots load, with their stored
+        permissions worked out again and attributes that are no longer
+        saved left out; saved again, they load the same.
+
+        :return: Null.
+        """
+        Player.rank_table = rank_table()
+        try:
+            player = Player.__new__(Player)
+            player.__setstate__(dict(
+                uuid="u1", species="human", name="Bob", alias="Bob",
+                ranks={"Guest"}, granted_perms=set(), revoked_perms=set(),
+                permissions={"stale.permission"}, chat_prefix="",
+                priority=0, logged_in=False, client_id=-1, ip="1.2.3.4",
+                location=None, last_location=None, muted=False,
+                team_id=None, warned=12345.0, seen_before=True))
+            assert_true(player.perm_check("general_commands.who"))
+            assert_false(player.perm_check("stale.permission"))
+            assert_false(hasattr(player, "warned"))
+            assert_is(player.ranks, share({"Guest"}))
+            loaded = pickle.loads(pickle.dumps(player))
+            assert_equal(loaded.__getstate__(), player.__getstate__())
+            assert_true(loaded.seen_before)
+        finally:
+            Player.rank_table = None
+
+    def test_permission_bits(self):
+        """
+        Checking permissions as bitsets gives the same answers as checking
+        the sets, and follows changes to grants and revocations.
+
+        :return: Null.
+        """
+        ranks = rank_table()
+        ranks["owner"] = {"permissions": share({"special.allperms"}),
+                          "priority": 1000, "prefix": ""}
+        players = [Player("u1", ranks={"Guest"}),
+                   Player("u2", ranks={"Admin"}),
+                   Player("u3", ranks={"owner"}),
+                   Player("u4")]
+        players[1].revoked_perms = share({"general_commands.who"})
+        players[3].granted_perms = share({"poi.set_poi"})
+        checks = ["general_commands.who", "General_Commands.WHO",
+                  "player_manager.kick", "poi.set_poi", "not.a.permission",
+                  ""]
+
+        def check_all():
+            for player in players:
+                player.update_ranks(ranks)
+                expected = [player.perm_check(x) for x in checks]
+                Player.rank_table = ranks
+                try:
+                    assert_equal([player.perm_check(x) for x in checks],
+                                 expected)
+                    # Cached, so the same again.
+                    assert_equal([player.perm_check(x) for x in checks],
+                                 expected)
+                finally:
+                    Player.rank_table = None
+
+        check_all()
+        assert_false(players[1].perm_check("general_commands.who"))
+        assert_true(players[2].perm_check("not.a.permission"))
+        Player.rank_table = ranks
+        try:
+            assert_false(players[0].perm_check("poi.set_poi"))
+            players[0].granted_perms = share({"poi.set_poi"})
+            assert_true(players[0].perm_check("poi.set_poi"))
+            # Every bit is set, so there is no mask to look up.
+            assert_true(players[2].perm_check("never.checked"))
+            assert_true(players[2].perm_check("never.checked"))
+            assert_not_in("never.checked", ranks.masks)
+        finally:
+            Player.rank_table = None
+        players[1].revoked_perms = share(())
+        check_all()
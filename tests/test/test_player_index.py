@@ -0,0 +1,109 @@
+import random
+
+from nose.tools import *
+
+from plugins.player_manager import Player, PlayerIndex
+
+
+def make_player(n, ip=None):
+    return Player("u{}".format(n), "human", "^red;Name{}".format(n),
+                  "Name{}".format(n), None, set(), False, None, -1,
+                  ip or "10.0.0.{}".format(n % 4), "", False)
+
+
+def rebuilt(players):
+    index = PlayerIndex(players)
+    for _ in index.build():
+        pass
+    return index
+
+
+def normalised(index):
+    return {column: {k: v if isinstance(v, set) else {v}
+                     for k, v in index.values[column].items()}
+            for column in index.columns}
+
+
+class TestPlayerIndex:
+    def test_stays_consistent(self):
+        """
+        After any mix of renames, IP changes, logins, logouts, additions
+        and removals, the index matches one built from scratch.
+
+        :return: Null.
+        """
+        rng = random.Random(46)
+        players = {}
+        index = PlayerIndex(players)
+        Player.index = index
+        try:
+            for n in range(20):
+                player = make_player(n)
+                players[player.uuid] = player
+            for _ in index.build(chunk=7):
+                pass
+            next_uuid = 20
+            client_id = 0
+            for _ in range(2000):
+                player = players[rng.choice(sorted(players))]
+                action = rng.randrange(7)
+                if action == 0:
+                    player.name = "Name{}".format(rng.randrange(30))
+                elif action == 1:
+                    player.alias = rng.choice(["Bob", "bob", "Alice",
+                                               player.alias.upper()])
+                elif action == 2:
+                    player.ip = "10.0.0.{}".format(rng.randrange(4))
+                elif action == 3:
+                    client_id += 1
+                    player.client_id = client_id
+                    player.logged_in = True
+                elif action == 4:
+                    player.logged_in = False
+                    player.client_id = -1
+                elif action == 5 and len(players) > 1:
+                    del players[player.uuid]
+                    index.remove(player)
+                    # Changes to players no longer in the database don't
+                    # touch the index.
+                    player.alias = "Gone"
+                else:
+                    player = make_player(next_uuid)
+                    next_uuid += 1
+                    players[player.uuid] = player
+                    index.add(player)
+                assert_equal(normalised(index), normalised(rebuilt(players)))
+        finally:
+            Player.index = None
+
+    def test_lookups(self):
+        """
+        Names and aliases are found case-insensitively, and IPs exactly.
+
+        :return: Null.
+        """
+        players = {}
+        index = PlayerIndex(players)
+        Player.index = index
+        try:
+            for n in range(3):
+                player = make_player(n, ip="1.2.3.4")
+                players[player.uuid] = player
+            for _ in index.build():
+                pass
+            assert_true(index.ready)
+            assert_equal([x.uuid for x in index.find("alias", "NAME1")],
+                         ["u1"])
+            assert_equal([x.uuid for x in index.find("name", "^RED;name2")],
+                         ["u2"])
+            assert_equal(sorted(x.uuid for x in index.find("ip", "1.2.3.4")),
+                         ["u0", "u1", "u2"])
+            assert_equal(index.find("alias", "nobody"), [])
+            # Players that aren't in the database aren't indexed.
+            stranger = make_player(9, ip="1.2.3.4")
+            stranger.alias = "Name1"
+            assert_equal([x.uuid for x in index.find("alias", "name1")],
+                         ["u1"])
+            assert_equal(len(index.find("ip", "1.2.3.4")), 3)
+        finally:
+            Player.index = None
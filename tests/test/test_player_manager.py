@@ -0,0 +1,205 @@
+import asyncio
+import logging
+import os
+import pickle
+import shutil
+import tempfile
+import types
+from pathlib import Path
+
+from nose.tools import *
+
+from configuration_manager import ConfigurationManager
+from events import PlayerJoined, PlayerLeft
+from plugins.player_manager import Planet, Player, PlayerIndex, \
+    PlayerManager
+from storage import PlayerArchive, open_storage
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+def started(tmp, **plugin_config):
+    """
+    A PlayerManager started the way the plugin manager starts it, with its
+    database and permissions in `tmp`. Stop it with `stopped`.
+    """
+    os.makedirs(os.path.join(tmp, "config"), exist_ok=True)
+    shutil.copy("config/permissions.json.default",
+                os.path.join(tmp, "config", "permissions.json"))
+    plugin_config.setdefault("player_db", os.path.join(tmp, "player"))
+    plugin_config.setdefault("archive_db", os.path.join(tmp, "archive"))
+    config = ConfigurationManager()
+    config._config = {"plugins": {"player_manager": plugin_config}}
+    PlayerManager.config = config
+    PlayerManager.logger = logging.getLogger("starrypy.plugin.player_manager")
+    cwd = os.getcwd()
+    os.chdir(tmp)
+    try:
+        return PlayerManager()
+    except BaseException:
+        del PlayerManager.config, PlayerManager.logger
+        raise
+    finally:
+        os.chdir(cwd)
+
+
+async def stopped(pm):
+    try:
+        await pm.deactivate()
+    finally:
+        del PlayerManager.config, PlayerManager.logger
+
+
+class Connection:
+    state = None
+
+
+def manager(archive):
+    # Just enough of a PlayerManager to look players up.
+    pm = PlayerManager.__new__(PlayerManager)
+    pm.shelf = {"players": {}}
+    pm.players = pm.shelf["players"]
+    pm.index = PlayerIndex(pm.players)
+    for _ in pm.index.build():
+        pass
+    pm.archive = archive
+    pm._restored = set()
+    pm.logger = logging.getLogger("test")
+    return pm
+
+
+class TestStartup:
+    def test_starts_and_reopens(self):
+        """
+        The player manager starts on a new database and on the one it
+        saved, eagerly and lazily loaded.
+
+        :return: Null.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            for lazy_cache_size in (0, 0, 10):
+                async def go():
+                    pm = started(tmp, lazy_cache_size=lazy_cache_size)
+                    player = await pm._add_or_get_player(
+                        "0123456789abcdef0123456789abcdef", "human", "Bob")
+                    assert_is(pm.get_player_by_uuid(player.uuid), player)
+                    await asyncio.sleep(0)
+                    await stopped(pm)
+                run(go())
+
+
+    def test_planets_rekeyed_lazily(self):
+        """
+        Planets filed under their old keys are moved to their current ones
+        when the database is first loaded lazily, and only then.
+
+        :return: Null.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            shelf = open_storage("dbm", os.path.join(tmp, "player"))
+            planet = Planet((1, 2, 3), 4, 0)
+            shelf["planets"] = {"1:2:3:4:0": planet}
+            shelf.close()
+
+            async def go():
+                pm = started(tmp, lazy_cache_size=10)
+                assert_equal(list(pm.planets), [planet.key])
+                assert_equal(pm.planets[planet.key].satellite, 0)
+                await asyncio.sleep(0)
+                await stopped(pm)
+                pm = started(tmp, lazy_cache_size=10)
+                assert_equal(list(pm.planets), [planet.key])
+                assert_equal(pm.planets.decoded, 0)
+                await asyncio.sleep(0)
+                await stopped(pm)
+            run(go())
+
+
+class TestHooks:
+    def test_join_and_leave_events(self):
+        """
+        A join another plugin refused isn't announced, and players who go
+        offline, kicked or otherwise, are announced as leaving once.
+
+        :return: Null.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            async def go():
+                pm = started(tmp)
+                emitted = []
+                pm.events = types.SimpleNamespace(emit=emitted.append)
+                player = await pm._add_or_get_player(
+                    "0123456789abcdef0123456789abcdef", "human", "Bob")
+                connection = Connection()
+                connection.player = player
+                refused = {"parsed": {"client_id": 1}, "vetoed": True}
+                assert_true(pm.on_connect_success(refused, connection))
+                assert_equal(emitted, [])
+                assert_not_in(player.uuid, pm.players_online)
+                pm.on_connect_success({"parsed": {"client_id": 1}},
+                                      connection)
+                assert_equal([type(x) for x in emitted], [PlayerJoined])
+                assert_in(player.uuid, pm.players_online)
+                pm.kick_player(player)
+                pm._set_offline(connection)
+                assert_equal([type(x) for x in emitted],
+                             [PlayerJoined, PlayerLeft])
+                del pm.events
+                await asyncio.sleep(0)
+                await stopped(pm)
+            run(go())
+
+    def test_no_deadlines(self):
+        """
+        The hooks that apply bans and track connection state are never cut
+        short by a deadline, which would let the packet through unchecked.
+
+        :return: Null.
+        """
+        for hook in (PlayerManager.on_client_connect,
+                     PlayerManager.on_world_start,
+                     PlayerManager.on_player_warp_result):
+            assert_equal(hook.hook_timeout, 0)
+            assert_true(hook.hook_always)
+
+
+class TestArchivedPlayers:
+    def test_lookups_leave_archived_players(self):
+        """
+        Archived players aren't found by the plain lookups; looking them up
+        with find_any_player reads them without restoring them, unless
+        asked to.
+
+        :return: Null.
+        """
+        uuid = "0123456789abcdef0123456789abcdef"
+        player = Player(uuid, "human", "^red;Bob", "Bob", ip="1.2.3.4")
+        with tempfile.TemporaryDirectory() as tmp:
+            archive = PlayerArchive(Path(tmp) / "archive")
+            archive.add([(uuid, player.name, player.alias, player.ip,
+                          pickle.dumps(player, 4))])
+            pm = manager(archive)
+            Player.index = pm.index
+            try:
+                assert_is_none(pm.find_player("bob"))
+                assert_is_none(pm.get_player_by_uuid(uuid))
+                for search in ("BOB", "^red;bob", "1.2.3.4", uuid):
+                    found = run(pm.find_any_player(search))
+                    assert_equal(found.uuid, uuid)
+                assert_equal(pm.players, {})
+                assert_is_none(run(pm.find_any_player("alice")))
+                assert_true(run(pm._alias_taken("bob")))
+                found = run(pm.find_any_player("bob", restore=True))
+                assert_is(pm.players[uuid], found)
+                assert_equal(pm._restored, {uuid})
+                assert_is(pm.find_player("bob"), found)
+                assert_is(run(pm.find_any_player("bob")), found)
+            finally:
+                Player.index = None
+                archive.close()
@@ -1,9 +1,17 @@
 import asyncio
+import tempfile
+import threading
+import types
+from pathlib import Path
+from unittest import TestCase
 
 from nose.tools import *
 
+from configuration_manager import ConfigurationManager
+from events import PlayerJoined, PlayerLeft
 from plugin_manager import PluginManager
-from utilities import path
+from tests.test_plugins.hook_plugins import hooks, isolated
+from utilities import Direction, State, path, tasks
 
 
 class TestPluginManager:
@@ -115,3 +123,463 @@ class TestPluginManager:
                      {'test_plugin_1', 'test_plugin_2'})
 
 
+
+
+def build_manager(*modules):
+    config = ConfigurationManager()
+    config._config = {"min_cache_size": 16, "packet_reap_time": 600,
+                      "plugins": {}}
+    manager = PluginManager(config)
+    for module in modules:
+        manager._seen_classes.update(manager.get_classes(module))
+    manager.resolve_dependencies()
+    return manager
+
+
+def tile_packet():
+    return {"type": 27, "size": 0, "data": b"", "original_data": b"",
+            "direction": 1}
+
+
+def run_do(loop, manager, action, packet):
+    async def dispatch():
+        result = await manager.do(None, action, packet)
+        task = manager.release_connection(None)
+        if task is not None:
+            await task
+        return result
+    return loop.run_until_complete(dispatch())
+
+
+class TestPluginDispatch:
+    def test_dispatch_table_skips_inherited_hooks(self):
+        loop = asyncio.new_event_loop()
+        manager = build_manager(hooks)
+        loop.run_until_complete(manager.activate_all())
+        assert_equal(set(manager._dispatch),
+                     {"tile_update", "tile_array_update", "entity_message",
+                      "tile_damage_update"})
+        assert_not_in("idle", [x.plugin.name for x in
+                               manager._dispatch["tile_update"]])
+
+    def test_dispatch_priority_order(self):
+        loop = asyncio.new_event_loop()
+        manager = build_manager(hooks)
+        loop.run_until_complete(manager.activate_all())
+        names = [x.plugin.name for x in manager._dispatch["tile_update"]]
+        assert_equal(names[0], "early")
+        assert_less(names.index("recorder"), names.index("veto"))
+        assert_less(names.index("veto"), names.index("skipped"))
+        assert_in("early", manager.dump_hook_chains("tile_update"))
+
+    def test_dispatch_table_rebuilt_on_deactivate(self):
+        loop = asyncio.new_event_loop()
+        manager = build_manager(hooks)
+        loop.run_until_complete(manager.activate_all())
+        veto = manager.list_plugins()["veto"]
+        loop.run_until_complete(manager.deactivate_plugin(veto))
+        assert_not_in(
+            "veto", [x.plugin.name for x in manager._dispatch["tile_update"]])
+        result = run_do(loop, manager, "tile_update", tile_packet())
+        assert_true(result)
+        assert_equal(veto.seen, [])
+
+    def test_do_veto_stops_chain(self):
+        loop = asyncio.new_event_loop()
+        manager = build_manager(hooks)
+        loop.run_until_complete(manager.activate_all())
+        plugins = manager.list_plugins()
+        result = run_do(loop, manager, "tile_update", tile_packet())
+        assert_false(result)
+        assert_equal(len(plugins["recorder"].seen), 1)
+        assert_equal(len(plugins["veto"].seen), 1)
+        assert_equal(plugins["skipped"].seen, [])
+        assert_equal(len(plugins["auditor"].seen), 1)
+        assert_true(plugins["auditor"].seen[0]["vetoed"])
+
+    def test_do_without_hooks(self):
+        loop = asyncio.new_event_loop()
+        manager = build_manager(hooks)
+        loop.run_until_complete(manager.activate_all())
+        result = run_do(loop, manager, "chat_sent", tile_packet())
+        assert_true(result)
+
+    def test_sync_and_async_hooks(self):
+        loop = asyncio.new_event_loop()
+        manager = build_manager(hooks)
+        loop.run_until_complete(manager.activate_all())
+        entries = {x.plugin.name: x for x in manager._dispatch["tile_update"]}
+        assert_true(entries["recorder"].is_async)
+        assert_false(entries["veto"].is_async)
+
+    def test_hook_stats(self):
+        loop = asyncio.new_event_loop()
+        manager = build_manager(hooks)
+        manager.slow_hook_threshold = 0
+        loop.run_until_complete(manager.activate_all())
+        run_do(loop, manager, "tile_update", tile_packet())
+        run_do(loop, manager, "tile_update", tile_packet())
+        veto = manager.hook_stats[("veto", "tile_update")]
+        assert_equal(veto.calls, 2)
+        assert_equal(veto.vetoes, 2)
+        assert_equal(veto.slow, 2)
+        assert_equal(manager.hook_stats[("skipped", "tile_update")].calls, 0)
+        observer = manager.hook_stats[("observer", "tile_update")]
+        assert_equal(observer.calls, 2)
+        assert_equal(observer.slow, 2)
+        top = manager.top_hooks(count=100, key="calls")
+        assert_not_in(("skipped", "tile_update"),
+                      [(x.plugin, x.action) for x in top])
+
+    def test_hook_timeouts_fail_open(self):
+        loop = asyncio.new_event_loop()
+        manager = build_manager(hooks)
+        loop.run_until_complete(manager.activate_all())
+        packet = tile_packet()
+        packet["type"] = 26
+        result = run_do(loop, manager, "tile_array_update", packet)
+        assert_true(result)
+        assert_equal(manager.hook_timeouts, 2)
+        plugins = manager.list_plugins()
+        assert_false(plugins["stalled"].finished)
+        assert_false(plugins["detached"].finished)
+        loop.run_until_complete(asyncio.sleep(0.1))
+        assert_false(plugins["stalled"].finished)
+        assert_true(plugins["detached"].finished)
+        assert_equal(
+            manager.hook_stats[("stalled", "tile_array_update")].timeouts, 1)
+
+    def test_always_hooks_have_no_default_deadline(self):
+        loop = asyncio.new_event_loop()
+        manager = build_manager(hooks)
+        manager.hook_timeout = 2.0
+        loop.run_until_complete(manager.activate_all())
+        for table in (manager._dispatch, manager._observers):
+            for entries in table.values():
+                for hook in entries:
+                    declared = hook.method.__dict__.get("hook_timeout")
+                    if declared is not None:
+                        assert_equal(hook.timeout, declared)
+                    elif hook.always:
+                        assert_equal(hook.timeout, 0)
+                    else:
+                        assert_equal(hook.timeout, 2.0)
+        assert_true(any(x.always for entries in manager._dispatch.values()
+                        for x in entries))
+
+    def test_detached_hook_failure_logged_once(self):
+        loop = asyncio.new_event_loop()
+        manager = build_manager(hooks)
+        loop.run_until_complete(manager.activate_all())
+        hook = manager._dispatch["tile_array_update"][0]
+
+        async def boom(data, connection):
+            await asyncio.sleep(0)
+            raise ValueError("boom")
+
+        hook.method = boom
+        hook.timeout = 1
+        hook.timeout_policy = "detach"
+        failed = tasks.failed
+        with TestCase().assertLogs(level="ERROR") as logged:
+            assert_true(loop.run_until_complete(
+                manager._call_with_deadline(hook, tile_packet(), None)))
+            loop.run_until_complete(asyncio.sleep(0))
+        assert_equal(len(logged.output), 1)
+        assert_equal(tasks.failed, failed + 1)
+        assert_equal(tasks.scope_counts("connection"), {})
+
+    def test_observers_run_after_dispatch(self):
+        loop = asyncio.new_event_loop()
+        manager = build_manager(hooks)
+        loop.run_until_complete(manager.activate_all())
+        observer = manager.list_plugins()["observer"]
+        assert_equal([x.method for x in manager._observers["tile_update"]],
+                     [observer.on_tile_update])
+
+        async def dispatch():
+            result = await manager.do(None, "tile_update", tile_packet())
+            seen = len(observer.seen)
+            await manager.release_connection(None)
+            return result, seen
+
+        result, seen = loop.run_until_complete(dispatch())
+        assert_false(result)
+        assert_equal(seen, 0)
+        assert_equal(len(observer.seen), 1)
+
+    def test_observer_queue_drops_when_full(self):
+        loop = asyncio.new_event_loop()
+        manager = build_manager(hooks)
+        manager.config.config.observer_queue_size = 2
+        loop.run_until_complete(manager.activate_all())
+
+        async def dispatch():
+            for _ in range(5):
+                await manager.do(None, "tile_update", tile_packet())
+            dropped = manager._observer_queues[None].dropped
+            await manager.release_connection(None)
+            return dropped
+
+        dropped = loop.run_until_complete(dispatch())
+        assert_equal(dropped, 3)
+        assert_equal(manager.observer_drops, 3)
+
+    def test_event_queue_size(self):
+        config = ConfigurationManager()
+        config._config = {"observer_queue_size": 2, "event_queue_size": 8}
+        assert_equal(PluginManager(config).events.maxsize, 8)
+        config = ConfigurationManager()
+        config._config = {"observer_queue_size": 2}
+        assert_equal(PluginManager(config).events.maxsize, 256)
+
+    def test_observer_calls_cancelled_with_plugin(self):
+        loop = asyncio.new_event_loop()
+        manager = build_manager(hooks)
+        loop.run_until_complete(manager.activate_all())
+        observer = manager.list_plugins()["observer"]
+        hook = manager._observers["tile_update"][0]
+        started = []
+
+        async def stuck(data, connection):
+            started.append(data)
+            await asyncio.sleep(60)
+
+        hook.method = stuck
+
+        async def dispatch():
+            for _ in range(3):
+                await manager.do(None, "tile_update", tile_packet())
+            await asyncio.sleep(0)
+            await asyncio.sleep(0)
+            assert_equal(tasks.scope_counts("plugin").get("observer"), 1)
+            await manager.deactivate_plugin(observer)
+            await asyncio.wait_for(manager.release_connection(None), 1)
+
+        loop.run_until_complete(dispatch())
+        assert_equal(len(started), 1)
+        assert_equal(hook.stats.calls, 1)
+
+    def test_direction_hooks(self):
+        loop = asyncio.new_event_loop()
+        manager = build_manager(hooks)
+        loop.run_until_complete(manager.activate_all())
+        inbound = manager.list_plugins()["inbound"]
+        assert_not_in("entity_message",
+                      manager._routes[Direction.TO_SERVER][0])
+        run_do(loop, manager, "tile_update", tile_packet())
+        assert_equal(inbound.seen, [])
+        packet = tile_packet()
+        packet["direction"] = Direction.TO_CLIENT
+        run_do(loop, manager, "tile_update", packet)
+        assert_equal(len(inbound.seen), 1)
+
+        packet = tile_packet()
+        packet["type"] = 55
+        assert_true(run_do(loop, manager, "entity_message", packet))
+        assert_not_in("parsed", packet)
+        assert_equal(manager.packets_skipped[Direction.TO_SERVER], 1)
+        assert_equal(manager.packets_parsed[Direction.TO_SERVER], 1)
+        assert_equal(manager.packets_parsed[Direction.TO_CLIENT], 1)
+        stats = manager.hook_stats[("recorder", "tile_update")]
+        assert_equal(stats.by_direction, {Direction.TO_SERVER: 1,
+                                          Direction.TO_CLIENT: 1})
+
+    def test_when_predicates_skip_parsing(self):
+        loop = asyncio.new_event_loop()
+        manager = build_manager(hooks)
+        loop.run_until_complete(manager.activate_all())
+        gated = manager.list_plugins()["gated"]
+        connection = types.SimpleNamespace(state=State.CONNECTED)
+
+        async def dispatch(packet, connection):
+            return await manager.do(connection, "tile_damage_update", packet)
+
+        small = tile_packet()
+        small["type"] = 29
+        assert_true(loop.run_until_complete(dispatch(small, connection)))
+        assert_not_in("parsed", small)
+        early = dict(tile_packet(), type=29, size=8)
+        connection.state = State.HANDSHAKE_CHALLENGE_SENT
+        loop.run_until_complete(dispatch(early, connection))
+        assert_not_in("parsed", early)
+        assert_equal(gated.seen, [])
+        stats = manager.hook_stats[("gated", "tile_damage_update")]
+        assert_equal(stats.unmatched, 2)
+        assert_equal(manager.packets_skipped[Direction.TO_SERVER], 2)
+
+        connection.state = State.CONNECTED
+        match = dict(tile_packet(), type=29, size=8)
+        loop.run_until_complete(dispatch(match, connection))
+        assert_in("parsed", match)
+        assert_equal(gated.seen, [match])
+        assert_equal(stats.calls, 1)
+
+    def test_event_bus_delivery(self):
+        loop = asyncio.new_event_loop()
+        manager = build_manager(hooks)
+        loop.run_until_complete(manager.activate_all())
+        plugins = manager.list_plugins()
+        listener = plugins["listener"]
+        slow = plugins["slow_listener"]
+        joined = PlayerJoined("player")
+        left = PlayerLeft("player")
+
+        async def emit():
+            assert_equal(manager.events.emit(joined), 2)
+            assert_equal(manager.events.emit(left), 1)
+            await asyncio.sleep(0.01)
+            # The slow subscriber has its own queue, so it doesn't hold
+            # up delivery to the other one.
+            assert_equal(listener.received, [joined, left])
+            assert_equal(slow.received, [])
+            await manager.deactivate_plugin(slow)
+            assert_equal(manager.events.emit(PlayerJoined("other")), 1)
+            manager.events.rebuild([])
+            await manager.events.drain()
+
+        loop.run_until_complete(emit())
+        assert_equal(slow.received, [joined])
+        assert_equal(len(listener.received), 3)
+
+    def test_isolated_plugin_runs_on_own_loop(self):
+        loop = asyncio.new_event_loop()
+        manager = build_manager(isolated)
+        loop.run_until_complete(manager.activate_all())
+        bridge = manager.list_plugins()["bridge"]
+        assert_equal(bridge.activated_on, "plugins-bridge")
+        assert_is(bridge.loop, manager._isolated["bridge"].loop)
+        result = run_do(loop, manager, "tile_update", tile_packet())
+        assert_false(result)
+        assert_equal(bridge.seen_on, "plugins-bridge")
+        main = threading.current_thread().name
+        assert_equal(loop.run_until_complete(bridge.away()), "plugins-bridge")
+        assert_equal(loop.run_until_complete(bridge.round_trip()), main)
+        assert_equal([x.name for x in manager.loop_lag()], ["main", "bridge"])
+        thread = manager._isolated["bridge"]._thread
+        loop.run_until_complete(manager.deactivate_all())
+        assert_false(thread.is_alive())
+
+    def test_plugin_isolation_disabled(self):
+        loop = asyncio.new_event_loop()
+        manager = build_manager(isolated)
+        manager.plugin_isolation = False
+        loop.run_until_complete(manager.activate_all())
+        bridge = manager.list_plugins()["bridge"]
+        main = threading.current_thread().name
+        assert_equal(bridge.activated_on, main)
+        run_do(loop, manager, "tile_update", tile_packet())
+        assert_equal(bridge.seen_on, main)
+        assert_equal(loop.run_until_complete(bridge.away()), main)
+        loop.run_until_complete(manager.deactivate_all())
+
+
+PROVIDER = """
+from base_plugin import BasePlugin
+
+
+class Provider(BasePlugin):
+    name = "reload_provider"
+
+    def __init__(self):
+        super().__init__()
+        self.storage = {{"version": {version}}}
+
+    def on_tile_update(self, data, connection):
+        return {result}
+"""
+
+CONSUMER = """
+import asyncio
+
+from base_plugin import BasePlugin
+
+
+class Consumer(BasePlugin):
+    name = "reload_consumer"
+    depends = ["reload_provider"]
+
+    async def activate(self):
+        self.provider = self.plugins.reload_provider
+        self.waiter = self.background(asyncio.Event().wait())
+"""
+
+
+class TestPluginReload:
+    def test_reload_replaces_plugin_and_restarts_dependents(self):
+        loop = asyncio.new_event_loop()
+        with tempfile.TemporaryDirectory() as tmp:
+            provider_path = Path(tmp) / "reload_provider.py"
+            consumer_path = Path(tmp) / "reload_consumer.py"
+            provider_path.write_text(PROVIDER.format(version=1,
+                                                     result=False))
+            consumer_path.write_text(CONSUMER)
+            manager = build_manager(
+                PluginManager._load_module(provider_path),
+                PluginManager._load_module(consumer_path))
+            loop.run_until_complete(manager.activate_all())
+            old = manager.list_plugins()["reload_provider"]
+            consumer = manager.list_plugins()["reload_consumer"]
+            old.storage["players"] = 3
+            assert_false(run_do(loop, manager, "tile_update",
+                                tile_packet()))
+
+            provider_path.write_text(PROVIDER.format(version=2,
+                                                     result=True))
+            restarted = loop.run_until_complete(
+                manager.reload_plugin("reload_provider"))
+
+        new = manager.list_plugins()["reload_provider"]
+        assert_equal(restarted, ["reload_provider", "reload_consumer"])
+        assert_is_not(new, old)
+        assert_is(consumer.provider, new)
+        assert_equal(new.storage, {"version": 1, "players": 3})
+        assert_in(new, manager._activated_plugins)
+        assert_not_in(old, manager._activated_plugins)
+        assert_true(run_do(loop, manager, "tile_update", tile_packet()))
+
+    def test_reload_cancels_old_tasks(self):
+        """
+        Reloading cancels the background tasks of the instances it replaces
+        or restarts, and leaves those of the new instances running.
+
+        :return: Null.
+        """
+        loop = asyncio.new_event_loop()
+        with tempfile.TemporaryDirectory() as tmp:
+            provider_path = Path(tmp) / "reload_provider.py"
+            consumer_path = Path(tmp) / "reload_consumer.py"
+            provider_path.write_text(PROVIDER.format(version=1,
+                                                     result=False))
+            consumer_path.write_text(CONSUMER)
+            manager = build_manager(
+                PluginManager._load_module(provider_path),
+                PluginManager._load_module(consumer_path))
+            loop.run_until_complete(manager.activate_all())
+            old = manager.list_plugins()["reload_consumer"].waiter
+            loop.run_until_complete(manager.reload_plugin("reload_consumer"))
+            new = manager.list_plugins()["reload_consumer"].waiter
+            loop.run_until_complete(asyncio.sleep(0))
+            assert_true(old.cancelled())
+            assert_false(new.done())
+            loop.run_until_complete(manager.deactivate_all())
+            loop.run_until_complete(asyncio.sleep(0))
+            assert_true(new.cancelled())
+
+    def test_reload_keeps_plugin_on_import_error(self):
+        loop = asyncio.new_event_loop()
+        with tempfile.TemporaryDirectory() as tmp:
+            provider_path = Path(tmp) / "reload_provider.py"
+            provider_path.write_text(PROVIDER.format(version=1,
+                                                     result=False))
+            manager = build_manager(PluginManager._load_module(provider_path))
+            loop.run_until_complete(manager.activate_all())
+            old = manager.list_plugins()["reload_provider"]
+            provider_path.write_text("class Broken(:\n")
+            with assert_raises(SyntaxError):
+                loop.run_until_complete(
+                    manager.reload_plugin("reload_provider"))
+
+        assert_is(manager.list_plugins()["reload_provider"], old)
+        assert_in(old, manager._activated_plugins)
+        assert_false(run_do(loop, manager, "tile_update", tile_packet()))
@@ -0,0 +1,304 @@
+import asyncio
+import pickle
+import tarfile
+import tempfile
+import threading
+from pathlib import Path
+
+from nose.tools import *
+
+from storage import ENGINES, PlayerArchive, SqliteCupboard, backup, \
+    expire_backups, open_storage
+from utilities import Cupboard, Tracked
+
+
+class Player(Tracked):
+    def __init__(self, uuid, name, alias, ip):
+        self.uuid = uuid
+        self.name = name
+        self.alias = alias
+        self.ip = ip
+
+
+def populate(shelf):
+    shelf["players"] = {"u1": Player("u1", "^red;Bob", "Bob", "1.2.3.4"),
+                        "u2": Player("u2", "Alice", "Alice", "5.6.7.8")}
+    shelf["bans"] = {"9.9.9.9": "reason"}
+    shelf["plugins"] = {"mail": {"mail": {"u1": []}}}
+    shelf["planets"] = {}
+    shelf["version"] = 2
+
+
+class TestSqliteCupboard:
+    def test_round_trip(self):
+        """
+        Everything put in comes back out after reopening, in the tables it
+        belongs in.
+
+        :return: Null.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            db = str(Path(tmp) / "player.sqlite3")
+            shelf = SqliteCupboard(db)
+            populate(shelf)
+            shelf.close()
+            shelf = SqliteCupboard(db)
+            assert_equal(shelf["players"]["u1"].alias, "Bob")
+            assert_equal(shelf["bans"], {"9.9.9.9": "reason"})
+            assert_equal(shelf["plugins"]["mail"], {"mail": {"u1": []}})
+            assert_equal(shelf["planets"], {})
+            assert_equal(shelf["version"], 2)
+            tables = dict(shelf._conn.execute(
+                "SELECT 'players', count(*) FROM players UNION ALL "
+                "SELECT 'plugins', count(*) FROM plugin_data UNION ALL "
+                "SELECT 'bans', count(*) FROM bans"))
+            assert_equal(tables, {"players": 2, "plugins": 1, "bans": 1})
+            assert_equal(shelf._conn.execute(
+                "PRAGMA journal_mode").fetchone()[0], "wal")
+            shelf.close()
+
+    def test_find(self):
+        """
+        `find` looks records up by their indexed columns as last saved,
+        names and aliases case-insensitively.
+
+        :return: Null.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            shelf = SqliteCupboard(str(Path(tmp) / "player.sqlite3"))
+            populate(shelf)
+            shelf.sync()
+            assert_equal(shelf.find("players", "ip", "1.2.3.4"), ["u1"])
+            assert_equal(shelf.find("players", "alias", "bob"), ["u1"])
+            assert_equal(shelf.find("players", "name", "ALICE"), ["u2"])
+            assert_equal(shelf.find("players", "ip", "0.0.0.0"), [])
+            shelf["players"]["u2"].ip = "1.2.3.4"
+            assert_equal(shelf.find("players", "ip", "1.2.3.4"), ["u1"])
+            asyncio.run(shelf.save())
+            assert_equal(sorted(shelf.find("players", "ip", "1.2.3.4")),
+                         ["u1", "u2"])
+            del shelf["players"]["u1"]
+            shelf.sync()
+            assert_equal(shelf.find("players", "ip", "1.2.3.4"), ["u2"])
+            with assert_raises(ValueError):
+                shelf.find("players", "uuid", "u1")
+            shelf.close()
+
+    def test_migration(self):
+        """
+        Opening the SQLite engine for the first time copies an existing dbm
+        database, and only the first time.
+
+        :return: Null.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            old = str(Path(tmp) / "player")
+            new = str(Path(tmp) / "player.sqlite3")
+            shelf = Cupboard(old)
+            populate(shelf)
+            shelf.close()
+            shelf = open_storage("sqlite", new, old)
+            assert_is_instance(shelf, SqliteCupboard)
+            assert_equal(shelf.syncs, 0)
+            assert_equal(sorted(shelf["players"]), ["u1", "u2"])
+            assert_equal(shelf["version"], 2)
+            assert_equal(shelf.find("players", "alias", "alice"), ["u2"])
+            shelf["bans"].clear()
+            shelf.close()
+            shelf = open_storage("sqlite", new, old)
+            assert_equal(shelf.syncs, 0)
+            assert_equal(shelf["bans"], {})
+            assert_equal(shelf["players"]["u1"].name, "^red;Bob")
+            shelf.close()
+            shelf = Cupboard(old)
+            assert_equal(shelf["bans"], {"9.9.9.9": "reason"})
+            shelf.close()
+
+    def test_interrupted_migration(self):
+        """
+        A migration that didn't finish leaves nothing in the database's
+        place, and is started over the next time.
+
+        :return: Null.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            old = str(Path(tmp) / "player")
+            new = str(Path(tmp) / "player.sqlite3")
+            shelf = Cupboard(old)
+            populate(shelf)
+            shelf.close()
+
+            class Interrupted(SqliteCupboard):
+                def sync(self):
+                    raise OSError("No space left on device")
+
+            ENGINES["interrupted"] = Interrupted
+            try:
+                with assert_raises(OSError):
+                    open_storage("interrupted", new, old)
+            finally:
+                del ENGINES["interrupted"]
+            assert_false(Path(new).exists())
+            shelf = open_storage("sqlite", new, old)
+            assert_equal(shelf["version"], 2)
+            assert_equal(shelf["players"]["u2"].alias, "Alice")
+            assert_equal(shelf["bans"], {"9.9.9.9": "reason"})
+            shelf.close()
+            assert_false(Path(new + ".part").exists())
+
+    def test_unknown_engine(self):
+        """
+        Unknown engine names are refused.
+
+        :return: Null.
+        """
+        with assert_raises(ValueError):
+            open_storage("carrier_pigeon", "nowhere")
+
+
+def archived(player):
+    return (player.uuid, player.name, player.alias, player.ip,
+            pickle.dumps(player))
+
+
+class TestPlayerArchive:
+    def test_lookups(self):
+        """
+        Archived players can be found by uuid, and by name, alias and IP
+        case-insensitively; discarded ones can't.
+
+        :return: Null.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = str(Path(tmp) / "player.archive")
+            archive = PlayerArchive(filename)
+            assert_is_none(archive.get("u1"))
+            assert_equal(archive.find("alias", "bob"), [])
+            assert_equal(len(archive), 0)
+            assert_false(Path(tmp, "player.archive.dat").exists())
+            archive.add([archived(Player("u1", "^red;Bob", "Bob", "1.2.3.4")),
+                         archived(Player("u2", "Alice", "Alice", "1.2.3.4"))])
+            archive.close()
+            archive = PlayerArchive(filename)
+            assert_equal(len(archive), 2)
+            assert_equal(archive.get("u1").alias, "Bob")
+            assert_equal(archive.find("alias", "BOB"), ["u1"])
+            assert_equal(archive.find("name", "^red;bob"), ["u1"])
+            assert_equal(archive.find("ip", "1.2.3.4"), ["u1", "u2"])
+            archive.discard(["u1"])
+            assert_is_none(archive.get("u1"))
+            assert_equal(len(archive), 1)
+            archive.add([archived(Player("u1", "Bob", "Robert", "5.6.7.8"))])
+            assert_equal(archive.get("u1").alias, "Robert")
+            assert_equal(archive.find("alias", "robert"), ["u1"])
+            archive.close()
+
+    def test_lookups_during_add(self):
+        """
+        Archiving many players lets lookups in between batches, rather
+        than holding them up until it's done.
+
+        :return: Null.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            archive = PlayerArchive(str(Path(tmp) / "player.archive"))
+            archive._batch = 2
+            seen = []
+
+            def players():
+                for n in range(5):
+                    if n == 3:
+                        # Another thread's lookup gets the lock meanwhile.
+                        thread = threading.Thread(
+                            target=lambda: seen.append(archive.get("u0")))
+                        thread.start()
+                        thread.join(5)
+                    yield archived(Player("u{}".format(n), "Bob", "Bob",
+                                          "1.2.3.4"))
+
+            assert_equal(archive.add(players()), 5)
+            assert_equal([x.uuid for x in seen], ["u0"])
+            assert_equal(len(archive.find("ip", "1.2.3.4")), 5)
+            archive.discard(["u{}".format(n) for n in range(5)])
+            assert_equal(len(archive), 0)
+            archive.close()
+
+
+class TestBackup:
+    def test_backup_restores(self):
+        """
+        A backup of either engine, taken with changes only in the journal,
+        restores everything up to the last flush.
+
+        :return: Null.
+        """
+        for engine in ("dbm", "sqlite"):
+            with tempfile.TemporaryDirectory() as tmp:
+                db = str(Path(tmp) / "live" / "player")
+                Path(db).parent.mkdir()
+                shelf = open_storage(engine, db, journal=True)
+                populate(shelf)
+                shelf.sync()
+                shelf["players"]["u1"].alias = "Robert"
+                asyncio.run(shelf.flush())
+                shelf["players"]["u2"].alias = "unflushed"
+                path = Path(tmp) / "backups" / "player-1.tar.gz"
+                size = backup(path, shelf)
+                shelf.close()
+                assert_equal(size, path.stat().st_size)
+                with tarfile.open(path) as tar:
+                    tar.extractall(Path(tmp) / "restored")
+                shelf = open_storage(engine,
+                                     str(Path(tmp) / "restored" / "player"),
+                                     journal=True)
+                assert_equal(shelf["players"]["u1"].alias, "Robert")
+                assert_equal(shelf["players"]["u2"].alias, "Alice")
+                assert_equal(shelf["bans"], {"9.9.9.9": "reason"})
+                shelf.close()
+
+    def test_saves_wait_without_blocking(self):
+        """
+        A save started during a snapshot waits for it without holding up
+        the event loop.
+
+        :return: Null.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            shelf = SqliteCupboard(str(Path(tmp) / "player.sqlite3"))
+            populate(shelf)
+            shelf.sync()
+            ticks = []
+
+            async def ticker():
+                while True:
+                    ticks.append(shelf.syncs)
+                    await asyncio.sleep(0.005)
+
+            async def go():
+                task = asyncio.ensure_future(ticker())
+                shelf._write_lock.acquire()
+                asyncio.get_running_loop().call_later(
+                    0.1, shelf._write_lock.release)
+                shelf["players"]["u1"].alias = "Robert"
+                await shelf.save()
+                task.cancel()
+
+            asyncio.run(go())
+            assert_greater(ticks.count(1), 5)
+            assert_equal(shelf.syncs, 2)
+            shelf.close()
+
+    def test_expire_backups(self):
+        """
+        Only the newest backups are kept.
+
+        :return: Null.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            for day in range(1, 6):
+                Path(tmp, "player-2026010{}.tar.gz".format(day)).touch()
+            Path(tmp, "other.tar.gz").touch()
+            expire_backups(tmp, "player-*.tar.gz", 2)
+            assert_equal(sorted(x.name for x in Path(tmp).iterdir()),
+                         ["other.tar.gz", "player-20260104.tar.gz",
+                          "player-20260105.tar.gz"])
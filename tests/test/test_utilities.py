@@ -0,0 +1,556 @@
+import asyncio
+import dbm
+import gc
+import pickle
+import tempfile
+import threading
+from pathlib import Path
+from unittest import TestCase
+
+from nose.tools import *
+
+from utilities import Cupboard, LazyDict, PluginStorage, TaskSupervisor, \
+    Tracked, TrackedDict
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+class TestTaskSupervisor:
+    def test_named_and_counted(self):
+        """
+        Tasks are named after their coroutine unless given a name, and the
+        gauge drops back to zero once they finish.
+
+        :return: Null.
+        """
+        tasks = TaskSupervisor(connection_limit=2, plugin_limit=3)
+
+        async def job():
+            await asyncio.sleep(0)
+
+        async def go():
+            first = tasks.spawn(job())
+            second = tasks.spawn(job(), name="custom")
+            assert_equals(tasks.count, 2)
+            await asyncio.gather(first, second)
+            return first, second
+
+        first, second = run(go())
+        assert_true(first.get_name().endswith("job"))
+        assert_equals(second.get_name(), "custom")
+        assert_equals(tasks.count, 0)
+        assert_equals(tasks.peak, 2)
+        assert_equals(tasks.spawned, 2)
+
+    def test_exceptions_are_logged(self):
+        """
+        A failing task is counted and logged instead of being dropped
+        silently.
+
+        :return: Null.
+        """
+        tasks = TaskSupervisor(connection_limit=2, plugin_limit=3)
+
+        async def boom():
+            raise ValueError("boom")
+
+        async def go():
+            task = tasks.spawn(boom())
+            await asyncio.wait((task,))
+
+        with TestCase().assertLogs("starrypy.tasks", "ERROR") as logged:
+            run(go())
+        assert_equals(tasks.failed, 1)
+        assert_in("boom", logged.output[0])
+
+    def test_cancel_connection_scope(self):
+        """
+        Cancelling a connection's tasks leaves other tasks alone, and
+        cancelled tasks aren't reported as failures.
+
+        :return: Null.
+        """
+        tasks = TaskSupervisor(connection_limit=2, plugin_limit=3)
+        conn, other = object(), object()
+
+        async def go():
+            mine = [tasks.spawn(asyncio.sleep(10), connection=conn)
+                    for _ in range(3)]
+            theirs = tasks.spawn(asyncio.sleep(0), connection=other)
+            await asyncio.sleep(0)
+            assert_equals(tasks.scope_counts("connection"),
+                          {conn: 3, other: 1})
+            assert_equals(tasks.cancel(connection=conn), 3)
+            await asyncio.wait(mine + [theirs])
+            return mine, theirs
+
+        mine, theirs = run(go())
+        assert_true(all(x.cancelled() for x in mine))
+        assert_false(theirs.cancelled())
+        assert_equals(tasks.failed, 0)
+        assert_equals(tasks.scope_counts("connection"), {})
+
+    def test_scope_concurrency_limit(self):
+        """
+        Only `connection_limit` tasks of one connection run at once; the
+        rest wait for a slot.
+
+        :return: Null.
+        """
+        tasks = TaskSupervisor(connection_limit=2, plugin_limit=3)
+        conn = object()
+        running = []
+        peak = []
+
+        async def job():
+            running.append(1)
+            peak.append(len(running))
+            await asyncio.sleep(0.01)
+            running.pop()
+
+        async def go():
+            jobs = [tasks.spawn(job(), connection=conn)
+                    for _ in range(5)]
+            await asyncio.sleep(0)
+            assert_equals(tasks.waiting, 3)
+            await asyncio.gather(*jobs)
+
+        run(go())
+        assert_equals(max(peak), 2)
+        assert_equals(len(peak), 5)
+        assert_equals(tasks.waiting, 0)
+
+    def test_unlimited_tasks(self):
+        """
+        Tasks spawned unlimited neither wait for nor take up a place in
+        their scope, but are still cancelled with it.
+
+        :return: Null.
+        """
+        tasks = TaskSupervisor(connection_limit=1, plugin_limit=3)
+        conn = object()
+
+        async def go():
+            free = [tasks.spawn(asyncio.sleep(10), connection=conn,
+                                limited=False) for _ in range(3)]
+            limited = tasks.spawn(asyncio.sleep(0), connection=conn)
+            await asyncio.wait((limited,))
+            assert_equals(tasks.waiting, 0)
+            assert_equals(tasks.scope_counts("connection"), {conn: 3})
+            assert_equals(tasks.cancel(connection=conn), 3)
+            await asyncio.wait(free)
+            return free
+
+        assert_true(all(x.cancelled() for x in run(go())))
+
+    def test_cancel_while_waiting(self):
+        """
+        A task cancelled before it got a slot never starts its coroutine.
+
+        :return: Null.
+        """
+        tasks = TaskSupervisor(connection_limit=2, plugin_limit=3)
+        started = []
+
+        async def job():
+            started.append(1)
+            await asyncio.sleep(10)
+
+        async def go():
+            jobs = [tasks.spawn(job(), plugin="p") for _ in range(5)]
+            await asyncio.sleep(0)
+            tasks.cancel(plugin="p")
+            await asyncio.wait(jobs)
+
+        run(go())
+        assert_equals(len(started), 3)
+        assert_equals(tasks.count, 0)
+
+    def test_spawn_from_other_threads(self):
+        """
+        Tasks spawned and finishing on another thread's loop (as isolated
+        plugins' do) don't upset the bookkeeping while it is read.
+
+        :return: Null.
+        """
+        tasks = TaskSupervisor(connection_limit=2, plugin_limit=1000)
+
+        async def churn():
+            for n in range(200):
+                jobs = [tasks.spawn(asyncio.sleep(0), plugin="p{}".format(x))
+                        for x in range(n % 20, n % 20 + 20)]
+                await asyncio.wait(jobs)
+
+        thread = threading.Thread(target=run, args=(churn(),))
+        thread.start()
+        while thread.is_alive():
+            tasks.scope_counts("plugin")
+            tasks.cancel(plugin="p5")
+        thread.join()
+        assert_equals(tasks.count, 0)
+        assert_equals(tasks.scope_counts("plugin"), {})
+
+
+class Record(Tracked):
+    def __init__(self, value):
+        self.value = value
+
+
+class TestCupboard:
+    def test_round_trip(self):
+        """
+        Records and other values come back as they were saved, including
+        empty dicts.
+
+        :return: Null.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            db = str(Path(tmp) / "db")
+            shelf = Cupboard(db)
+            shelf["players"] = {"a": Record(1), "b": Record(2)}
+            shelf["bans"] = {}
+            shelf["plugins"] = {"mail": {"x": [1, 2]}}
+            shelf["version"] = 3
+            shelf.close()
+            shelf = Cupboard(db)
+            assert_equal(shelf["players"]["a"].value, 1)
+            assert_equal(shelf["players"]["b"].value, 2)
+            assert_equal(shelf["bans"], {})
+            assert_equal(shelf["plugins"], {"mail": {"x": [1, 2]}})
+            assert_equal(shelf["version"], 3)
+            assert_is_instance(shelf["players"], TrackedDict)
+            shelf.close()
+
+    def test_only_changed_records_written(self):
+        """
+        A sync writes set records, changed Tracked records and other records
+        whose contents changed, and nothing else.
+
+        :return: Null.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            db = str(Path(tmp) / "db")
+            shelf = Cupboard(db)
+            shelf["players"] = {str(x): Record(x) for x in range(100)}
+            shelf["plugins"] = {"mail": {"x": []}, "motd": {"y": 1}}
+            shelf.sync()
+            assert_equal(shelf.last_sync_records, 102)
+            shelf.sync()
+            assert_equal(shelf.last_sync_records, 0)
+            assert_equal(shelf.last_sync_bytes, 0)
+            shelf["players"]["5"].value = "changed"
+            shelf["players"]["new"] = Record(0)
+            shelf["plugins"]["mail"]["x"].append(1)
+            shelf.sync()
+            assert_equal(shelf.last_sync_records, 3)
+            assert_greater(shelf.last_sync_bytes, 0)
+            del shelf["players"]["7"]
+            shelf["players"].pop("8")
+            shelf.close()
+            shelf = Cupboard(db)
+            assert_equal(shelf["players"]["5"].value, "changed")
+            assert_in("new", shelf["players"])
+            assert_not_in("7", shelf["players"])
+            assert_not_in("8", shelf["players"])
+            assert_equal(shelf["plugins"]["mail"]["x"], [1])
+            assert_equal(shelf.syncs, 0)
+            shelf.close()
+
+    def test_legacy_database_is_split(self):
+        """
+        A database written whole by older versions loads, and is rewritten
+        one record per key on the first sync.
+
+        :return: Null.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            db = str(Path(tmp) / "db")
+            with dbm.open(db, "c") as raw:
+                raw[b"players"] = pickle.dumps({"a": Record(1)})
+                raw[b"bans"] = pickle.dumps({})
+            shelf = Cupboard(db)
+            assert_equal(shelf["players"]["a"].value, 1)
+            shelf.close()
+            with dbm.open(db, "r") as raw:
+                assert_not_in(b"players", raw.keys())
+                assert_not_in(b"bans", raw.keys())
+            shelf = Cupboard(db)
+            assert_equal(shelf["players"]["a"].value, 1)
+            assert_equal(shelf["bans"], {})
+            shelf.close()
+
+    def test_replaced_dict_drops_old_records(self):
+        """
+        Assigning a new dict to a key replaces all of its old records.
+
+        :return: Null.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            db = str(Path(tmp) / "db")
+            shelf = Cupboard(db)
+            shelf["ships"] = {"a": 1, "b": 2}
+            shelf.sync()
+            shelf["ships"] = {"c": 3}
+            shelf.close()
+            shelf = Cupboard(db)
+            assert_equal(shelf["ships"], {"c": 3})
+            shelf.close()
+
+    def test_save_writes_off_loop(self):
+        """
+        Saves write in a worker thread, one at a time and in order, and
+        keep track of how long they held up the loop.
+
+        :return: Null.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            db = str(Path(tmp) / "db")
+            shelf = Cupboard(db)
+            shelf["players"] = {str(x): Record(x) for x in range(100)}
+            threads = set()
+            write = shelf._write
+
+            def spy(batch):
+                threads.add(threading.get_ident())
+                write(batch)
+            shelf._write = spy
+
+            async def go():
+                first = asyncio.ensure_future(shelf.save())
+                await asyncio.sleep(0)
+                shelf["players"]["1"].value = "second"
+                await asyncio.gather(first, shelf.save())
+
+            run(go())
+            assert_not_in(threading.get_ident(), threads)
+            assert_equal(shelf.syncs, 2)
+            assert_equal(shelf.last_sync_records, 1)
+            assert_greater(shelf.max_stall, 0)
+            assert_less(shelf.last_stall, shelf.last_sync_time)
+            shelf.close()
+            shelf = Cupboard(db)
+            assert_equal(shelf["players"]["1"].value, "second")
+            shelf.close()
+
+    def test_journal_recovery(self):
+        """
+        Flushed changes survive a crash, are compacted into the database on
+        reopening, and a torn record at the end of the journal is ignored.
+
+        :return: Null.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            db = str(Path(tmp) / "db")
+            journal = db + ".journal"
+            shelf = Cupboard(db, journal=journal)
+            shelf["players"] = {str(x): Record(x) for x in range(10)}
+            shelf["bans"] = {}
+            shelf.sync()
+            shelf["players"]["1"].value = "flushed"
+            shelf["bans"]["1.2.3.4"] = "griefing"
+            run(shelf.flush())
+            assert_equal(shelf.flushes, 1)
+            shelf["players"]["new"] = Record(0)
+            del shelf["players"]["2"]
+            run(shelf.flush())
+            del shelf["players"]["new"]
+            shelf["players"]["2"] = Record("back")
+            run(shelf.flush())
+            assert_equal(shelf.flushes, 3)
+            shelf["players"]["3"].value = "lost"
+            # Crash: nothing after the last flush reaches the disk, and the
+            # last record is only half written.
+            shelf.dict = None
+            shelf._journal_file.close()
+            with open(journal, "ab") as f:
+                f.write(b"\x00\x00\x01\x00garbage")
+            shelf = Cupboard(db, journal=journal)
+            assert_equal(Path(journal).stat().st_size, 0)
+            assert_equal(shelf["players"]["1"].value, "flushed")
+            assert_equal(shelf["players"]["2"].value, "back")
+            assert_equal(shelf["players"]["3"].value, 3)
+            assert_not_in("new", shelf["players"])
+            assert_equal(shelf["bans"], {"1.2.3.4": "griefing"})
+            shelf.close()
+
+    def test_journal_compacted_on_save(self):
+        """
+        Saving writes journaled changes into the database and empties the
+        journal; flushes only pick up what changed since.
+
+        :return: Null.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            db = str(Path(tmp) / "db")
+            journal = db + ".journal"
+            shelf = Cupboard(db, journal=journal)
+            shelf["players"] = {str(x): Record(x) for x in range(100)}
+            run(shelf.flush())
+            assert_greater(shelf.journal_bytes, 0)
+            run(shelf.flush())
+            assert_equal(shelf.flushes, 1)
+            shelf["players"]["5"].value = "saved"
+            run(shelf.save())
+            assert_equal(shelf.journal_bytes, 0)
+            assert_equal(Path(journal).stat().st_size, 0)
+            shelf.dict = None
+            shelf = Cupboard(db)
+            assert_equal(len(shelf["players"]), 100)
+            assert_equal(shelf["players"]["5"].value, "saved")
+            shelf.close()
+
+
+class TestLazyCupboard:
+    def test_records_decoded_on_use(self):
+        """
+        Lazy dicts only unpickle the records that are used, and keep no more
+        of them decoded than their cache size.
+
+        :return: Null.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            db = str(Path(tmp) / "db")
+            shelf = Cupboard(db, lazy={"players": 5})
+            shelf["players"] = {str(x): Record(x) for x in range(100)}
+            shelf["bans"] = {"1.2.3.4": "griefing"}
+            assert_is_instance(shelf["players"], LazyDict)
+            shelf.close()
+            shelf = Cupboard(db, lazy={"players": 5})
+            players = shelf["players"]
+            assert_is_instance(shelf["bans"], TrackedDict)
+            assert_equal(len(players), 100)
+            assert_in("42", players)
+            assert_equal(players.decoded, 0)
+            assert_equal(players["42"].value, 42)
+            assert_equal(players.decoded, 1)
+            assert_equal(sum(x.value for x in players.values()), 4950)
+            gc.collect()
+            assert_equal(players.cached, 5)
+            shelf.close()
+
+    def test_same_object_while_referenced(self):
+        """
+        A record still referenced elsewhere is not decoded again, so changes
+        made through that reference are saved.
+
+        :return: Null.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            db = str(Path(tmp) / "db")
+            shelf = Cupboard(db, lazy={"players": 2})
+            shelf["players"] = {str(x): Record(x) for x in range(10)}
+            shelf.sync()
+            players = shelf["players"]
+            kept = players["1"]
+            for x in range(10):
+                players[str(x)]
+            gc.collect()
+            assert_is(players["1"], kept)
+            kept.value = "changed"
+            del kept
+            for x in range(10):
+                players[str(x)]
+            gc.collect()
+            shelf.sync()
+            assert_equal(shelf.last_sync_records, 1)
+            shelf.close()
+            shelf = Cupboard(db, lazy={"players": 2})
+            assert_equal(shelf["players"]["1"].value, "changed")
+            shelf.close()
+
+    def test_pinned_and_changed_records_stay_decoded(self):
+        """
+        Pinned records stay decoded until unpinned, and other records set or
+        changed stay decoded until they have been saved.
+
+        :return: Null.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            db = str(Path(tmp) / "db")
+            shelf = Cupboard(db, lazy={"players": 1, "plugins": 1})
+            shelf["players"] = {str(x): Record(x) for x in range(10)}
+            shelf["plugins"] = {"mail": {"x": []}}
+            shelf.close()
+            shelf = Cupboard(db, lazy={"players": 1, "plugins": 1})
+            players = shelf["players"]
+            players.pin("1")
+            players["2"].value = "changed"
+            players["new"] = Record("new")
+            shelf["plugins"]["mail"]["x"].append(1)
+            for x in range(10):
+                players[str(x)]
+            gc.collect()
+            assert_equal(players.cached, 4)
+            shelf.sync()
+            assert_equal(shelf.last_sync_records, 3)
+            gc.collect()
+            assert_equal(players.cached, 2)
+            players.unpin("1")
+            players["3"]
+            gc.collect()
+            assert_equal(players.cached, 1)
+            del players["4"]
+            shelf.close()
+            shelf = Cupboard(db)
+            assert_equal(shelf["players"]["2"].value, "changed")
+            assert_equal(shelf["players"]["new"].value, "new")
+            assert_not_in("4", shelf["players"])
+            assert_equal(shelf["plugins"]["mail"]["x"], [1])
+            shelf.close()
+
+
+class TestPluginStorage:
+    def test_only_touched_storage_saved(self):
+        """
+        A plugin's storage is only pickled and written when it was touched,
+        by setting a key or explicitly; other plugins' storage costs
+        nothing.
+
+        :return: Null.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            db = str(Path(tmp) / "db")
+            shelf = Cupboard(db)
+            shelf["plugins"] = {"mail": PluginStorage({"mail": {"u1": []}}),
+                                "poi": PluginStorage({"pois": {}})}
+            shelf.sync()
+            assert_equal(shelf.last_sync_records, 2)
+            shelf.sync()
+            assert_equal(shelf.last_sync_records, 0)
+            mail = shelf["plugins"]["mail"]
+            mail["mail"]["u1"].append("hello")
+            shelf.sync()
+            assert_equal(shelf.last_sync_records, 0)
+            mail.touch()
+            shelf.sync()
+            assert_equal(shelf.last_sync_records, 1)
+            shelf["plugins"]["poi"].pois = {"home": 1}
+            shelf.close()
+            shelf = Cupboard(db)
+            assert_is_instance(shelf["plugins"]["mail"], PluginStorage)
+            assert_equal(shelf["plugins"]["mail"]["mail"], {"u1": ["hello"]})
+            assert_equal(shelf["plugins"]["poi"].pois, {"home": 1})
+            shelf.close()
+
+    def test_check_spots_untouched_changes(self):
+        """
+        `check` marks storage changed in place as changed, but only once it
+        has taken note of its contents.
+
+        :return: Null.
+        """
+        storage = PluginStorage({"ignores": {"u1": []}})
+        object.__setattr__(storage, "_changed", False)
+        storage["ignores"]["u1"].append("u2")
+        assert_false(storage.check())
+        assert_false(storage._changed)
+        assert_false(storage.check())
+        storage["ignores"]["u1"].append("u3")
+        assert_true(storage.check())
+        assert_true(storage._changed)
@@ -0,0 +1,167 @@
+import asyncio
+
+from base_plugin import BasePlugin
+from events import PlayerEvent, PlayerJoined, WorldChanged, subscribe
+from utilities import Direction, Hook, HookKind, State, When
+
+
+class Recorder(BasePlugin):
+    name = "recorder"
+
+    def __init__(self):
+        super().__init__()
+        self.seen = []
+
+    async def on_tile_update(self, data, connection):
+        self.seen.append(data)
+        return True
+
+
+class Veto(BasePlugin):
+    name = "veto"
+    depends = ["recorder"]
+
+    def __init__(self):
+        super().__init__()
+        self.seen = []
+
+    def on_tile_update(self, data, connection):
+        self.seen.append(data)
+        return False
+
+
+class Idle(BasePlugin):
+    name = "idle"
+
+
+class Observer(BasePlugin):
+    name = "observer"
+
+    def __init__(self):
+        super().__init__()
+        self.seen = []
+
+    @Hook(kind=HookKind.OBSERVER)
+    async def on_tile_update(self, data, connection):
+        self.seen.append(data)
+        return False
+
+
+class Skipped(BasePlugin):
+    name = "skipped"
+    depends = ["veto"]
+
+    def __init__(self):
+        super().__init__()
+        self.seen = []
+
+    async def on_tile_update(self, data, connection):
+        self.seen.append(data)
+        return True
+
+
+class Auditor(BasePlugin):
+    name = "auditor"
+    depends = ["veto"]
+
+    def __init__(self):
+        super().__init__()
+        self.seen = []
+
+    @Hook(always=True)
+    async def on_tile_update(self, data, connection):
+        self.seen.append(data)
+        return True
+
+
+class Early(BasePlugin):
+    name = "early"
+    depends = ["skipped"]
+
+    @Hook(priority=10)
+    async def on_tile_update(self, data, connection):
+        return True
+
+
+class Stalled(BasePlugin):
+    name = "stalled"
+
+    def __init__(self):
+        super().__init__()
+        self.finished = False
+
+    @Hook(timeout=0.01)
+    async def on_tile_array_update(self, data, connection):
+        await asyncio.sleep(0.05)
+        self.finished = True
+        return False
+
+
+class Detached(BasePlugin):
+    name = "detached"
+
+    def __init__(self):
+        super().__init__()
+        self.finished = False
+
+    @Hook(timeout=0.01, timeout_policy="detach")
+    async def on_tile_array_update(self, data, connection):
+        await asyncio.sleep(0.05)
+        self.finished = True
+        return False
+
+
+class Inbound(BasePlugin):
+    name = "inbound"
+
+    def __init__(self):
+        super().__init__()
+        self.seen = []
+
+    @Hook(direction=Direction.TO_CLIENT, always=True)
+    def on_tile_update(self, data, connection):
+        self.seen.append(data)
+        return True
+
+    @Hook(direction=Direction.TO_CLIENT)
+    def on_entity_message(self, data, connection):
+        self.seen.append(data)
+        return True
+
+
+class Gated(BasePlugin):
+    name = "gated"
+
+    def __init__(self):
+        super().__init__()
+        self.seen = []
+
+    @Hook(when=When(min_size=4, min_state=State.CONNECTED))
+    def on_tile_damage_update(self, data, connection):
+        self.seen.append(data)
+        return True
+
+
+class Listener(BasePlugin):
+    name = "listener"
+
+    def __init__(self):
+        super().__init__()
+        self.received = []
+
+    @subscribe(PlayerEvent)
+    def player_event(self, event):
+        self.received.append(event)
+
+
+class SlowListener(BasePlugin):
+    name = "slow_listener"
+
+    def __init__(self):
+        super().__init__()
+        self.received = []
+
+    @subscribe(PlayerJoined, WorldChanged)
+    async def player_event(self, event):
+        await asyncio.sleep(0.05)
+        self.received.append(event)
@@ -0,0 +1,33 @@
+import threading
+
+from base_plugin import BasePlugin
+from utilities import on_main_loop, on_plugin_loop
+
+
+class Bridge(BasePlugin):
+    name = "bridge"
+    isolate = "bridge"
+
+    def __init__(self):
+        super().__init__()
+        self.activated_on = None
+        self.seen_on = None
+
+    async def activate(self):
+        self.activated_on = threading.current_thread().name
+
+    def on_tile_update(self, data, connection):
+        self.seen_on = threading.current_thread().name
+        return False
+
+    @on_plugin_loop
+    async def away(self):
+        return threading.current_thread().name
+
+    @on_main_loop
+    async def home(self):
+        return threading.current_thread().name
+
+    @on_plugin_loop
+    async def round_trip(self):
+        return await self.home()
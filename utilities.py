@@ -11,18 +11,26 @@ Updated for release: kharidiron
 import asyncio
 import collections
 import io
+import functools
+import hashlib
+import logging
+import os
+import pickle
 import re
+import shutil
+import struct
+import threading
+import time
+import weakref
 import zlib
 import dbm
 from enum import IntEnum
 from pathlib import Path
 from types import FunctionType
 from shelve import Shelf, _ClosedDict
-from pickle import Pickler, Unpickler
 from collections import abc
 
 path = Path(__file__).parent
-background_tasks = set()
 
 # Enums
 
@@ -42,6 +50,11 @@ class Direction(IntEnum):
     TO_SERVER = 1
 
 
+class HookKind(IntEnum):
+    FILTER = 0
+    OBSERVER = 1
+
+
 class WarpType(IntEnum):
     TO_WORLD = 1
     TO_PLAYER = 2
@@ -231,44 +244,799 @@ class AsyncBytesIO(io.BytesIO):
         return super().read(*args, **kwargs)
 
 
+class Tracked:
+    """
+    Mixin for objects stored as records in a Cupboard. Assigning to an
+    attribute marks the object as changed, so that `Cupboard.sync` only
+    re-pickles the objects that changed since the last sync. Attributes
+    named in `_volatile` aren't saved, so assigning to them doesn't count.
+
+    Changing a mutable attribute in place (adding to a set, say) isn't
+    noticed; assign the attribute again or call `touch` afterwards.
+    """
+    __slots__ = ()
+    _changed = True
+    _owner = None
+    _volatile = frozenset()
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if name not in self._volatile:
+            self.touch()
+
+    def touch(self):
+        """
+        Marks the object as changed.
+        """
+        if not self._changed:
+            object.__setattr__(self, "_changed", True)
+            # Tell the TrackedDict holding it, so saves only need to look
+            # at the records that changed.
+            if self._owner is not None:
+                self._owner[0]._touched(self._owner[1], self)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("_changed", None)
+        state.pop("_owner", None)
+        return state
+
+
+class TrackedRecord(Tracked):
+    """
+    `Tracked` for records kept by the thousand, which keep their attributes
+    in slots rather than a __dict__. Subclasses list their attributes in
+    `__slots__`, and the ones that are saved in `_fields`.
+
+    Unpickling skips attributes that aren't fields (any more), and leaves
+    fields that weren't saved unset, so records saved before their class
+    had slots still load.
+    """
+    __slots__ = ("_changed", "_owner", "__weakref__")
+    _fields = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._field_set = frozenset(cls._fields)
+
+    def __new__(cls, *args, **kwargs):
+        self = super().__new__(cls)
+        object.__setattr__(self, "_changed", True)
+        object.__setattr__(self, "_owner", None)
+        return self
+
+    def __getstate__(self):
+        state = {}
+        for name in self._fields:
+            try:
+                state[name] = getattr(self, name)
+            except AttributeError:
+                pass
+        return state
+
+    def __setstate__(self, state):
+        fields = self._field_set
+        for name, value in state.items():
+            if name in fields:
+                object.__setattr__(self, name, value)
+
+
+class TrackedDict(dict):
+    """
+    Dict that remembers which keys were set or deleted since the last
+    `Cupboard.sync`. The Cupboard keeps its top-level dicts as these.
+
+    `Tracked` values report their own changes to the dict holding them (the
+    last one they were put in, if there are several). Other values are
+    listed in `untracked`, for the Cupboard to check itself.
+    """
+    __slots__ = ("changed", "deleted", "untracked")
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.changed = set(self)
+        self.deleted = set()
+        self.untracked = set()
+        for key, value in self.items():
+            self._adopt(key, value)
+
+    def _adopt(self, key, value):
+        if isinstance(value, Tracked):
+            object.__setattr__(value, "_owner", (self, key))
+            self.untracked.discard(key)
+        else:
+            self.untracked.add(key)
+
+    def _drop(self, key):
+        self.changed.discard(key)
+        self.untracked.discard(key)
+        self.deleted.add(key)
+
+    def _touched(self, key, value):
+        self.changed.add(key)
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.changed.add(key)
+        self.deleted.discard(key)
+        self._adopt(key, value)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._drop(key)
+
+    def pop(self, key, *default):
+        if key in self:
+            self._drop(key)
+        return super().pop(key, *default)
+
+    def popitem(self):
+        key, value = super().popitem()
+        self._drop(key)
+        return key, value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return super().__getitem__(key)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def clear(self):
+        self.deleted.update(self)
+        self.changed.clear()
+        self.untracked.clear()
+        super().clear()
+
+
+class LazyDict(abc.MutableMapping):
+    """
+    Mapping a Cupboard keeps a top-level dict as in lazy mode. Records stay
+    pickled until they are first used, and only the `cache_size` most
+    recently used ones are kept decoded, along with pinned records and
+    records changed since the last save. A record that is still referenced
+    from elsewhere keeps being returned as the same object.
+
+    Has the same `changed`, `deleted` and `untracked` sets as TrackedDict
+    for the Cupboard to save it by. Values that aren't `Tracked` can't
+    report their own changes, so they stay decoded once used.
+    """
+    def __init__(self, raw=None, cache_size=1024):
+        # Key -> pickled record as last saved, or None if not saved yet.
+        self.raw = {} if raw is None else raw
+        self.cache_size = cache_size
+        self.changed = set()
+        self.deleted = set()
+        self.untracked = set()
+        self.pinned = set()
+        self.decoded = 0
+        self._live = weakref.WeakValueDictionary()
+        self._recent = collections.OrderedDict()
+        self._held = {}
+
+    def __len__(self):
+        return len(self.raw)
+
+    def __iter__(self):
+        return iter(self.raw)
+
+    def __contains__(self, key):
+        return key in self.raw
+
+    def __getitem__(self, key):
+        try:
+            return self._held[key]
+        except KeyError:
+            pass
+        value = self._live.get(key)
+        if value is None:
+            value = pickle.loads(self.raw[key])
+            self.decoded += 1
+            if not isinstance(value, Tracked):
+                self._held[key] = value
+                self.untracked.add(key)
+                return value
+            object.__setattr__(value, "_changed", False)
+            object.__setattr__(value, "_owner", (self, key))
+            self._live[key] = value
+        self._use(key, value)
+        return value
+
+    def _use(self, key, value):
+        recent = self._recent
+        recent[key] = value
+        recent.move_to_end(key)
+        while len(recent) > self.cache_size:
+            key, value = recent.popitem(last=False)
+            if value._changed:
+                self._held[key] = value
+
+    def _touched(self, key, value):
+        if self._live.get(key) is value:
+            self.changed.add(key)
+            self._held[key] = value
+
+    def __setitem__(self, key, value):
+        self.raw[key] = None
+        self.changed.add(key)
+        self.deleted.discard(key)
+        self._recent.pop(key, None)
+        self._held[key] = value
+        if isinstance(value, Tracked):
+            object.__setattr__(value, "_owner", (self, key))
+            self._live[key] = value
+            self.untracked.discard(key)
+        else:
+            self._live.pop(key, None)
+            self.untracked.add(key)
+
+    def __delitem__(self, key):
+        del self.raw[key]
+        for cache in (self._held, self._live, self._recent):
+            cache.pop(key, None)
+        self.pinned.discard(key)
+        self.changed.discard(key)
+        self.untracked.discard(key)
+        self.deleted.add(key)
+
+    def clear(self):
+        self.deleted.update(self.raw)
+        for cache in (self.raw, self._held, self._live, self._recent,
+                      self.pinned, self.changed, self.untracked):
+            cache.clear()
+
+    def saved(self, key, data):
+        """
+        Called by the Cupboard with a record it just pickled to save.
+        Records that are neither pinned nor untracked are left to the LRU
+        again.
+        """
+        self.raw[key] = data
+        if key in self.pinned or key in self.untracked:
+            return
+        value = self._held.pop(key, None)
+        if value is not None:
+            self._use(key, value)
+
+    def pin(self, key):
+        """
+        Keeps a record decoded until it is unpinned, e.g. while its player
+        is online.
+        """
+        self._held[key] = self[key]
+        self.pinned.add(key)
+
+    def unpin(self, key):
+        """
+        Leaves a pinned record to the LRU again, once it has been saved.
+        """
+        if key not in self.pinned:
+            return
+        self.pinned.discard(key)
+        value = self._held.get(key)
+        if isinstance(value, Tracked) and not value._changed:
+            del self._held[key]
+            self._use(key, value)
+
+    @property
+    def cached(self):
+        """
+        Number of records currently decoded.
+        """
+        return len(self._live) + len(self.untracked)
+
+
 class Cupboard(Shelf):
     """
     Custom Shelf implementation that only pickles values at save-time.
     Increases save/load times, decreases get/set item times.
     More suitable for use as a savable dictionary.
+
+    Dict values are kept as TrackedDicts and saved one record per key, so
+    a sync only re-pickles records that were set, or that are `Tracked`
+    objects that changed. Other records are pickled and only written if
+    they differ from what was written last. Databases written whole, by
+    older versions, are split into records on their first sync.
+
+    `save` is the non-blocking version of `sync` for use on the event loop.
+
+    With a `journal` file, `flush` cheaply appends what changed to the
+    journal instead (and fsyncs it), so it can be called every few seconds.
+    `sync` and `save` compact the journal into the database, as does
+    opening the Cupboard after a crash.
+
+    `lazy` maps top-level keys to a cache size. Those dicts are kept as
+    LazyDicts, which only unpickle records when they are used.
     """
-    def __init__(self, filename, flag='c', protocol=None, keyencoding='utf-8'):
+    _sep = b"\x00"
+
+    def __init__(self, filename, flag='c', protocol=None, keyencoding='utf-8',
+                 journal=None, lazy=None):
         self.db = filename
         self.flag = flag
+        self.journal = journal
+        self._lazy = {k.encode(keyencoding): v
+                      for k, v in (lazy or {}).items()}
         self.dict = {}
+        Shelf.__init__(self, self.dict, protocol, False, keyencoding)
+        self._digests = {}
+        self._legacy = set()
+        self._replaced = set()
+        self._marked = set()
+        # Taken by each save from before its changes are collected until
+        # they are written, so saves reach the disk in the order they were
+        # collected in.
+        self._write_lock = threading.Lock()
+        self._save_lock = None
+        self.syncs = 0
+        self.sync_time = 0.0
+        self.bytes_written = 0
+        self.last_sync_time = 0.0
+        self.last_sync_bytes = 0
+        self.last_sync_records = 0
+        self.last_stall = 0.0
+        self.max_stall = 0.0
+        self.flushes = 0
+        self.journal_bytes = 0
+        self.last_flush_time = 0.0
+        self._journaled = []
+        self._journal_file = None
+        if journal is not None:
+            frames = self._read_journal()
+            if frames:
+                self._store(self._merge(frames))
+            self._truncate_journal()
+        self._load(self._read())
+
+    def _read(self):
+        """
+        Reads the database. Backends override this and `_store`.
+
+        :return: Iterable of (top-level key, record key, pickled data). The
+                 record key is None for values stored whole, and the data
+                 is None for the marker of a (possibly empty) dict.
+        """
         with dbm.open(self.db, self.flag) as db:
             for k in db.keys():
-                v = io.BytesIO(db[k])
-                self.dict[k] = Unpickler(v).load()
-        Shelf.__init__(self, self.dict, protocol, False, keyencoding)
+                top, sep, sub = k.partition(self._sep)
+                if not sep:
+                    yield top, None, db[k]
+                elif not sub:
+                    yield top, None, None
+                else:
+                    yield top, self._load_key(sub), db[k]
+
+    def _load(self, items):
+        whole = {}
+        split = {}
+        for top, key, data in items:
+            if key is None and data is not None:
+                whole[top] = pickle.loads(data)
+                self._differs((top, None), data)
+                continue
+            records = split.setdefault(top, {})
+            self._marked.add(top)
+            if data is not None and top in self._lazy:
+                records[key] = data
+            elif data is not None:
+                record = pickle.loads(data)
+                if isinstance(record, Tracked):
+                    object.__setattr__(record, "_changed", False)
+                else:
+                    self._differs((top, key), data)
+                records[key] = record
+        for top, value in whole.items():
+            if top in split:
+                # Interrupted while splitting; the records are newer.
+                self._legacy.add(top)
+            elif type(value) is dict:
+                self.dict[top] = TrackedDict(value)
+                self._legacy.add(top)
+            else:
+                self.dict[top] = value
+        for top, records in split.items():
+            if top in self._lazy:
+                self.dict[top] = LazyDict(records, self._lazy[top])
+                continue
+            self.dict[top] = records = TrackedDict(records)
+            records.changed.clear()
+
+    @staticmethod
+    def _dump_key(key):
+        if isinstance(key, str):
+            return b"s" + key.encode("utf-8")
+        return b"p" + pickle.dumps(key, 4)
+
+    @staticmethod
+    def _load_key(data):
+        if data[:1] == b"s":
+            return data[1:].decode("utf-8")
+        return pickle.loads(data[1:])
 
     def __getitem__(self, key):
         return self.dict[key.encode(self.keyencoding)]
 
     def __setitem__(self, key, value):
-        self.dict[key.encode(self.keyencoding)] = value
+        key = key.encode(self.keyencoding)
+        if type(value) is dict and key in self._lazy:
+            records = LazyDict(cache_size=self._lazy[key])
+            records.update(value)
+            value = records
+        elif type(value) is dict:
+            value = TrackedDict(value)
+        if key in self.dict and value is not self.dict[key]:
+            self._replaced.add(key)
+        self.dict[key] = value
 
     def __delitem__(self, key):
-        del self.dict[key.encode(self.keyencoding)]
+        key = key.encode(self.keyencoding)
+        del self.dict[key]
+        self._replaced.add(key)
 
-    def sync(self):
-        res = {}
+    def _differs(self, slot, data):
+        """
+        Whether pickled `data` differs from what was last written to `slot`.
+        """
+        digest = hashlib.blake2b(data, digest_size=16).digest()
+        if self._digests.get(slot) == digest:
+            return False
+        self._digests[slot] = digest
+        return True
+
+    def _collect(self):
+        """
+        Pickles what changed since the last sync, and marks it unchanged.
+        This is the part of a save that has to run on the event loop.
+
+        :return: Batch for `_write`.
+        """
+        batch = DotDict({"purge": set(self._replaced), "delete": [],
+                         "write": {}, "fields": {}, "sections": [],
+                         "legacy": []})
+        if self._replaced:
+            self._digests = {k: v for k, v in self._digests.items()
+                             if k[0] not in self._replaced}
+            self._marked -= self._replaced
+            for top in self._replaced:
+                value = self.dict.get(top)
+                if isinstance(value, (TrackedDict, LazyDict)):
+                    value.changed.update(value)
+                    value.deleted.clear()
+                if isinstance(value, Tracked):
+                    value.touch()
+                self._legacy.discard(top)
+            self._replaced.clear()
+        write = batch.write
+        for top, value in self.dict.items():
+            lazy = isinstance(value, LazyDict)
+            if not lazy and not isinstance(value, TrackedDict):
+                if isinstance(value, Tracked) and not value._changed:
+                    continue
+                data = pickle.dumps(value, self._protocol)
+                if self._differs((top, None), data):
+                    write[top, None] = data
+                if isinstance(value, Tracked):
+                    object.__setattr__(value, "_changed", False)
+                continue
+            if top not in self._marked:
+                batch.sections.append(top)
+                self._marked.add(top)
+            for key in value.deleted:
+                batch.delete.append((top, key))
+                self._digests.pop((top, key), None)
+            value.deleted.clear()
+            changed = value.changed
+            for key in changed | value.untracked:
+                try:
+                    record = value[key]
+                except KeyError:
+                    # Changed after it was removed.
+                    continue
+                if isinstance(record, Tracked):
+                    data = pickle.dumps(record, self._protocol)
+                    object.__setattr__(record, "_changed", False)
+                else:
+                    data = pickle.dumps(record, self._protocol)
+                    if lazy:
+                        differs = data != value.raw.get(key)
+                    else:
+                        differs = self._differs((top, key), data)
+                    if not differs and key not in changed:
+                        continue
+                write[top, key] = data
+                if lazy:
+                    value.saved(key, data)
+                fields = self._fields(top, record)
+                if fields is not None:
+                    batch.fields[top, key] = fields
+            changed.clear()
+            if top in self._legacy:
+                batch.legacy.append(top)
+                self._legacy.discard(top)
+        return batch
+
+    def _fields(self, top, record):
+        """
+        Values a backend stores alongside a record, to index it by.
+
+        :return: None, or whatever the backend's `_store` expects.
+        """
+        return None
+
+    def _store(self, batch):
+        """
+        Applies a batch from `_collect` to the database: first purging the
+        top-level keys in `batch.purge`, then deleting and writing records,
+        and last removing whole values left by older versions.
+
+        :param batch: Batch from `_collect`.
+        :return: Null.
+        """
+        dump = self._dump_key
         with dbm.open(self.db, self.flag) as db:
-            for k, v in self.dict.items():
-                f = io.BytesIO()
-                p = Pickler(f, protocol=self._protocol)
-                p.dump(v)
-                db[k] = f.getvalue()
+            if batch.purge:
+                for k in list(db.keys()):
+                    if k.partition(self._sep)[0] in batch.purge:
+                        del db[k]
+            for top, key in batch.delete:
+                try:
+                    del db[top + self._sep + dump(key)]
+                except KeyError:
+                    pass
+            for top in batch.sections:
+                # Empty record marking the dict, so it exists even when
+                # empty.
+                db[top + self._sep] = b""
+            for (top, key), data in batch.write.items():
+                if key is None:
+                    db[top] = data
+                else:
+                    db[top + self._sep + dump(key)] = data
+            # Only once the records replacing them are in.
+            for top in batch.legacy:
+                try:
+                    del db[top]
+                except KeyError:
+                    pass
             try:
                 db.sync()
             except AttributeError:
                 pass
 
+    @staticmethod
+    def _merge(batches):
+        """
+        Merges batches into one with the same effect as storing them in
+        order.
+
+        :param batches: Batches from `_collect`, oldest first.
+        :return: Batch.
+        """
+        merged = DotDict({"purge": set(), "delete": set(), "write": {},
+                          "fields": {}, "sections": [], "legacy": []})
+        write = merged.write
+        fields = merged.fields
+        for batch in batches:
+            purge = batch["purge"]
+            if purge:
+                merged.purge |= purge
+                for slot in [x for x in write if x[0] in purge]:
+                    del write[slot]
+                    fields.pop(slot, None)
+                merged.delete = {x for x in merged.delete
+                                 if x[0] not in purge}
+                merged.sections = [x for x in merged.sections
+                                   if x not in purge]
+            for slot in batch["delete"]:
+                write.pop(slot, None)
+                fields.pop(slot, None)
+                merged.delete.add(slot)
+            merged.sections.extend(batch["sections"])
+            for slot, data in batch["write"].items():
+                merged.delete.discard(slot)
+                write[slot] = data
+            fields.update(batch["fields"])
+            merged.legacy.extend(batch["legacy"])
+        return merged
+
+    def _read_journal(self):
+        """
+        Reads the batches in the journal, stopping at a torn one left by a
+        crash while it was being appended.
+
+        :return: List of batches, oldest first.
+        """
+        frames = []
+        try:
+            f = open(self.journal, "rb")
+        except FileNotFoundError:
+            return frames
+        with f:
+            while True:
+                header = f.read(4)
+                if len(header) < 4:
+                    break
+                size, = struct.unpack(">I", header)
+                data = f.read(size)
+                try:
+                    if len(data) < size:
+                        raise EOFError
+                    frames.append(pickle.loads(data))
+                except Exception:
+                    logging.getLogger("starrypy.storage").warning(
+                        "Ignoring a torn record at the end of %s.",
+                        self.journal)
+                    break
+        return frames
+
+    def _truncate_journal(self):
+        if self._journal_file is not None:
+            self._journal_file.close()
+            self._journal_file = None
+        with open(self.journal, "wb"):
+            pass
+        self._journaled = []
+        self.journal_bytes = 0
+
+    def _append(self, batch):
+        """
+        Appends a batch from `_collect` to the journal and fsyncs it, then
+        releases the write lock taken before it was collected. Safe to run
+        in a worker thread.
+
+        :param batch: Batch from `_collect`.
+        :return: Null.
+        """
+        try:
+            if not (batch.purge or batch.delete or batch.write or
+                    batch.sections or batch.legacy):
+                return
+            start = time.perf_counter()
+            frame = {"purge": batch.purge, "delete": batch.delete,
+                     "write": dict(batch.write),
+                     "fields": dict(batch.fields),
+                     "sections": batch.sections, "legacy": batch.legacy}
+            data = pickle.dumps(frame, 4)
+            if self._journal_file is None:
+                self._journal_file = open(self.journal, "ab")
+            self._journal_file.write(struct.pack(">I", len(data)) + data)
+            self._journal_file.flush()
+            os.fsync(self._journal_file.fileno())
+            self._journaled.append(frame)
+            self.flushes += 1
+            self.journal_bytes += len(data) + 4
+            self.last_flush_time = batch.stall + time.perf_counter() - start
+        finally:
+            self._write_lock.release()
+
+    def _write(self, batch):
+        """
+        Writes a batch from `_collect` to the database, along with anything
+        in the journal, and releases the write lock taken before it was
+        collected. Safe to run in a worker thread, since it doesn't touch
+        anything but the batch (and the journal).
+
+        :param batch: Batch from `_collect`.
+        :return: Null.
+        """
+        try:
+            start = time.perf_counter()
+            if self._journaled:
+                stall = batch.stall
+                batch = self._merge(self._journaled + [batch])
+                batch.stall = stall
+            self._store(batch)
+            if self.journal is not None:
+                # Only once the database has everything in it.
+                self._truncate_journal()
+            written = sum(len(x) for x in batch.write.values())
+            self.last_sync_time = batch.stall + time.perf_counter() - start
+            self.last_sync_bytes = written
+            self.last_sync_records = len(batch.write)
+            self.syncs += 1
+            self.sync_time += self.last_sync_time
+            self.bytes_written += written
+        finally:
+            self._write_lock.release()
+
+    def _begin(self, locked=False):
+        if not locked:
+            self._write_lock.acquire()
+        start = time.perf_counter()
+        try:
+            batch = self._collect()
+        except BaseException:
+            self._write_lock.release()
+            raise
+        batch.stall = self.last_stall = time.perf_counter() - start
+        self.max_stall = max(self.max_stall, self.last_stall)
+        return batch
+
+    async def _lock(self):
+        """
+        Takes the write lock, waiting in a worker thread rather than holding
+        up the event loop if a write or a snapshot has it.
+        """
+        if self._write_lock.acquire(blocking=False):
+            return
+        future = asyncio.get_running_loop().run_in_executor(
+            None, self._write_lock.acquire)
+        try:
+            await asyncio.shield(future)
+        except asyncio.CancelledError:
+            future.add_done_callback(lambda _: self._write_lock.release())
+            raise
+
+    def sync(self):
+        self._write(self._begin())
+
+    async def save(self):
+        """
+        Like `sync`, but only collects the changes on the event loop, and
+        writes them to disk in a worker thread. Saves never overlap; one
+        started while another is writing waits for it to finish.
+
+        :return: Null.
+        """
+        if self._save_lock is None:
+            self._save_lock = asyncio.Lock()
+        async with self._save_lock:
+            await self._lock()
+            await asyncio.to_thread(self._write, self._begin(locked=True))
+
+    async def flush(self):
+        """
+        Appends what changed since the last flush or save to the journal,
+        collecting it on the event loop and writing it in a worker thread.
+        Without a journal, this is the same as `save`.
+
+        :return: Null.
+        """
+        if self.journal is None:
+            return await self.save()
+        if self._save_lock is None:
+            self._save_lock = asyncio.Lock()
+        async with self._save_lock:
+            await self._lock()
+            await asyncio.to_thread(self._append, self._begin(locked=True))
+
+    # Files a dbm database may consist of, depending on the implementation.
+    dbm_suffixes = ("", ".db", ".dat", ".dir", ".bak", ".pag")
+
+    def snapshot(self, directory):
+        """
+        Copies the database, and the journal if there is one, into
+        `directory` as they were after the last save or flush. Meant for a
+        worker thread: saves started meanwhile wait for it to finish.
+
+        :param directory: Existing directory to copy into.
+        :return: List of the files written.
+        """
+        with self._write_lock:
+            files = self._copy(Path(directory))
+            if self.journal is not None and Path(self.journal).exists():
+                files.append(shutil.copy2(self.journal, directory))
+        return files
+
+    def _copy(self, directory):
+        """
+        Copies the database into `directory`. Backends override this.
+
+        :return: List of the files written.
+        """
+        files = []
+        for suffix in self.dbm_suffixes:
+            source = Path(str(self.db) + suffix)
+            if source.is_file():
+                files.append(shutil.copy2(source, directory))
+        return files
+
     def close(self):
         if(self.dict is None):
             return
@@ -277,6 +1045,9 @@ class Cupboard(Shelf):
             return    
         try:
             self.sync()
+            if self._journal_file is not None:
+                self._journal_file.close()
+                self._journal_file = None
         finally:
             try:
                 self.dict = _ClosedDict()
@@ -385,18 +1156,207 @@ def get_syntax(command, fn, command_prefix):
         command,
         fn.syntax)
 
-def background(coro):
-    task = asyncio.create_task(coro)
+def on_plugin_loop(f):
+    """
+    Decorator for coroutine methods of a plugin that may run on an isolated
+    loop (see `BasePlugin.isolate`). The method always runs on the plugin's
+    loop, whichever loop awaits it. No-op for plugins that aren't isolated.
+    """
+    @functools.wraps(f)
+    async def wrapped(self, *args, **kwargs):
+        if self.isolation is None:
+            return await f(self, *args, **kwargs)
+        return await self.isolation.call(f(self, *args, **kwargs))
+    return wrapped
+
 
-    # Add task to the set. This creates a strong reference.
-    background_tasks.add(task)
+def on_main_loop(f):
+    """
+    Decorator for coroutine methods of an isolated plugin that touch the
+    server (connections, the factory, other plugins' state). The method
+    always runs on the main loop. No-op for plugins that aren't isolated.
+    """
+    @functools.wraps(f)
+    async def wrapped(self, *args, **kwargs):
+        if self.isolation is None:
+            return await f(self, *args, **kwargs)
+        return await self.isolation.call_main(f(self, *args, **kwargs))
+    return wrapped
+
+
+class TaskSupervisor:
+    """
+    Keeps track of every task started through `background`. Tasks are named,
+    and may be scoped to a connection and/or a plugin: a scope's tasks are
+    cancelled together (when the connection dies, or the plugin is
+    deactivated), and only `connection_limit` / `plugin_limit` of them run
+    at once, the rest waiting their turn. Exceptions are logged when the
+    task finishes, instead of vanishing with it.
+
+    Isolated plugins spawn tasks from their own loop's thread, so the
+    bookkeeping is done under a lock.
+    """
+    def __init__(self, connection_limit=16, plugin_limit=64):
+        self.connection_limit = connection_limit
+        self.plugin_limit = plugin_limit
+        self.logger = logging.getLogger("starrypy.tasks")
+        self.spawned = 0
+        self.failed = 0
+        self.waiting = 0
+        self.peak = 0
+        self._tasks = set()
+        self._scopes = {}
+        self._limits = {}
+        self._lock = threading.Lock()
+
+    @property
+    def count(self):
+        """
+        Number of tasks that have not finished yet, waiting ones included.
+        """
+        return len(self._tasks)
 
-    # To prevent keeping references to finished tasks forever,
-    # make each task remove its own reference from the set after
-    # completion:
-    task.add_done_callback(background_tasks.discard)
+    def spawn(self, coro, name=None, connection=None, plugin=None,
+              limited=True):
+        """
+        Starts a supervised task on the running loop.
+
+        :param coro: The coroutine to run.
+        :param name: Task name. Defaults to the coroutine's name.
+        :param connection: Connection the task belongs to, if any.
+        :param plugin: Name of the plugin the task belongs to, if any.
+        :param limited: Whether the task waits for (and takes up) a place
+                        within its scopes' limits. Either way it is
+                        cancelled along with them.
+        :return: The Task.
+        """
+        if name is None:
+            name = getattr(coro, "__qualname__", repr(coro))
+        scopes = []
+        if connection is not None:
+            scopes.append(("connection", connection))
+        if plugin is not None:
+            scopes.append(("plugin", plugin))
+        if scopes and limited:
+            coro = self._limited(coro, scopes)
+        task = asyncio.create_task(coro, name=name)
+        with self._lock:
+            self.spawned += 1
+            self._tasks.add(task)
+            self.peak = max(self.peak, len(self._tasks))
+            for scope in scopes:
+                self._scopes.setdefault(scope, set()).add(task)
+        task.add_done_callback(functools.partial(self._done, scopes))
+        return task
+
+    def _semaphore(self, scope):
+        with self._lock:
+            try:
+                return self._limits[scope]
+            except KeyError:
+                limit = (self.connection_limit if scope[0] == "connection"
+                         else self.plugin_limit)
+                semaphore = self._limits[scope] = asyncio.Semaphore(limit)
+                return semaphore
+
+    async def _limited(self, coro, scopes):
+        acquired = []
+        try:
+            for scope in scopes:
+                semaphore = self._semaphore(scope)
+                if semaphore.locked():
+                    self.waiting += 1
+                    try:
+                        await semaphore.acquire()
+                    finally:
+                        self.waiting -= 1
+                else:
+                    await semaphore.acquire()
+                acquired.append(semaphore)
+            return await coro
+        finally:
+            for semaphore in acquired:
+                semaphore.release()
+            # Never awaited if cancelled while waiting; close it so Python
+            # doesn't warn about it.
+            coro.close()
+
+    def _done(self, scopes, task):
+        with self._lock:
+            self._tasks.discard(task)
+            for scope in scopes:
+                tasks = self._scopes.get(scope)
+                if tasks is not None:
+                    tasks.discard(task)
+                    if not tasks:
+                        del self._scopes[scope]
+                        self._limits.pop(scope, None)
+        if task.cancelled():
+            return
+        exc = task.exception()
+        if exc is not None:
+            self.failed += 1
+            self.logger.error("Background task %s failed.", task.get_name(),
+                              exc_info=exc)
 
-    return task
+    def cancel(self, connection=None, plugin=None):
+        """
+        Cancels the tasks of a connection or plugin.
+
+        :param connection: Connection whose tasks should be cancelled.
+        :param plugin: Name of the plugin whose tasks should be cancelled.
+        :return: Number of tasks cancelled.
+        """
+        tasks = set()
+        with self._lock:
+            if connection is not None:
+                tasks |= self._scopes.get(("connection", connection), set())
+            if plugin is not None:
+                tasks |= self._scopes.get(("plugin", plugin), set())
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        current = asyncio.current_task() if loop else None
+        cancelled = 0
+        for task in tasks:
+            if task is current or task.done():
+                continue
+            if task.get_loop() is loop:
+                task.cancel()
+            else:
+                # Tasks of isolated plugins live on their plugin loop.
+                task.get_loop().call_soon_threadsafe(task.cancel)
+            cancelled += 1
+        return cancelled
+
+    def scope_counts(self, kind):
+        """
+        Live task counts per scope of one kind.
+
+        :param kind: "connection" or "plugin".
+        :return: Dict of connection (or plugin name) to task count.
+        """
+        with self._lock:
+            return {scope[1]: len(tasks)
+                    for scope, tasks in self._scopes.items()
+                    if scope[0] == kind}
+
+
+tasks = TaskSupervisor()
+
+
+def background(coro, name=None, connection=None, plugin=None):
+    """
+    Runs a coroutine as a supervised background task. See `TaskSupervisor`.
+
+    :param coro: The coroutine to run.
+    :param name: Task name. Defaults to the coroutine's name.
+    :param connection: Connection the task belongs to, if any.
+    :param plugin: Name of the plugin the task belongs to, if any.
+    :return: The Task.
+    """
+    return tasks.spawn(coro, name=name, connection=connection, plugin=plugin)
 
 
 def send_message(connection, *messages, **kwargs):
@@ -407,7 +1367,8 @@ def send_message(connection, *messages, **kwargs):
     :param messages: The message(s) to send.
     :return: A Future for the message(s) being sent.
     """
-    return background(connection.send_message(*messages, **kwargs))
+    return background(connection.send_message(*messages, **kwargs),
+                      name="send_message", connection=connection)
 
 
 def broadcast(connection, *messages, **kwargs):
@@ -418,7 +1379,8 @@ def broadcast(connection, *messages, **kwargs):
     :param messages: The message(s) to send.
     :return: A Future for the message(s) being sent.
     """
-    return background(connection.factory.broadcast(*messages, **kwargs))
+    return background(connection.factory.broadcast(*messages, **kwargs),
+                      name="broadcast")
 
 
 def link_plugin_if_available(self, plugin):
@@ -431,6 +1393,19 @@ def link_plugin_if_available(self, plugin):
         return False
 
 
+def memory_usage():
+    """
+    The server's resident memory, in bytes, where the OS can tell us.
+
+    :return: Integer, or None.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
 class Command:
     """
     Defines a decorator that encapsulates a chat command. Provides a common
@@ -481,6 +1456,170 @@ class Command:
         return wrapped
 
 
+class Hook:
+    """
+    Defines a decorator that declares how the plugin manager dispatches a
+    packet hook.
+
+    Filters (the default for undecorated hooks) run inline, in front of the
+    packet being forwarded, and may veto it by returning False. Filters run
+    in descending `priority`, ties keeping plugin dependency order. Once one
+    has vetoed a packet the rest are skipped, except those declared with
+    `always=True` (e.g. for state tracking or auditing), which see every
+    packet of their type; packet["vetoed"] is set on vetoed packets.
+
+    Observers never block traffic: they are queued per-connection and run
+    after the packet has been handed on, and their return value is ignored.
+
+    Coroutine filters that run past their deadline are cancelled, or left
+    running detached from the packet, depending on `timeout_policy`
+    ("cancel" or "detach"). Either way the packet is let through. When not
+    given, `timeout` and `timeout_policy` come from the `hook_timeout` and
+    `hook_timeout_policy` config values; a timeout of 0 disables it.
+    Filters declared with `always=True` track state or enforce security,
+    which can't be skipped by letting the packet through, so they get no
+    deadline unless they declare one.
+
+    A hook given a `direction` (a `Direction`) only sees packets flowing
+    that way. Packets going the other way aren't handed to it, and aren't
+    even parsed unless some other hook wants them.
+
+    `when` narrows it further with a predicate over the packet envelope (see
+    `When`), checked before the packet is parsed. A packet none of whose
+    hooks match is forwarded without being parsed.
+    """
+    def __init__(self, kind=HookKind.FILTER, priority=0, always=False,
+                 timeout=None, timeout_policy=None, direction=None,
+                 when=None):
+        self.kind = kind
+        self.priority = priority
+        self.always = always
+        self.timeout = timeout
+        self.timeout_policy = timeout_policy
+        self.direction = direction
+        self.when = when
+
+    def __call__(self, f):
+        f.hook_kind = self.kind
+        f.hook_priority = self.priority
+        f.hook_always = self.always
+        f.hook_timeout = self.timeout
+        f.hook_timeout_policy = self.timeout_policy
+        f.hook_direction = self.direction
+        f.hook_when = self.when
+        return f
+
+
+class When:
+    """
+    A predicate for `Hook(when=...)`, built from what is known about a packet
+    before it is parsed: the header fields filled in by `read_packet` (size
+    and compression) and the state of the connection it arrived on. Every
+    condition given must hold; those left as None aren't checked.
+
+    Any callable taking (packet, connection) and returning a bool may be
+    used in place of a `When`, as long as it doesn't look at
+    packet["parsed"].
+    """
+    def __init__(self, min_size=None, max_size=None, compressed=None,
+                 min_state=None):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.compressed = compressed
+        self.min_state = min_state
+
+    def __call__(self, packet, connection):
+        if self.min_size is not None and packet["size"] < self.min_size:
+            return False
+        if self.max_size is not None and packet["size"] > self.max_size:
+            return False
+        if self.compressed is not None and \
+                packet.get("compressed", False) != self.compressed:
+            return False
+        if self.min_state is not None:
+            state = getattr(connection, "state", None)
+            if state is None or state < self.min_state:
+                return False
+        return True
+
+    def __repr__(self):
+        conditions = ("{}={!r}".format(k, v) for k, v in vars(self).items()
+                      if v is not None)
+        return "When({})".format(", ".join(conditions))
+
+
+class PluginStorage(Tracked, DotDict):
+    """
+    A plugin's storage, as handed out by `PlayerManager.get_storage`: a
+    DotDict saved as a record of its own, and only once it has changed.
+
+    Setting or deleting a top-level key marks it as changed; changing
+    something nested in place (appending to a list in it, say) doesn't, so
+    plugins call `touch` afterwards. For plugins that don't, `check` spots
+    changes by comparing pickles.
+    """
+    def __init__(self, d=(), **kwargs):
+        # Nested dicts are kept as they are, unlike in a DotDict.
+        dict.__init__(self, d, **kwargs)
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self.touch()
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self.touch()
+
+    def __setattr__(self, key, value):
+        DotDict.__setattr__(self, key, value)
+        self.touch()
+
+    __delattr__ = __delitem__
+
+    def pop(self, key, *default):
+        if key in self:
+            self.touch()
+        return dict.pop(self, key, *default)
+
+    def popitem(self):
+        item = dict.popitem(self)
+        self.touch()
+        return item
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return dict.__getitem__(self, key)
+
+    def update(self, *args, **kwargs):
+        dict.update(self, *args, **kwargs)
+        self.touch()
+
+    def clear(self):
+        dict.clear(self)
+        self.touch()
+
+    def check(self):
+        """
+        Marks the storage as changed if its contents differ from the last
+        time it was checked. The first check only takes note of them.
+
+        :return: Boolean: Whether it was marked as changed.
+        """
+        digest = hashlib.blake2b(pickle.dumps(self, 4),
+                                 digest_size=16).digest()
+        last = self.__dict__.get("_digest")
+        object.__setattr__(self, "_digest", digest)
+        if last is None or last == digest or self._changed:
+            return False
+        self.touch()
+        return True
+
+    def __reduce_ex__(self, protocol):
+        # Everything worth saving is in the dict itself.
+        return type(self), (), None, None, iter(self.items())
+
+
 class StorageMixin:
     """
     Convenience class for adding access to a player's server-based storage.